@@ -9,6 +9,18 @@
 ## program in mind but I'd like to spin this piece off as its own little thing
 
 debug = False
+max_steps = 500 # picks a greedy search makes before giving up
+
+import atexit
+import functools
+import hashlib
+import multiprocessing
+import threading
+import time
+import traceback
+import numpy as np
+import milp # exact (branch-and-bound) searches
+import instrument # PERFECTMEAL_PROFILE counters and timers
 
 def algorithm_names():
     """ Return a list of different algorithm options """
@@ -16,11 +28,16 @@ def algorithm_names():
             "greedy_finishline","greedy_finishline_pickonce",
             "greedy_alternating","greedy_alternating_pickonce",
             "greedy_runwalk","greedy_runwalk_pickonce",
-            "greedy_goldilocks","greedy_goldilocks_pickonce",]
+            "greedy_goldilocks","greedy_goldilocks_pickonce",
+            "exact_servings","exact_mass","exact_balance",
+            "portfolio",]
 
 
+@instrument.timed()
 def ackp(possibilities, minimums, maximums=None, currents=None, 
-         algorithm="greedy_balance"):
+         algorithm="greedy_balance", engine="dict", progress=None,
+         costs=None, time_limit=None, prune=None, report=None,
+         arrays=None):
     """ 
     Main interface function for the library.  Primarily a dispatch.
 
@@ -34,6 +51,42 @@ def ackp(possibilities, minimums, maximums=None, currents=None,
               names and their values].  The current members of the knapsack.
     algorithm: if the user has a preference of algorithm it can be entered 
                here
+    engine: "dict" runs the greedy algorithms on the dictionaries directly,
+            "array" converts everything to NumPy arrays once and scores all
+            the candidates of a step in one batch (same picks, much faster
+            for large numbers of possibilities), "parallel" is the array
+            engine with each step's scoring spread over a pool of worker
+            processes (same picks again, see greedy_alg_parallel)
+    progress: optional callable, called as progress(step, score) after
+              each pick of a greedy search (score is the indexer's value
+              for the pick, smaller is better).  If it returns False the
+              search stops and returns the picks made so far.
+              The exact searches call it as progress(nodes, value), at
+              most every milp.PROGRESS_INTERVAL seconds.
+    costs: per-possibility costs for "exact_mass" (the serving sizes)
+    time_limit: seconds an exact search may run before it settles for the
+                best meal found so far (milp.DEFAULT_TIME_LIMIT if None)
+
+    The "exact_" algorithms treat the minimums and maximums as hard limits
+    and search for the best whole number of servings of each possibility
+    (see milp.py): fewest servings, least mass or best balance.  They
+    return None if no meal can meet the limits.
+    prune: None, "safe" or "heuristic", see prune_possibilities.  The exact
+           searches always prune at least "safe" (it can't change their
+           result), the greedy ones only prune when asked to.
+    report: optional dictionary, filled in with the number of candidates
+            ('candidates') and how many were pruned for each reason
+            ('pruned'), for the exact searches whether they finished
+            ('optimal'), and for "portfolio" the table of results
+            ('portfolio', see portfolio())
+
+    arrays: optional (keys, matrix) when the caller already has the
+            possibilities' values as a float matrix (one row per
+            possibility, one column per key, NaN for None), used by every
+            engine but "dict" instead of converting the dictionaries
+
+    "portfolio" runs all of the greedy algorithms in worker processes and
+    returns the best of their meals (see portfolio())
    
     currently defaults to "greedy_balance"
     """
@@ -53,46 +106,101 @@ def ackp(possibilities, minimums, maximums=None, currents=None,
         assert set(possibilities[0][1].keys()) == set(maximums[1].keys())
     if currents != None:
         assert set(possibilities[0][1].keys()) == set(currents[0][1].keys())
+
+    if prune is None and algorithm.startswith("exact_"):
+        prune = "safe"
+    has_data = None
+    if prune is not None:
+        if algorithm.startswith("exact_"):
+            # the exact searches constrain every nutrient any possibility
+            # has data for, including the ones about to be pruned
+            has_data = ~np.isnan(to_arrays(possibilities, minimums, maximums,
+                                           arrays)[1]).all(axis=0)
+        # dominance isn't safe for the balance objective, a weaker food can
+        # even out a meal better than a stronger one
+        dominance = prune == "heuristic" or \
+                    algorithm in ("exact_servings", "exact_mass")
+        if prune == "safe" and algorithm != "exact_mass":
+            dominance_costs = None # a serving is a serving
+        else:
+            dominance_costs = costs
+        kept, dropped = prune_possibilities(possibilities, minimums,
+                                            maximums, currents, prune,
+                                            dominance_costs, dominance,
+                                            arrays)
+        possibilities = [possibilities[index] for index in kept]
+        if arrays is not None:
+            arrays = (arrays[0], arrays[1][kept])
+        if costs is not None:
+            costs = [costs[index] for index in kept]
+        if report is not None:
+            report['pruned'] = dropped
+        if debug: print 'pruned', dropped
+    if report is not None:
+        report['candidates'] = len(possibilities)
     
     # dispatch
-    if "greedy" in algorithm:
+    if algorithm == "portfolio":
+        currents, table = portfolio(possibilities, minimums, maximums,
+                                    currents, engine=engine, costs=costs,
+                                    time_limit=time_limit, arrays=arrays)
+        if report is not None:
+            report['portfolio'] = table
+        return currents
+    elif "greedy" in algorithm:
+        if engine == "dict":
+            greedy = greedy_alg
+        elif engine == "array":
+            greedy = greedy_alg_array
+        elif engine == "parallel":
+            greedy = greedy_alg_parallel
+        else:
+            raise ValueError("unknown engine: %s" % engine)
+        greedy = functools.partial(greedy, progress=progress)
+        if engine != "dict":
+            greedy = functools.partial(greedy, arrays=arrays)
         if "greedy_balance" == algorithm:
             if debug: print 'calling greedy_alg'
-            return greedy_alg(possibilities, minimums, maximums, currents, 
-                              balance_indx) # balance_indx defined below
+            return greedy(possibilities, minimums, maximums, currents, 
+                          balance_indx) # balance_indx defined below
         elif "greedy_balance_pickonce" == algorithm:
-            return greedy_alg(possibilities, minimums, maximums, currents, 
-                              balance_indx, unique=True)
+            return greedy(possibilities, minimums, maximums, currents, 
+                          balance_indx, unique=True)
         elif "greedy_finishline" == algorithm:
-            return greedy_alg(possibilities, minimums, maximums, currents, 
-                              finishline_indx)
+            return greedy(possibilities, minimums, maximums, currents, 
+                          finishline_indx)
         elif "greedy_finishline_pickonce" == algorithm:
-            return greedy_alg(possibilities, minimums, maximums, currents, 
-                              finishline_indx, unique=True)
+            return greedy(possibilities, minimums, maximums, currents, 
+                          finishline_indx, unique=True)
         elif "greedy_alternating"  == algorithm:
-            return greedy_alg(possibilities, minimums, maximums, currents, 
-                              alternating_indx)
+            return greedy(possibilities, minimums, maximums, currents, 
+                          alternating_indx)
         elif "greedy_alternating_pickonce"  == algorithm:
-            return greedy_alg(possibilities, minimums, maximums, currents, 
-                              alternating_indx, unique=True)
+            return greedy(possibilities, minimums, maximums, currents, 
+                          alternating_indx, unique=True)
         elif "greedy_runwalk"  == algorithm:
-            return greedy_alg(possibilities, minimums, maximums, currents, 
-                              runwalk_indx)
+            return greedy(possibilities, minimums, maximums, currents, 
+                          runwalk_indx)
         elif "greedy_runwalk_pickonce"  == algorithm:
-            return greedy_alg(possibilities, minimums, maximums, currents, 
-                              runwalk_indx, unique=True)
+            return greedy(possibilities, minimums, maximums, currents, 
+                          runwalk_indx, unique=True)
         elif "greedy_goldilocks"  == algorithm:
-            return greedy_alg(possibilities, minimums, maximums, currents, 
-                              goldilocks_indx)
+            return greedy(possibilities, minimums, maximums, currents, 
+                          goldilocks_indx)
         elif "greedy_goldilocks_pickonce"  == algorithm:
-            return greedy_alg(possibilities, minimums, maximums, currents, 
-                              goldilocks_indx, unique=True)
+            return greedy(possibilities, minimums, maximums, currents, 
+                          goldilocks_indx, unique=True)
         else:
             return NotImplemented
 
-    elif "super awesome whatever" in algorithm:
-        ## todo. non-greedy algorithms.  should be interesting....
-        pass
+    elif algorithm.startswith("exact_"):
+        objective = algorithm[len("exact_"):]
+        if objective not in milp.OBJECTIVES:
+            return NotImplemented
+        return exact_alg(possibilities, minimums, maximums, currents,
+                         objective, costs=costs, time_limit=time_limit,
+                         progress=progress, arrays=arrays, report=report,
+                         has_data=has_data)
     else:
         if debug: print 'no algorithm match found'
         return None
@@ -146,7 +254,7 @@ def dict_sub(dict1, dict2):
 
 ## Greedy Algorithms
 def greedy_alg(possibilities, minimums, maximums, currents, indexer, 
-               unique=False):
+               unique=False, progress=None):
     """
     This is a greedy algorithm (i.e. continual local optimization)
 
@@ -157,6 +265,8 @@ def greedy_alg(possibilities, minimums, maximums, currents, indexer,
     currents: a list of dictionaries the current values, must have same keys
     unique: False means a 'possibility' can be used more than once.  True means
             it will be removed from 'possibilities' once used
+    progress: optional callable(step, score), returning False stops the
+              search (see ackp)
             """
     if debug: print 'greedy_alg...'
     # find current total
@@ -174,6 +284,7 @@ def greedy_alg(possibilities, minimums, maximums, currents, indexer,
             total[1][key] = 0
             
 
+    @instrument.timed('ackpl.greedy_alg.step')
     def _next_item_helper(possibilities):
         current_next = possibilities[0]
         current_score = indexer(minimums,
@@ -191,10 +302,10 @@ def greedy_alg(possibilities, minimums, maximums, currents, indexer,
                 current_score = poss_score
         if unique == True:
             possibilities.remove(current_next)
-        return current_next
+        return current_next, current_score
     if debug: print 'pre while loop'
     i = 0
-    while i < 500:
+    while i < max_steps:
         i += 1
         if maximums is not None:
             if not dict_greater(maximums[1], total[1]):
@@ -207,14 +318,18 @@ def greedy_alg(possibilities, minimums, maximums, currents, indexer,
         if len(possibilities) < 1:
             if debug: print 'out of new possibilities'
             return currents
-        next_item = _next_item_helper(possibilities)
+        next_item, score = _next_item_helper(possibilities)
         currents.append(next_item)
         total[1] = dict_add(total[1], next_item[1])
+        if progress is not None and progress(i, score) is False:
+            if debug: print 'stopped by progress callback'
+            return currents
     if debug: print 'end greedy_val'
     return currents
 
 
 # Simple Indexers (smaller index value is better)
+@instrument.timed()
 def finishline_indx(minimums, total, currents, maximums=None):
     """
     Measures total distance to the finish line of having all values in
@@ -229,6 +344,7 @@ def finishline_indx(minimums, total, currents, maximums=None):
                 distance += ((minimums_val - total_val) / float(minimums_val))
     return distance
 
+@instrument.timed()
 def balance_indx(minimums, total, currents, maximums=None):
     """
     Measures balance of currents, total distance to 'minimums' is calculated 
@@ -256,6 +372,7 @@ def balance_indx(minimums, total, currents, maximums=None):
     return b_factor
 
 # includes both desire to meet minimum and aversion to exceeding maximum
+@instrument.timed()
 def goldilocks_indx(minimums, total, currents, maximums):
     """ goldilocks_indx by adding points both for being short of the minimum,
         and then for getting too close to the maximum
@@ -275,12 +392,14 @@ def goldilocks_indx(minimums, total, currents, maximums):
     return score
 
 # Complex Indexers
+@instrument.timed()
 def alternating_indx(minimums, total, currents, maximums=None):
     if len(currents) % 2 == 0:
         return finishline_indx(minimums, total, currents)
     else:
         return balance_indx(minimums, total, currents)
 
+@instrument.timed()
 def runwalk_indx(minimums, total, currents, maximums=None):
     ## needs dict_sub method to find total - currents[-1]
     if len(currents) < 1:
@@ -293,6 +412,742 @@ def runwalk_indx(minimums, total, currents, maximums=None):
 
 
 
+## Array engine
+## The same greedy search as greedy_alg, but the dictionaries are converted
+## to NumPy arrays once (NaN standing in for None) and every candidate of a
+## step is scored in one batch.  All values are treated as floats.
+def to_arrays(possibilities, minimums, maximums=None, arrays=None):
+    """ Converts possibilities, minimums and maximums to arrays.  Returns the
+        key order, a (possibilities x keys) matrix, and the minimum and
+        maximum vectors (the maximum vector is None if maximums is None)
+        If the caller already has the (keys, matrix) of the possibilities
+        they can be passed in as 'arrays'.
+        """
+    if arrays is None:
+        keys = list(minimums[1].keys())
+    else:
+        keys, matrix = arrays
+        assert len(matrix) == len(possibilities)
+    def _vector(d):
+        return [np.nan if d[key] is None else d[key] for key in keys]
+    if arrays is None:
+        matrix = np.array([_vector(poss[1]) for poss in possibilities],
+                          dtype=float).reshape(len(possibilities), len(keys))
+    mins = np.array(_vector(minimums[1]), dtype=float)
+    maxs = None
+    if maximums is not None:
+        maxs = np.array(_vector(maximums[1]), dtype=float)
+    return keys, matrix, mins, maxs
+
+def array_add(first, second):
+    """ The array version of dict_add, NaN + x is x """
+    return np.where(np.isnan(first), second,
+                    np.where(np.isnan(second), first, first + second))
+
+def array_sub(first, second):
+    """ The array version of dict_sub, NaN - x is -x """
+    return np.where(np.isnan(first), -second,
+                    np.where(np.isnan(second), first, first - second))
+
+def array_greater(first, second):
+    """ The array version of dict_greater """
+    with np.errstate(invalid='ignore'):
+        return not np.any(first < second)
+
+# batched indexers, each row of 'totals' is one candidate total
+def finishline_scores(mins, totals, maxs=None):
+    """ finishline_indx for every row of totals """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        short = totals < mins # False wherever either side is NaN
+        return np.where(short, (mins - totals) / mins, 0.).sum(axis=1)
+
+def balance_scores(mins, totals, maxs=None):
+    """ balance_indx for every row of totals """
+    valid = ~np.isnan(totals) & ~np.isnan(mins)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratios = np.where(valid, totals / mins, 0.)
+        average = ratios.sum(axis=1) / valid.sum(axis=1)
+        return np.where(valid, np.abs(average[:, None] - ratios),
+                        0.).sum(axis=1)
+
+def goldilocks_scores(mins, totals, maxs):
+    """ goldilocks_indx for every row of totals """
+    assert maxs is not None
+    valid = ~np.isnan(totals) & ~np.isnan(mins) & ~np.isnan(maxs)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        over = np.any(valid & (totals >= maxs), axis=1)
+        scores = np.where(valid & ~(totals >= maxs),
+                          (maxs - mins) / (maxs - totals), 0.).sum(axis=1)
+    scores[over] = 100000000 # same "big enough" number as goldilocks_indx
+    return scores
+
+def _batch_scores(indexer, mins, maxs, total, candidates, currents):
+    """ Scores every row of candidates (added to total) the way 'indexer'
+        would score them one at a time.
+        """
+    totals = array_add(total[None, :], candidates)
+    if indexer is finishline_indx:
+        return finishline_scores(mins, totals, maxs)
+    elif indexer is balance_indx:
+        return balance_scores(mins, totals, maxs)
+    elif indexer is goldilocks_indx:
+        return goldilocks_scores(mins, totals, maxs)
+    elif indexer is alternating_indx:
+        if len(currents) % 2 == 0:
+            return finishline_scores(mins, totals)
+        return balance_scores(mins, totals)
+    elif indexer is runwalk_indx:
+        if len(currents) < 1:
+            return finishline_scores(mins, totals)
+        last_totals = array_sub(totals, currents[-1])
+        run = finishline_scores(mins, last_totals) / len(currents) < .75
+        return np.where(run, finishline_scores(mins, totals),
+                        balance_scores(mins, totals))
+    raise ValueError("the array engine has no batched version of %s" %
+                     indexer.__name__)
+
+## Incremental scorers
+## The greedy search only ever adds to its total, so as long as no value is
+## negative some of the scoring work carries over from one step to the next:
+##  -finishline: a nutrient the total has reached can't score again, only
+##   the nutrients that are still short are looked at
+##  -goldilocks: a candidate that would pass a maximum always will, it keeps
+##   its "big enough" score without being rescored, and the other
+##   candidates' terms are only recomputed for nutrients whose total changed
+##  -balance: only the nutrients that have a minimum are looked at, with
+##   their slice of the matrix and its missing-value mask cached.  The
+##   average ratio is the total's ratio sum plus each candidate's (cached),
+##   over the nutrients either has a value for: the total's count plus,
+##   per candidate, the ones it has and the total doesn't (kept up to date
+##   as the total gets values)
+## alternating uses the finishline and balance scorers, runwalk falls back
+## to _batch_scores.
+class FinishlineScorer(object):
+    def __init__(self, matrix, mins):
+        self.mins = mins
+        self.active = np.flatnonzero(~np.isnan(mins))
+        self.columns = matrix[:, self.active]
+
+    def scores(self, total, rows, currents=None):
+        with np.errstate(invalid='ignore'):
+            met = total[self.active] >= self.mins[self.active]
+        if met.any():
+            self.active = self.active[~met]
+            self.columns = self.columns[:, ~met]
+        totals = array_add(total[self.active][None, :], self.columns[rows])
+        return finishline_scores(self.mins[self.active], totals)
+
+class BalanceScorer(object):
+    def __init__(self, matrix, mins):
+        self.cols = np.flatnonzero(~np.isnan(mins))
+        self.mins = mins[self.cols]
+        self.columns = matrix[:, self.cols]
+        self.has_value = ~np.isnan(self.columns)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.row_sums = np.where(self.has_value,
+                                     self.columns / self.mins,
+                                     0.).sum(axis=1)
+        self.known = np.zeros(len(self.cols), dtype=bool)
+        self.row_counts = self.has_value.sum(axis=1)
+
+    def scores(self, total, rows, currents=None):
+        total = total[self.cols]
+        known = ~np.isnan(total)
+        if np.any(self.known & ~known):
+            # not the total this scorer has been following, start over
+            self.known = np.zeros(len(self.cols), dtype=bool)
+            self.row_counts = self.has_value.sum(axis=1)
+        added = known & ~self.known
+        if added.any():
+            self.row_counts = self.row_counts - \
+                              self.has_value[:, added].sum(axis=1)
+            self.known = known
+        valid = self.has_value[rows] | known
+        totals = array_add(total[None, :], self.columns[rows])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            total_sum = np.where(known, total / self.mins, 0.).sum()
+            average = (total_sum + self.row_sums[rows]) / \
+                      (known.sum() + self.row_counts[rows])
+            return np.where(valid, np.abs(average[:, None] -
+                                          totals / self.mins),
+                            0.).sum(axis=1)
+
+class GoldilocksScorer(object):
+    def __init__(self, matrix, mins, maxs):
+        self.cols = np.flatnonzero(~np.isnan(mins) & ~np.isnan(maxs))
+        self.mins, self.maxs = mins[self.cols], maxs[self.cols]
+        self.columns = matrix[:, self.cols]
+        self.terms = np.zeros(self.columns.shape)
+        self.over = np.zeros(len(matrix), dtype=bool)
+        self.total = None
+
+    def scores(self, total, rows, currents=None):
+        total = total[self.cols]
+        if self.total is None:
+            changed = np.arange(len(total))
+        else:
+            same = (total == self.total) | \
+                   (np.isnan(total) & np.isnan(self.total))
+            changed = np.flatnonzero(~same)
+        self.total = total.copy()
+        live = np.flatnonzero(~self.over)
+        if len(changed) and len(live):
+            block = np.ix_(live, changed)
+            totals = array_add(total[changed][None, :], self.columns[block])
+            valid = ~np.isnan(totals)
+            maxs, mins = self.maxs[changed], self.mins[changed]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                over = valid & (totals >= maxs)
+                self.terms[block] = np.where(valid & ~over,
+                                             (maxs - mins) / (maxs - totals),
+                                             0.)
+            self.over[live[np.any(over, axis=1)]] = True
+        scores = self.terms[rows].sum(axis=1)
+        scores[self.over[rows]] = 100000000 # as in goldilocks_indx
+        return scores
+
+class AlternatingScorer(object):
+    def __init__(self, matrix, mins):
+        self.finishline = FinishlineScorer(matrix, mins)
+        self.balance = BalanceScorer(matrix, mins)
+
+    def scores(self, total, rows, currents=None):
+        if len(currents) % 2 == 0:
+            return self.finishline.scores(total, rows)
+        return self.balance.scores(total, rows)
+
+def has_negatives(matrix):
+    with np.errstate(invalid='ignore'):
+        return bool(np.any(matrix < 0))
+
+def incremental_scorer(indexer, matrix, mins, maxs):
+    """ The incremental scorer for indexer, or None if there isn't one (or
+        the matrix has negative values, which break its assumptions)
+        """
+    if has_negatives(matrix):
+        return None
+    if indexer is finishline_indx:
+        return FinishlineScorer(matrix, mins)
+    elif indexer is balance_indx:
+        return BalanceScorer(matrix, mins)
+    elif indexer is goldilocks_indx and maxs is not None:
+        return GoldilocksScorer(matrix, mins, maxs)
+    elif indexer is alternating_indx:
+        return AlternatingScorer(matrix, mins)
+    return None
+
+class CandidateScan(object):
+    def __init__(self, matrix, offset, mins, maxs, indexer, unique,
+                 current_vectors, incremental=True):
+        """ Picks the best candidate of a block of rows at every step of a
+            greedy search.  The rows are candidates offset, offset + 1...
+            of the whole search (the parallel engine gives each worker one
+            block, the serial one uses a single block).
+            """
+        self.matrix = matrix
+        self.offset = offset
+        self.mins, self.maxs = mins, maxs
+        self.indexer = indexer
+        self.unique = unique
+        self.current_vectors = list(current_vectors)
+        self.available = np.arange(len(matrix))
+        self.scorer = None
+        if incremental:
+            self.scorer = incremental_scorer(indexer, matrix, mins, maxs)
+
+    @instrument.timed('ackpl.CandidateScan.step')
+    def step(self, total, pick=None):
+        """ 'pick' is the (index, vector) picked by the previous step, if
+            any.  Returns the (score, index) of the best available row,
+            (inf, -1) if there are none.
+            """
+        if pick is not None:
+            index, vector = pick
+            self.current_vectors.append(vector)
+            if self.unique:
+                self.available = \
+                    self.available[self.available != index - self.offset]
+        if len(self.available) < 1:
+            return np.inf, -1
+        instrument.count('ackpl.candidates_scored', len(self.available))
+        if self.scorer is None:
+            scores = _batch_scores(self.indexer, self.mins, self.maxs, total,
+                                   self.matrix[self.available],
+                                   self.current_vectors)
+        else:
+            scores = self.scorer.scores(total, self.available,
+                                        self.current_vectors)
+        best = np.argmin(scores) # first of any ties, like greedy_alg
+        return scores[best], self.offset + self.available[best]
+
+def greedy_alg_array(possibilities, minimums, maximums, currents, indexer,
+                     unique=False, progress=None, pool=None, arrays=None):
+    """
+    Array-backed version of greedy_alg, same arguments and same picks.
+    'possibilities' is not mutated, used items are tracked by index instead.
+    pool: a ScoringPool to spread the scoring of every step over
+    arrays: the possibilities' (keys, matrix), see to_arrays
+    """
+    if debug: print 'greedy_alg_array...'
+    keys, matrix, mins, maxs = to_arrays(possibilities, minimums, maximums,
+                                         arrays)
+    def _vector(d):
+        return np.array([np.nan if d[key] is None else d[key]
+                         for key in keys], dtype=float)
+    # find current total
+    if currents is not None:
+        current_vectors = [_vector(curr[1]) for curr in currents]
+        total = current_vectors[0]
+        for vector in current_vectors[1:]:
+            total = array_add(total, vector)
+    else:
+        currents = []
+        current_vectors = []
+        total = np.zeros(len(keys))
+    incremental = not has_negatives(matrix)
+    if pool is None:
+        scan = CandidateScan(matrix, 0, mins, maxs, indexer, unique,
+                             current_vectors, incremental)
+    else:
+        pool.load(matrix, mins, maxs, indexer, unique, current_vectors,
+                  incremental)
+        scan = pool
+    remaining = len(possibilities)
+    pick = None
+
+    i = 0
+    while i < max_steps:
+        i += 1
+        if maxs is not None:
+            if not array_greater(maxs, total):
+                # dead end reached, return current total
+                if debug: print 'dead end reached in greedy search algorithm'
+                return currents
+        if array_greater(total, mins):
+            if debug: print 'success, returning currents'
+            return currents
+        if remaining < 1:
+            if debug: print 'out of new possibilities'
+            return currents
+        score, index = scan.step(total, pick)
+        if unique == True:
+            remaining -= 1
+        currents.append(possibilities[index])
+        total = array_add(total, matrix[index])
+        pick = (index, matrix[index])
+        if progress is not None and progress(i, score) is False:
+            if debug: print 'stopped by progress callback'
+            return currents
+    if debug: print 'end greedy_alg_array'
+    return currents
+
+## Parallel engine
+## A pool of worker processes that is started once and reused.  For each
+## search every worker gets one block of rows of the candidate matrix (kept
+## between searches over the same matrix), after that a step only sends out
+## the total and the previous pick, and each worker answers with the best
+## (score, index) of its block.  The lowest score wins and ties go to the
+## lowest index, the same as np.argmin over the whole matrix.
+parallel_threshold = 2000 # smaller searches aren't worth the messaging
+scoring_processes = None # None for one per CPU
+
+def _scoring_worker(connection):
+    # runs in the worker processes
+    blocks = {}
+    scan = None
+    error = None # loads aren't answered, a failed one is reported by step
+    while True:
+        message = connection.recv()
+        if message[0] == 'stop':
+            break
+        try:
+            if message[0] == 'load':
+                error = None
+                (key, block, offset, mins, maxs, indexer, unique,
+                 current_vectors, incremental) = message[1:]
+                if block is None:
+                    block = blocks[key]
+                else:
+                    blocks = {key: block}
+                scan = CandidateScan(block, offset, mins, maxs, indexer,
+                                     unique, current_vectors, incremental)
+            elif error is not None:
+                connection.send(('error', error))
+            else:
+                connection.send(scan.step(*message[1:]))
+        except Exception:
+            error = traceback.format_exc()
+            if message[0] == 'step':
+                connection.send(('error', error))
+
+def _best_result(results):
+    # lowest score first (NaN before anything, as with np.argmin), then
+    # lowest index
+    def _order(result):
+        score, index = result
+        if np.isnan(score):
+            return (0, 0., index)
+        return (1, score, index)
+    return min(results, key=_order)
+
+class ScoringPool(object):
+    def __init__(self, processes=None):
+        """ Starts 'processes' worker processes (one per CPU if None) """
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.connections = []
+        self.processes = []
+        for i in range(processes):
+            parent_end, child_end = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_scoring_worker,
+                                              args=(child_end,))
+            process.daemon = True
+            process.start()
+            self.connections.append(parent_end)
+            self.processes.append(process)
+        self.lock = threading.Lock() # one search at a time
+        self.key = None
+
+    def load(self, matrix, mins, maxs, indexer, unique, current_vectors,
+             incremental):
+        """ Hands every worker its block of matrix for a new search, blocks
+            the workers already hold aren't sent again.
+            """
+        key = (matrix.shape, hashlib.sha1(matrix.tostring()).hexdigest())
+        resend = key != self.key
+        bounds = np.linspace(0, len(matrix),
+                             len(self.connections) + 1).astype(int)
+        try:
+            for i, connection in enumerate(self.connections):
+                lo, hi = bounds[i], bounds[i + 1]
+                connection.send(('load', key,
+                                 matrix[lo:hi] if resend else None,
+                                 lo, mins, maxs, indexer, unique,
+                                 current_vectors, incremental))
+        except Exception:
+            _discard_pool(self)
+            raise
+        self.key = key
+
+    @instrument.timed('ackpl.ScoringPool.step')
+    def step(self, total, pick=None):
+        """ CandidateScan.step over all of the workers' blocks.  If any
+            worker fails, its answers and the other workers' can't be
+            trusted anymore and the pool is closed (scoring_pool starts a
+            new one).
+            """
+        try:
+            for connection in self.connections:
+                connection.send(('step', total, pick))
+            results = [connection.recv() for connection in self.connections]
+        except Exception:
+            _discard_pool(self)
+            raise
+        for result in results:
+            if isinstance(result[0], str):
+                _discard_pool(self)
+                raise RuntimeError('scoring worker failed:\n' + result[1])
+        return _best_result(results)
+
+    def close(self):
+        for connection in self.connections:
+            try:
+                connection.send(('stop',))
+            except (IOError, OSError):
+                pass
+        for process in self.processes:
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+        for connection in self.connections:
+            connection.close()
+        self.connections, self.processes = [], []
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def scoring_pool():
+    """ The shared ScoringPool, started on first use """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ScoringPool(scoring_processes)
+            atexit.register(_pool.close)
+        return _pool
+
+def _discard_pool(pool):
+    # closes a broken pool, the next search gets a new one
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.close()
+
+def greedy_alg_parallel(possibilities, minimums, maximums, currents, indexer,
+                        unique=False, progress=None, arrays=None):
+    """
+    greedy_alg_array with every step scored by the shared ScoringPool.
+    Searches smaller than parallel_threshold, or started while another
+    search is using the pool, are scored in this process.  Same picks
+    either way.
+    """
+    if len(possibilities) < parallel_threshold:
+        return greedy_alg_array(possibilities, minimums, maximums, currents,
+                                indexer, unique, progress, arrays=arrays)
+    pool = scoring_pool()
+    if not pool.lock.acquire(False):
+        return greedy_alg_array(possibilities, minimums, maximums, currents,
+                                indexer, unique, progress, arrays=arrays)
+    try:
+        return greedy_alg_array(possibilities, minimums, maximums, currents,
+                                indexer, unique, progress, pool=pool,
+                                arrays=arrays)
+    finally:
+        pool.lock.release()
+
+## Candidate pruning
+## Many foods can never be (usefully) picked, taking them out up front saves
+## scoring them at every step.
+dominance_probes = 64 # strongest candidates every other one is checked against
+
+def prune_possibilities(possibilities, minimums, maximums=None, currents=None,
+                        level="safe", costs=None, dominance=True,
+                        arrays=None):
+    """
+    Finds the possibilities worth searching.  Missing values count as 0.
+
+    level "safe" drops only what can't be part of a best exact solution:
+      -possibilities with no nonzero values
+      -possibilities that pass a maximum on their own (with the currents)
+      -(if dominance) possibilities dominated by another one: at least as
+       much of every nutrient still under its minimum, at most as much of
+       every nutrient with a maximum, and at most the same cost ('costs',
+       every serving costs the same if None)
+    level "heuristic" (for the greedy searches) also drops:
+      -possibilities with none of the nutrients still under their minimums
+    and uses per cost (per gram when 'costs' are serving sizes) dominance
+    on the nutrients under their minimums only.
+
+    Dominance is only checked against the 'dominance_probes' strongest
+    possibilities, so some dominated ones may be kept.
+
+    'arrays' are the possibilities' (keys, matrix), see to_arrays.
+
+    Returns (kept, dropped): the indices of the kept possibilities (in
+    order) and a dictionary of the number dropped for each reason.
+    """
+    assert level in ("safe", "heuristic")
+    keys, matrix, mins, maxs = to_arrays(possibilities, minimums, maximums,
+                                         arrays)
+    values = np.where(np.isnan(matrix), 0., matrix)
+    current = np.zeros(len(keys))
+    for curr in currents or []:
+        current += [curr[1][key] or 0. for key in keys]
+    keep = np.ones(len(possibilities), dtype=bool)
+    dropped = {}
+    def _drop(reason, mask):
+        mask = mask & keep
+        dropped[reason] = int(mask.sum())
+        keep[mask] = False
+
+    _drop('no_data', ~np.any(values != 0, axis=1))
+    with np.errstate(invalid='ignore'):
+        if maxs is not None:
+            _drop('over_max', np.any(current + values > maxs, axis=1))
+            limited = ~np.isnan(maxs)
+        else:
+            limited = np.zeros(len(keys), dtype=bool)
+        short = (mins > 0) & ~(current >= mins)
+    if level == "heuristic":
+        _drop('no_help', ~np.any(values[:, short] > 0, axis=1))
+
+    dropped['dominated'] = 0
+    if dominance and keep.any():
+        if costs is None:
+            cost = np.ones(len(possibilities))
+        else:
+            cost = np.asarray(costs, dtype=float)
+        if level == "heuristic":
+            # compare per unit of cost, nothing else matters
+            values = values / np.where(cost > 0, cost, 1.)[:, None]
+            cost = np.zeros(len(possibilities))
+            limited = np.zeros(len(keys), dtype=bool)
+        better = values[:, short]
+        worse = values[:, limited]
+        strength = (better / mins[short]).sum(axis=1)
+        candidates = np.flatnonzero(keep)
+        order = np.argsort(-strength[candidates], kind='mergesort')
+        indices = np.arange(len(possibilities))
+        for probe in candidates[order[:dominance_probes]]:
+            at_least = np.all(better[probe] >= better, axis=1) & \
+                       np.all(worse[probe] <= worse, axis=1) & \
+                       (cost[probe] <= cost)
+            strictly = np.any(better[probe] > better, axis=1) | \
+                       np.any(worse[probe] < worse, axis=1) | \
+                       (cost[probe] < cost) | (probe < indices)
+            dominated = at_least & strictly & (indices != probe) & keep
+            dropped['dominated'] += int(dominated.sum())
+            keep[dominated] = False
+    return list(np.flatnonzero(keep)), dropped
+
+## Exact searches
+def exact_alg(possibilities, minimums, maximums, currents, objective,
+              costs=None, time_limit=None, progress=None, arrays=None,
+              report=None, has_data=None):
+    """
+    Branch-and-bound search for the meal that meets every minimum without
+    passing any maximum and is best for 'objective' (see milp.OBJECTIVES).
+    Returns currents plus the picks (a possibility appears once per
+    serving), or None if no such meal was found.
+    report: optional dictionary, 'optimal' is set to False if the search
+            was cut short by time_limit or progress
+    has_data: optional boolean vector (in the key order of to_arrays) of
+              the nutrients to constrain, see milp.Problem
+    """
+    keys, matrix, mins, maxs = to_arrays(possibilities, minimums, maximums,
+                                         arrays)
+    def _vector(d):
+        return np.array([np.nan if d[key] is None else d[key]
+                         for key in keys], dtype=float)
+    total = None
+    if currents:
+        total = _vector(currents[0][1])
+        for curr in currents[1:]:
+            total = array_add(total, _vector(curr[1]))
+    servings, value, optimal = milp.branch_and_bound(
+        matrix, mins, maxs, total, objective, costs=costs,
+        time_limit=time_limit, progress=progress, has_data=has_data)
+    if debug: print 'exact_alg', objective, value, 'optimal:', optimal
+    if report is not None:
+        report['optimal'] = optimal
+    if servings is None:
+        return None
+    picks = list(currents or [])
+    for index in np.flatnonzero(servings):
+        picks.extend([possibilities[index]] * servings[index])
+    return picks
+
+## Portfolio
+## Runs several algorithms at once in worker processes and keeps the best
+## meal.  Every result is judged the same way (meal_quality): how far it
+## falls short of the minimums plus how far it goes over the maximums,
+## then the number of servings it added.  The workers share the fewest
+## servings of any meal that met every limit, a greedy search that has
+## already picked more than that can't win and stops.
+def meal_quality(picks, minimums, maximums=None, currents=None):
+    """ Returns (penalty, servings) for a meal of currents plus picks, lower
+        is better.  penalty is the summed fraction by which nutrients fall
+        short of their minimums or go over their maximums, 0 for a meal
+        within every limit.
+        """
+    keys, matrix, mins, maxs = to_arrays(list(currents or []) + list(picks),
+                                         minimums, maximums)
+    total = np.zeros(len(keys))
+    for vector in matrix:
+        total = array_add(total, vector)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        penalty = np.where(total < mins, (mins - total) / mins, 0.).sum()
+        if maxs is not None:
+            penalty += np.where(total > maxs,
+                                (total - maxs) / np.abs(maxs), 0.).sum()
+    return float(penalty), len(picks)
+
+_portfolio_job = None
+
+def _portfolio_init(job, best_servings):
+    # runs in each worker, the job (shared by every task) and the shared
+    # best are handed over once instead of with every task
+    global _portfolio_job
+    _portfolio_job = job + (best_servings,)
+
+def _portfolio_task(algorithm):
+    (possibilities, minimums, maximums, currents, engine, costs, time_limit,
+     arrays, best_servings) = _portfolio_job
+    state = {'stopped': False}
+    def _progress(step, score):
+        # a greedy search with more picks than a meal that met every limit
+        # can't win
+        if step > best_servings.value:
+            state['stopped'] = True
+            return False
+    start = time.time()
+    try:
+        picks = ackp(list(possibilities), minimums, maximums,
+                     list(currents) if currents else None, algorithm,
+                     engine=engine, costs=costs, time_limit=time_limit,
+                     progress=_progress if "greedy" in algorithm else None,
+                     arrays=arrays)
+    except Exception:
+        return algorithm, None, time.time() - start, \
+               'error: ' + traceback.format_exc().splitlines()[-1]
+    seconds = time.time() - start
+    if picks is None or picks is NotImplemented:
+        return algorithm, None, seconds, 'no meal'
+    # hand back indices, the parent maps them onto its own possibilities
+    position = dict((id(poss), i) for i, poss in enumerate(possibilities))
+    indices = [position[id(poss)] for poss in picks[len(currents or []):]]
+    if not state['stopped']:
+        penalty, servings = meal_quality([possibilities[i] for i in indices],
+                                         minimums, maximums, currents)
+        if penalty == 0:
+            with best_servings.get_lock():
+                if servings < best_servings.value:
+                    best_servings.value = servings
+    return algorithm, indices, seconds, \
+           'stopped' if state['stopped'] else 'done'
+
+def portfolio(possibilities, minimums, maximums=None, currents=None,
+              algorithms=None, engine="array", processes=None, costs=None,
+              time_limit=None, arrays=None):
+    """
+    Runs each of 'algorithms' (every greedy algorithm if None) on the same
+    problem in a pool of 'processes' worker processes (one per CPU if None)
+    and returns (currents, table).
+
+    currents is the best meal by meal_quality (currents plus picks, like
+    ackp, None if no algorithm produced a meal).  table has one dictionary
+    per algorithm, best first: 'algorithm', 'seconds', 'status' ("done",
+    "stopped" when it couldn't beat another meal anymore, "no meal" or an
+    error), 'penalty', 'servings' and 'best'.
+    """
+    if algorithms is None:
+        algorithms = [name for name in algorithm_names() if "greedy" in name]
+    if processes is None:
+        processes = min(len(algorithms), multiprocessing.cpu_count())
+    best_servings = multiprocessing.Value('l', 2 ** 31 - 1)
+    job = (possibilities, minimums, maximums, currents, engine, costs,
+           time_limit, arrays)
+    pool = multiprocessing.Pool(processes, _portfolio_init,
+                                (job, best_servings))
+    try:
+        results = pool.map(_portfolio_task, algorithms, chunksize=1)
+    finally:
+        pool.terminate()
+    table = []
+    for order, (algorithm, indices, seconds, status) in enumerate(results):
+        row = {'algorithm': algorithm, 'seconds': seconds, 'status': status,
+               'penalty': None, 'servings': None, 'best': False}
+        if indices is not None:
+            picks = [possibilities[i] for i in indices]
+            row['penalty'], row['servings'] = \
+                meal_quality(picks, minimums, maximums, currents)
+            row['picks'] = picks
+        row['order'] = order
+        table.append(row)
+    def _rank(row):
+        if row['penalty'] is None:
+            return (1, 0., 0, row['order'])
+        return (0, row['penalty'], row['servings'], row['order'])
+    table.sort(key=_rank)
+    best = None
+    if table and table[0]['penalty'] is not None:
+        table[0]['best'] = True
+        best = list(currents or []) + table[0]['picks']
+    for row in table:
+        row.pop('picks', None)
+        del row['order']
+    return best, table
+
 ## basic sanity tests
 def test_greedy():
     minimums = ('minimums', {'a':10, 'b':100, 'c':12,  'd':17, 'e':5})
@@ -467,3 +1322,20 @@ def test_goldilocks_pickonce():
                      ]
     return ackp(possibilities, minimums, maximums, 
                 algorithm="greedy_goldilocks_pickonce")
+
+def test_exact():
+    minimums = ('minimums', {'a':10, 'b':100, 'c':12,  'd':17, 'e':5})
+    maximums = ('maximums', {'a':87, 'b':145, 'c':99,  'd':82, 'e':123})
+    possibilities = [('one', {'a':1, 'b':5, 'c':2,  'd':0, 'e':4}),
+                     ('two', {'a':2, 'b':4, 'c':3,  'd':2, 'e':2}),
+                     ('three', {'a':3, 'b':3, 'c':1,  'd':2, 'e':3}),
+                     ('four', {'a':4, 'b':2, 'c':5,  'd':1, 'e':1}),
+                     ('five', {'a':5, 'b':1, 'c':14,  'd':6, 'e':5}),
+                     ('six', {'a':11, 'b':15, 'c':2,  'd':10, 'e':4}),
+                     ('seven', {'a':12, 'b':14, 'c':3,  'd':2, 'e':2}),
+                     ('eight', {'a':13, 'b':13, 'c':1,  'd':12, 'e':3}),
+                     ('nine', {'a':14, 'b':22, 'c':15,  'd':1, 'e':1}),
+                     ('ten', {'a':15, 'b':61, 'c':4,  'd':6, 'e':5}),
+                     ]
+    return ackp(possibilities, minimums, maximums,
+                algorithm="exact_servings")
@@ -0,0 +1,276 @@
+## Benchmarks
+## Author: Christopher Olsen
+## Copyright: 2013
+## License: GNU GPL v3
+##
+
+## Fixed workloads for timing the database loader, the search and the meal
+## completion algorithms, written out as JSON so runs can be compared.
+##
+## usage:
+##   python benchmarks.py                     (the USDA database, 3 repeats)
+##   python benchmarks.py --scale 1 10 100    (plus 10x and 100x databases)
+##   python benchmarks.py --output new.json --compare old.json
+##
+## The scaled databases are synthetic ones fitted to the USDA file (see
+## synthetic_foods.py), written to a work directory.
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from timeit import default_timer
+
+import numpy as np
+
+import ackpl
+import nutrient_matrix
+import perfectmeal
+import synthetic_foods
+
+SEARCHES = [('search_1_term', 'chicken'),
+            ('search_2_terms', 'chicken breast'),
+            ('search_3_terms', 'chicken breast roasted')]
+
+MEAL_SIZES = [10, 100]
+
+SELECTIONS = [('all', perfectmeal.the_groups),
+              ('produce', ['Vegetables and Vegetable Products',
+                           'Fruits and Fruit Juices']),
+              ('meat', ['Beef Products', 'Poultry Products', 'Pork Products',
+                        'Finfish and Shellfish Products'])]
+
+GROUPINGS = ['elements', 'vitamins']
+STARTING_FOODS = 3 # foods in the meal complete_meal starts from
+EXACT_TIME_LIMIT = 5. # seconds, for the exact_ algorithms and the portfolio
+
+
+#############################################################################
+############################### databases ###################################
+#############################################################################
+
+def scale_database(json_path, factor, out_path, seed=0):
+    """ Writes a synthetic database 'factor' times the size of json_path,
+        imitating it (see synthetic_foods.py), to out_path.  Returns
+        out_path.
+        """
+    profile = synthetic_foods.FoodProfile.from_file(json_path)
+    return synthetic_foods.write_json(
+        profile.generate(profile.size * factor, seed=seed), out_path)
+
+def use_database(json_path):
+    """ Points perfectmeal at json_path and drops everything loaded or cached
+        from the previous database.
+        """
+    perfectmeal.json_loc = json_path
+    perfectmeal._database = None
+    perfectmeal.food_cache.clear()
+    perfectmeal.candidate_cache.clear()
+
+def remove_store(json_path):
+    store_path = nutrient_matrix.store_path_for(json_path)
+    if os.path.exists(store_path):
+        shutil.rmtree(store_path)
+
+def sample_names(count):
+    """ count food names spread evenly over the database """
+    names = perfectmeal.get_database().matrix.names
+    step = max(len(names) // count, 1)
+    return [names[i] for i in xrange(0, len(names), step)][:count]
+
+
+#############################################################################
+############################### measuring ###################################
+#############################################################################
+
+def measure(name, func, repeat, setup=None):
+    """ Times func() 'repeat' times (setup() runs untimed before each call).
+        Returns a result dictionary, 'result' is func's last return value.
+        """
+    times = []
+    result = None
+    for i in xrange(repeat):
+        if setup is not None:
+            setup()
+        start = default_timer()
+        result = func()
+        times.append(default_timer() - start)
+    return {'name': name, 'repeat': repeat, 'times': times,
+            'min': min(times), 'median': float(np.median(times)),
+            'mean': float(np.mean(times)), 'result': result}
+
+def _meal_summary(meal):
+    if meal is None:
+        return None
+    return {'servings': len(meal.foods), 'foods': len(meal.servings())}
+
+def run_loading(json_path, repeat):
+    def _load():
+        return len(perfectmeal.get_database().matrix)
+    def _cold():
+        use_database(json_path)
+        remove_store(json_path)
+    def _index():
+        return len(perfectmeal.get_database().get_search_index().vocabulary)
+    def _drop_index():
+        perfectmeal.get_database()._search_index = None
+    results = [measure('load_cold', _load, repeat, _cold),
+               measure('load_warm', _load, repeat,
+                       lambda: use_database(json_path)),
+               measure('search_index', _index, repeat, _drop_index)]
+    _load() # leave a loaded database (and index) for the next workloads
+    _index()
+    return results
+
+def run_searches(repeat):
+    results = []
+    for name, search in SEARCHES:
+        func = lambda: len(perfectmeal.search_like(search,
+                                                   perfectmeal.the_groups))
+        results.append(measure(name, func, repeat))
+    return results
+
+def run_meals(repeat):
+    results = []
+    for size in MEAL_SIZES:
+        names = sample_names(size)
+        func = lambda: _meal_summary(perfectmeal.get_meal(names))
+        results.append(measure('get_meal_%d' % size, func, repeat))
+    return results
+
+def run_completions(repeat, algorithms, time_limit=EXACT_TIME_LIMIT):
+    results = []
+    min_meal, max_meal = perfectmeal.get_benchmarks(GROUPINGS)
+    start = sample_names(STARTING_FOODS)
+    for selection, food_groups in SELECTIONS:
+        for algorithm in algorithms:
+            def _complete():
+                meal = perfectmeal.get_meal(start, GROUPINGS)
+                return _meal_summary(perfectmeal.complete_meal(
+                    meal, min_meal, max_meal, algorithm, food_groups,
+                    time_limit=time_limit, cache=False))
+            name = 'complete_meal_%s_%s' % (algorithm, selection)
+            results.append(measure(name, _complete, repeat))
+    return results
+
+def run(json_path, scales=(1,), repeat=3, algorithms=None, work_dir=None,
+        time_limit=EXACT_TIME_LIMIT, log=None):
+    """ Runs every workload against json_path and its scaled copies.
+        Returns the report dictionary that main() writes out.
+        """
+    if algorithms is None:
+        algorithms = ackpl.algorithm_names()
+    made_work_dir = work_dir is None
+    if made_work_dir:
+        work_dir = tempfile.mkdtemp(prefix='perfectmeal-bench-')
+    report = {'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'python': platform.python_version(),
+                       'numpy': np.__version__,
+                       'platform': platform.platform(),
+                       'source': os.path.basename(json_path),
+                       'repeat': repeat},
+              'results': []}
+    try:
+        for scale in scales:
+            if scale == 1:
+                path = json_path
+            else:
+                path = os.path.join(work_dir, 'foods-x%d.json' % scale)
+                if not os.path.exists(path):
+                    scale_database(json_path, scale, path)
+            results = run_loading(path, repeat)
+            results += run_searches(repeat)
+            results += run_meals(repeat)
+            results += run_completions(repeat, algorithms, time_limit)
+            db = perfectmeal.get_database()
+            for result in results:
+                result['scale'] = scale
+                result['rows'] = len(db.matrix)
+                result['checksum'] = db.checksum
+                if log is not None:
+                    log(result)
+            report['results'] += results
+    finally:
+        use_database(json_path)
+        if made_work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return report
+
+
+#############################################################################
+############################### comparing ###################################
+#############################################################################
+
+def compare(old_report, new_report, threshold=1.25):
+    """ Matches the results of two reports by (name, scale).  Returns a list
+        of (name, scale, old median, new median, ratio, regressed) where
+        regressed means the new median is over threshold times the old one.
+        """
+    old = dict(((r['name'], r['scale']), r) for r in old_report['results'])
+    rows = []
+    for result in new_report['results']:
+        key = (result['name'], result['scale'])
+        if key not in old:
+            continue
+        before, after = old[key]['median'], result['median']
+        ratio = after / before if before > 0 else float('inf')
+        rows.append((key[0], key[1], before, after, ratio,
+                     ratio > threshold))
+    return rows
+
+def _print_result(result):
+    print '%-48s x%-4d %10.4fs %10.4fs  %s' % (
+        result['name'], result['scale'], result['min'], result['median'],
+        json.dumps(result['result']))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Perfect Meal benchmarks")
+    parser.add_argument('--json', default=perfectmeal.json_loc,
+                        help="the food database (default: the USDA file)")
+    parser.add_argument('--scale', type=int, nargs='+', default=[1],
+                        help="database sizes, as multiples of --json")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--algorithms', nargs='+', default=None,
+                        help="complete_meal algorithms (default: all)")
+    parser.add_argument('--time-limit', type=float, default=EXACT_TIME_LIMIT,
+                        help="seconds for the exact_ algorithms")
+    parser.add_argument('--work-dir', default=None,
+                        help="keep the scaled databases here between runs")
+    parser.add_argument('--output', default='benchmarks.json')
+    parser.add_argument('--compare', default=None, metavar='OLD_OUTPUT',
+                        help="report medians against an earlier run")
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help="slowdown ratio counted as a regression")
+    args = parser.parse_args(argv)
+
+    print '%-48s %-5s %11s %11s  result' % ('workload', 'scale', 'min',
+                                            'median')
+    report = run(args.json, args.scale, args.repeat, args.algorithms,
+                 args.work_dir, args.time_limit, log=_print_result)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    print 'wrote', args.output
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            old_report = json.load(f)
+        regressions = 0
+        print
+        print '%-48s %-5s %11s %11s %7s' % ('workload', 'scale', 'old',
+                                            'new', 'ratio')
+        for name, scale, before, after, ratio, regressed in \
+                compare(old_report, report, args.threshold):
+            print '%-48s x%-4d %10.4fs %10.4fs %7.2f%s' % (
+                name, scale, before, after, ratio,
+                '  REGRESSION' if regressed else '')
+            regressions += regressed
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,233 @@
+## Caching
+## Author: Christopher Olsen
+## Copyright: 2013
+## License: GNU GPL v3
+##
+
+## A small thread-safe LRU cache with hit/miss counters, shared by the parts
+## of the program that memoize expensive conversions, and a size-limited
+## on-disk tier for results worth keeping between runs.
+
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    def __init__(self, maxsize=1024):
+        """ Holds at most 'maxsize' entries, the least recently used entry is
+            evicted first.
+            """
+        assert maxsize > 0
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """ Returns the value for key (marking it as recently used), or
+            default if it isn't cached.
+            """
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            if key in self._data:
+                del self._data[key]
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """ Returns a dictionary of hits, misses, evictions, size and
+            maxsize.
+            """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'size': len(self._data),
+                    'maxsize': self.maxsize}
+
+
+class DiskCache(object):
+    def __init__(self, path, max_bytes=64 << 20):
+        """ Keeps JSON values in files under 'path', one per key (keys are
+            hex strings).  Once the files pass max_bytes the least recently
+            used ones are deleted.  Several processes can share a directory,
+            files are replaced atomically and a missing or broken file is
+            just a miss.
+            """
+        assert max_bytes > 0
+        self.path = path
+        self.max_bytes = max_bytes
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._lock = threading.Lock()
+        self._bytes = sum(size for mtime, size, name in self._files())
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.json')
+
+    def _files(self):
+        # (modification time, size, path) of every cached file
+        files = []
+        for name in os.listdir(self.path):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue # deleted by another process
+            files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def get(self, key, default=None):
+        """ Returns the value for key (marking it as recently used), or
+            default if it isn't cached.
+            """
+        path = self._file(key)
+        try:
+            with open(path, 'r') as f:
+                value = json.load(f)
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return default
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """ Stores value, a failed write (full disk...) is skipped """
+        data = json.dumps(value)
+        path = self._file(key)
+        temp_path = None
+        try:
+            handle, temp_path = tempfile.mkstemp(suffix='.tmp',
+                                                 dir=self.path)
+            with os.fdopen(handle, 'w') as f:
+                f.write(data)
+            try:
+                replaced = os.path.getsize(path)
+            except OSError:
+                replaced = 0
+            if os.name == 'nt' and replaced:
+                os.remove(path) # rename doesn't replace files on Windows
+            os.rename(temp_path, path)
+        except (IOError, OSError):
+            if temp_path is not None:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+            return
+        with self._lock:
+            self._bytes += len(data) - replaced
+            if self._bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # deletes the oldest files until the rest fill 90% of max_bytes (so
+        # the next few puts don't rescan), the directory is rescanned since
+        # other processes write to it too
+        files = sorted(self._files())
+        self._bytes = sum(size for mtime, size, path in files)
+        target = self.max_bytes * 9 // 10
+        for mtime, size, path in files:
+            if self._bytes <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._bytes -= size
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self._files())
+
+    def clear(self):
+        with self._lock:
+            for mtime, size, path in self._files():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._bytes = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """ Returns a dictionary of hits, misses, evictions, bytes and
+            max_bytes.
+            """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'bytes': self._bytes,
+                    'max_bytes': self.max_bytes}
+
+
+_missing = object()
+
+class TieredCache(object):
+    def __init__(self, memory, disk=None):
+        """ An LRUCache in front of an optional DiskCache.  Values found on
+            disk are copied into memory, new values go into both.
+            """
+        self.memory = memory
+        self.disk = disk
+
+    def get(self, key, default=None):
+        value = self.memory.get(key, _missing)
+        if value is _missing and self.disk is not None:
+            value = self.disk.get(key, _missing)
+            if value is not _missing:
+                self.memory.put(key, value)
+        if value is _missing:
+            return default
+        return value
+
+    def put(self, key, value):
+        self.memory.put(key, value)
+        if self.disk is not None:
+            self.disk.put(key, value)
+
+    def clear(self):
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def stats(self):
+        """ {'memory': the LRUCache's stats, 'disk': the DiskCache's or
+            None}
+            """
+        return {'memory': self.memory.stats(),
+                'disk': self.disk.stats() if self.disk is not None else None}
@@ -0,0 +1,137 @@
+## Instrumentation
+## Author: Christopher Olsen
+## Copyright: 2013
+## License: GNU GPL v3
+##
+
+## Call counters and cumulative timers for the hot paths of perfectmeal and
+## ackpl, switched on with the PERFECTMEAL_PROFILE environment variable:
+##
+##   PERFECTMEAL_PROFILE=json     counters and timers are written to
+##                                perfectmeal-profile.json at exit
+##   PERFECTMEAL_PROFILE=pstats   the same, plus a cProfile of the main
+##                                thread written to perfectmeal-profile.prof
+##                                (read it with the pstats module)
+##
+## PERFECTMEAL_PROFILE_PATH changes the output name (without the extension).
+##
+## When it's off, timed() hands back the undecorated function and timer()
+## and count() do nothing, so the hooks cost (next to) nothing.  Each
+## process keeps its own numbers, worker processes aren't included.
+
+import atexit
+import functools
+import json
+import os
+import threading
+from timeit import default_timer
+
+MODES = ('json', 'pstats')
+
+MODE = os.environ.get('PERFECTMEAL_PROFILE', '').strip().lower()
+if MODE in ('1', 'true', 'yes', 'on'):
+    MODE = 'json'
+ENABLED = MODE in MODES
+OUTPUT_PATH = os.environ.get('PERFECTMEAL_PROFILE_PATH',
+                             'perfectmeal-profile')
+
+_timers = {} # name -> [calls, seconds]
+_counters = {} # name -> count
+_lock = threading.Lock()
+_profiler = None
+
+
+def _record(name, seconds):
+    with _lock:
+        entry = _timers.get(name)
+        if entry is None:
+            entry = _timers[name] = [0, 0.]
+        entry[0] += 1
+        entry[1] += seconds
+
+def timed(name=None):
+    """ Decorator that counts the calls of a function and the time spent in
+        them under 'name' (module.function by default).  Returns the function
+        untouched when instrumentation is off.
+        """
+    def _decorate(func):
+        if not ENABLED:
+            return func
+        label = name or '%s.%s' % (func.__module__, func.__name__)
+        @functools.wraps(func)
+        def _timed(*args, **kwargs):
+            start = default_timer()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _record(label, default_timer() - start)
+        return _timed
+    return _decorate
+
+class _Timer(object):
+    def __init__(self, name):
+        self.name = name
+    def __enter__(self):
+        self.start = default_timer()
+        return self
+    def __exit__(self, *exc_info):
+        _record(self.name, default_timer() - self.start)
+        return False
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc_info):
+        return False
+
+_null_timer = _NullTimer()
+
+def timer(name):
+    """ Context manager timing a block under 'name' """
+    if not ENABLED:
+        return _null_timer
+    return _Timer(name)
+
+def count(name, n=1):
+    """ Adds n to the counter 'name' """
+    if not ENABLED:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+def report():
+    """ Returns {'timers': {name: {'calls', 'seconds'}}, 'counters': {name:
+        count}}
+        """
+    with _lock:
+        return {'timers': dict((name, {'calls': calls, 'seconds': seconds})
+                               for name, (calls, seconds)
+                               in _timers.items()),
+                'counters': dict(_counters)}
+
+def reset():
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+
+def dump(path=None):
+    """ Writes the report (and the cProfile stats in pstats mode) next to
+        path, OUTPUT_PATH by default.  Returns the paths written.
+        """
+    if path is None:
+        path = OUTPUT_PATH
+    written = [path + '.json']
+    with open(written[0], 'w') as f:
+        json.dump(report(), f, indent=1, sort_keys=True)
+    if _profiler is not None:
+        _profiler.disable()
+        _profiler.dump_stats(path + '.prof')
+        written.append(path + '.prof')
+    return written
+
+if ENABLED:
+    if MODE == 'pstats':
+        import cProfile
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+    atexit.register(dump)
@@ -0,0 +1,334 @@
+## Exact Meal Completion (mixed integer programming)
+## Author: Christopher Olsen
+## Copyright: 2013
+## License: GNU GPL v3
+##
+
+## An exact alternative to ackpl's greedy searches.  The number of servings
+## of each possibility is an integer variable, the minimums and maximums are
+## hard constraints, and a depth-first branch-and-bound search finds the
+## meal that is best for the chosen objective.  Every node of the search is
+## bounded by its LP relaxation, solved with the small dense simplex below.
+##
+## Everything works on the arrays from ackpl.to_arrays (NaN standing in for
+## None).  A missing value counts as 0 servings-wise, but a nutrient that
+## no possibility and no current food has any data for is left
+## unconstrained, the same way the greedy searches let None win by default.
+
+import math
+import time
+
+import numpy as np
+
+TOLERANCE = 1e-9 # pivoting tolerance
+FEASIBILITY_TOLERANCE = 1e-7
+INTEGER_TOLERANCE = 1e-6
+DEFAULT_TIME_LIMIT = 10. # seconds
+PROGRESS_INTERVAL = .1 # seconds between progress reports
+BALANCE_SERVING_WEIGHT = 1e-3 # keeps the balance objective from growing meals
+
+
+## Linear programming
+def _pivot(tableau, row, col):
+    tableau[row] /= tableau[row, col]
+    column = tableau[:, col].copy()
+    column[row] = 0.
+    tableau -= np.outer(column, tableau[row])
+
+def _run_simplex(tableau, basis, cost, max_iterations):
+    # minimizes cost.x over a tableau already in canonical form for 'basis'
+    degenerate = 0
+    for iteration in xrange(max_iterations):
+        reduced = cost - cost[basis].dot(tableau[:, :-1])
+        entering = np.flatnonzero(reduced < -TOLERANCE)
+        if len(entering) == 0:
+            return 'optimal'
+        if degenerate > 50:
+            col = entering[0] # Bland's rule, can't cycle
+        else:
+            col = entering[np.argmin(reduced[entering])]
+        column = tableau[:, col]
+        rows = np.flatnonzero(column > TOLERANCE)
+        if len(rows) == 0:
+            return 'unbounded'
+        ratios = tableau[rows, -1] / column[rows]
+        best = ratios.min()
+        ties = rows[ratios <= best + TOLERANCE]
+        row = ties[np.argmin(basis[ties])]
+        if best <= TOLERANCE:
+            degenerate += 1
+        else:
+            degenerate = 0
+        _pivot(tableau, row, col)
+        basis[row] = col
+    return 'iterations'
+
+def linprog(cost, A, b, max_iterations=20000):
+    """ Minimizes cost.x subject to A.x <= b and x >= 0 with a two-phase
+        dense simplex.
+        Returns (status, x, value), status is one of 'optimal', 'infeasible',
+        'unbounded' or 'iterations' (x and value are None unless optimal)
+        """
+    cost = np.asarray(cost, dtype=float)
+    A = np.asarray(A, dtype=float)
+    b = np.asarray(b, dtype=float)
+    m, n = A.shape
+    negative = np.flatnonzero(b < 0)
+    k = len(negative)
+    # columns: the variables, one slack per row, one artificial per row with
+    # a negative right hand side, then the right hand side
+    tableau = np.zeros((m, n + m + k + 1))
+    tableau[:, :n] = A
+    tableau[np.arange(m), n + np.arange(m)] = 1.
+    tableau[:, -1] = b
+    tableau[negative] *= -1.
+    tableau[negative, n + m + np.arange(k)] = 1.
+    basis = n + np.arange(m)
+    basis[negative] = n + m + np.arange(k)
+
+    if k:
+        phase_one = np.zeros(n + m + k)
+        phase_one[n + m:] = 1.
+        status = _run_simplex(tableau, basis, phase_one, max_iterations)
+        if status != 'optimal':
+            return status, None, None
+        if phase_one[basis].dot(tableau[:, -1]) > FEASIBILITY_TOLERANCE:
+            return 'infeasible', None, None
+        # pivot the (zero valued) artificials out of the basis, rows where
+        # that's impossible are redundant
+        for row in np.flatnonzero(basis >= n + m):
+            nonzero = np.flatnonzero(np.abs(tableau[row, :n + m]) > TOLERANCE)
+            if len(nonzero):
+                _pivot(tableau, row, nonzero[0])
+                basis[row] = nonzero[0]
+        keep = basis < n + m
+        tableau = np.delete(tableau[keep], np.s_[n + m:n + m + k], axis=1)
+        basis = basis[keep]
+
+    phase_two = np.zeros(n + m)
+    phase_two[:n] = cost
+    status = _run_simplex(tableau, basis, phase_two, max_iterations)
+    if status != 'optimal':
+        return status, None, None
+    solution = np.zeros(n + m)
+    solution[basis] = tableau[:, -1]
+    x = solution[:n]
+    return 'optimal', x, cost.dot(x)
+
+
+## The model
+class Problem(object):
+    def __init__(self, matrix, mins, maxs=None, total=None, costs=None,
+                 has_data=None):
+        """ matrix: (possibilities x nutrients) array, NaN for no data
+            mins, maxs: nutrient vectors (maxs may be None)
+            total: the current foods' total, None for an empty meal
+            costs: optional per-possibility cost (serving size in grams for
+                   the "mass" objective)
+            has_data: optional boolean vector of the nutrients some
+                      possibility has data for, when matrix is what's left
+                      of a larger one (by default it's read from matrix)
+
+            Builds the hard constraints as rows of A.x <= b over the
+            servings x, scaled so each benchmark is 1.
+            """
+        self.n = matrix.shape[0]
+        self.values = np.where(np.isnan(matrix), 0., matrix).T
+        if total is None:
+            total = np.zeros(matrix.shape[1])
+        if has_data is None:
+            has_data = ~np.isnan(matrix).all(axis=0)
+        has_data = has_data | ~np.isnan(total)
+        self.current = np.where(np.isnan(total), 0., total)
+        self.mins = mins
+        self.costs = costs
+        self.feasible = True
+
+        rows, rhs = [], []
+        with np.errstate(invalid='ignore'):
+            self.min_keys = np.flatnonzero(has_data & (mins > 0))
+        short = self.min_keys[self.current[self.min_keys] <
+                              mins[self.min_keys]]
+        rows.append(-self.values[short] / mins[short, None])
+        rhs.append(self.current[short] / mins[short] - 1.)
+        if maxs is not None:
+            with np.errstate(invalid='ignore'):
+                max_keys = np.flatnonzero(has_data & (maxs >= 0))
+            if np.any(self.current[max_keys] > maxs[max_keys]):
+                self.feasible = False # already over a maximum
+            scale = np.where(maxs[max_keys] > 0, maxs[max_keys], 1.)
+            rows.append(self.values[max_keys] / scale[:, None])
+            rhs.append((maxs[max_keys] - self.current[max_keys]) / scale)
+        self.A = np.vstack(rows)
+        self.b = np.concatenate(rhs)
+
+    def satisfies(self, servings):
+        """ True if integer servings meet every constraint """
+        return np.all(self.A.dot(servings) <= self.b + FEASIBILITY_TOLERANCE)
+
+
+## Objectives
+## An objective turns a Problem into a linear program over the servings
+## plus any auxiliary variables it needs: build() returns the cost vector
+## (servings first) and extra constraint rows and right hand sides (None if
+## there are none), value() scores a finished integer solution.
+class ServingsObjective(object):
+    """ Fewest servings """
+    integral = True # the objective of an integer solution is an integer
+    def build(self, problem):
+        return np.ones(problem.n), None, None
+    def value(self, problem, servings):
+        return float(servings.sum())
+
+class MassObjective(object):
+    """ Least total mass (problem.costs are the serving sizes) """
+    integral = False
+    def build(self, problem):
+        if problem.costs is None:
+            raise ValueError("the mass objective needs serving sizes (costs)")
+        return np.asarray(problem.costs, dtype=float), None, None
+    def value(self, problem, servings):
+        return float(np.dot(problem.costs, servings))
+
+class BalanceObjective(object):
+    """ Smallest spread between the most and least satisfied nutrients, as
+        fractions of their minimums.  This is the linear stand-in for
+        balance_indx: the spread (high - low) is minimized with high above
+        and low below every ratio.
+        """
+    integral = False
+    def _ratios(self, problem):
+        keys = problem.min_keys
+        mins = problem.mins[keys]
+        return problem.values[keys] / mins[:, None], \
+               problem.current[keys] / mins
+    def build(self, problem):
+        ratios, base = self._ratios(problem)
+        n, k = problem.n, len(base)
+        if k == 0:
+            return ServingsObjective().build(problem)
+        cost = np.empty(n + 2)
+        cost[:n] = BALANCE_SERVING_WEIGHT
+        cost[n], cost[n + 1] = 1., -1. # high, low
+        rows = np.zeros((2 * k, n + 2))
+        rows[:k, :n] = ratios
+        rows[:k, n] = -1.
+        rows[k:, :n] = -ratios
+        rows[k:, n + 1] = 1.
+        return cost, rows, np.concatenate([-base, base])
+    def value(self, problem, servings):
+        ratios, base = self._ratios(problem)
+        if len(base) == 0:
+            return float(servings.sum())
+        totals = base + ratios.dot(servings)
+        return float(totals.max() - totals.min() +
+                     BALANCE_SERVING_WEIGHT * servings.sum())
+
+OBJECTIVES = {'servings': ServingsObjective(),
+              'mass': MassObjective(),
+              'balance': BalanceObjective()}
+
+
+## Branch and bound
+def _solve_node(A, b, cost, lower, upper):
+    # the LP relaxation with lower <= x <= upper, lower bounds are shifted
+    # out and finite upper bounds become rows
+    shifted = b - A.dot(lower)
+    bounded = np.flatnonzero(np.isfinite(upper))
+    if len(bounded):
+        bound_rows = np.zeros((len(bounded), A.shape[1]))
+        bound_rows[np.arange(len(bounded)), bounded] = 1.
+        A = np.vstack([A, bound_rows])
+        shifted = np.concatenate([shifted, upper[bounded] - lower[bounded]])
+    status, x, value = linprog(cost, A, shifted)
+    if status != 'optimal':
+        return None, None
+    return lower + x, value + cost.dot(lower)
+
+def branch_and_bound(matrix, mins, maxs=None, total=None,
+                     objective='servings', costs=None, time_limit=None,
+                     progress=None, has_data=None):
+    """ Finds integer servings of each row of matrix that bring total up to
+        mins without passing maxs, best for 'objective' (a name in
+        OBJECTIVES or an object with the same methods).
+
+        Stops at time_limit seconds (DEFAULT_TIME_LIMIT if None) or when
+        progress(nodes, value) returns False, keeping the best solution
+        found so far.  progress is called at most every PROGRESS_INTERVAL
+        seconds, value is the best solution's value or, before there is
+        one, the bound of the node just solved.
+
+        has_data: see Problem.
+
+        Returns (servings, value, optimal): servings is an integer array
+        (None if no solution was found), optimal is True if the search
+        finished.
+        """
+    if isinstance(objective, basestring):
+        objective = OBJECTIVES[objective]
+    if time_limit is None:
+        time_limit = DEFAULT_TIME_LIMIT
+    deadline = time.time() + time_limit
+    problem = Problem(matrix, mins, maxs, total, costs, has_data)
+    if not problem.feasible:
+        return None, None, True
+    n = problem.n
+    cost, extra_rows, extra_rhs = objective.build(problem)
+    width = len(cost)
+    A = np.zeros((len(problem.b), width))
+    A[:, :n] = problem.A
+    b = problem.b
+    if extra_rows is not None:
+        A = np.vstack([A, extra_rows])
+        b = np.concatenate([b, extra_rhs])
+
+    best, best_value = None, np.inf
+    nodes = 0
+    reported = None
+    stack = [(np.zeros(width), np.repeat(np.inf, width))]
+    while stack:
+        if time.time() > deadline:
+            return best, best_value if best is not None else None, False
+        lower, upper = stack.pop()
+        nodes += 1
+        x, bound = _solve_node(A, b, cost, lower, upper)
+        if x is None:
+            continue # infeasible branch
+        if progress is not None:
+            now = time.time()
+            if reported is None or now - reported >= PROGRESS_INTERVAL:
+                reported = now
+                if progress(nodes, best_value if best is not None
+                                   else bound) is False:
+                    return best, best_value if best is not None else None, \
+                           False
+        if objective.integral:
+            bound = math.ceil(bound - INTEGER_TOLERANCE)
+        if bound >= best_value - FEASIBILITY_TOLERANCE:
+            continue # can't beat the incumbent
+        servings = x[:n]
+        # rounding up keeps every minimum, it's a solution if it also keeps
+        # every maximum
+        rounded = np.ceil(servings - INTEGER_TOLERANCE)
+        if problem.satisfies(rounded):
+            value = objective.value(problem, rounded)
+            if value < best_value - FEASIBILITY_TOLERANCE:
+                best, best_value = rounded.astype(int), value
+        fraction = np.abs(servings - np.round(servings))
+        branch = np.argmax(fraction)
+        if fraction[branch] <= INTEGER_TOLERANCE:
+            continue # integral, the rounding above already recorded it
+        down_upper = upper.copy()
+        down_upper[branch] = math.floor(servings[branch])
+        up_lower = lower.copy()
+        up_lower[branch] = math.ceil(servings[branch])
+        down = (lower, down_upper)
+        up = (up_lower, upper)
+        # explore the nearer side first
+        if servings[branch] - math.floor(servings[branch]) < .5:
+            stack.extend([up, down])
+        else:
+            stack.extend([down, up])
+    if best is None:
+        return None, None, True
+    return best, best_value, True
@@ -0,0 +1,598 @@
+## Nutrient Matrix
+## Author: Christopher Olsen
+## Copyright: 2013
+## License: GNU GPL v3
+##
+
+## The database-wide nutrient layout.  Every nutrient the program knows about
+## gets one fixed column, and every food in the database gets one row of a
+## dense float matrix (NaN where the USDA data has no value).  Food and Meal
+## objects in perfectmeal.py are thin views over these vectors instead of
+## carrying their own nested dictionaries.
+
+import numpy as np
+import hashlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+ALL_GROUPINGS = ['elements', 'vitamins', 'energy', 'sugars', 'amino_acids',
+                 'other', 'composition']
+
+## the fields of each nutritional grouping, in display order
+FIELDS = {
+    'elements': ['Sodium, Na', 'Phosphorus, P', 'Manganese, Mn', 'Iron, Fe',
+                 'Potassium, K', 'Fluoride, F', 'Selenium, Se',
+                 'Magnesium, Mg', 'Zinc, Zn', 'Copper, Cu', 'Calcium, Ca'],
+    'vitamins': ['Niacin', 'Menaquinone-4', 'Thiamin', 'Folate, food',
+                 'Vitamin B-6', 'Tocopherol, gamma', 'Carotene, beta',
+                 'Pantothenic acid', 'Vitamin E, added', 'Tocopherol, beta',
+                 'Vitamin C, total ascorbic acid', 'Tocopherol, delta',
+                 'Cryptoxanthin, beta', 'Vitamin D3 (cholecalciferol)',
+                 'Lycopene', 'Vitamin B-12, added', 'Vitamin A, IU',
+                 'Retinol', 'Vitamin A, RAE', 'Dihydrophylloquinone',
+                 'Vitamin E (alpha-tocopherol)', 'Lutein + zeaxanthin',
+                 'Betaine', 'Riboflavin', 'Vitamin D',
+                 'Vitamin D2 (ergocalciferol)', 'Carotene, alpha',
+                 'Folic acid', 'Folate, total', 'Vitamin B-12',
+                 'Choline, total', 'Vitamin K (phylloquinone)',
+                 'Vitamin D (D2 + D3)', 'Folate, DFE'],
+    'energy': ['Energy'],
+    'sugars': ['Galactose', 'Starch', 'Lactose', 'Sucrose', 'Maltose',
+               'Fructose', 'Glucose (dextrose)'],
+    'amino_acids': ['Lysine', 'Alanine', 'Glycine', 'Proline', 'Serine',
+                    'Arginine', 'Glutamic acid', 'Phenylalanine', 'Leucine',
+                    'Methionine', 'Histidine', 'Valine', 'Tryptophan',
+                    'Isoleucine', 'Threonine', 'Aspartic acid', 'Cystine',
+                    'Tyrosine', 'Hydroxyproline'],
+    'other': ['Alcohol, ethyl', 'Stigmasterol',
+              'Fatty acids, total trans-monoenoic', 'Theobromine',
+              'Caffeine', 'Fatty acids, total trans',
+              'Fatty acids, total monounsaturated', 'Beta-sitosterol',
+              'Fatty acids, total saturated',
+              'Fatty acids, total trans-polyenoic', 'Campesterol',
+              'Cholesterol', 'Ash', 'Fatty acids, total polyunsaturated',
+              'Phytosterols'],
+    'composition': ['Fiber, total dietary', 'Adjusted Protein', 'Water',
+                    'Total lipid (fat)', 'Protein',
+                    'Carbohydrate, by difference', 'Sugars, total'],
+    }
+
+## one column per (grouping, field)
+COLUMNS = [(group, field) for group in ALL_GROUPINGS
+           for field in FIELDS[group]]
+COLUMN_INDEX = dict((col, i) for i, col in enumerate(COLUMNS))
+NUM_COLUMNS = len(COLUMNS)
+
+## all values are normalized to mg
+UNIT_CONVERTER = {'g': 1000., 'mg': 1., 'mcg': (1 / 1000.)}
+
+_columns_cache = {}
+
+def columns_for(groupings):
+    """ Returns an index array of the matrix columns belonging to the given
+        nutritional groupings (in ALL_GROUPINGS order).
+        """
+    key = tuple(sorted(set(groupings)))
+    if key not in _columns_cache:
+        _columns_cache[key] = np.array([i for i, col in enumerate(COLUMNS)
+                                        if col[0] in key], dtype=np.intp)
+    return _columns_cache[key]
+
+def empty_vector():
+    """ A fresh, writable all-NaN nutrient vector. """
+    return np.full(NUM_COLUMNS, np.nan)
+
+def nan_add(first, second):
+    """ Adds two nutrient vectors where NaN means "no data".  NaN + x is x and
+        NaN + NaN stays NaN (the vector version of Meal's old None juggling)
+        """
+    return np.where(np.isnan(first), second,
+                    np.where(np.isnan(second), first, first + second))
+
+def nan_sub(first, second):
+    """ Subtracts second from first where NaN means "no data".  Differences
+        that come out at (or just under) zero are clamped to zero.
+        """
+    diff = first - second
+    with np.errstate(invalid='ignore'):
+        diff = np.where(diff > .000000001, diff, 0.)
+    return np.where(np.isnan(first), -second,
+                    np.where(np.isnan(second), first, diff))
+
+def portion(json_object):
+    """ Returns the unit and size (in grams) of the smallest serving listed
+        in a json_object, or 100g if none are listed.
+        """
+    portions = json_object['portions']
+    if len(portions) == 0:
+        return "100g", 100
+    smallest = min(portions, key=lambda k: k['grams'])
+    return smallest['unit'], smallest['grams']
+
+def _usda_grouping(group, description):
+    ## the USDA file capitalizes the group names ("Elements", "Vitamins"...)
+    ## amino acids are matched on their description alone
+    if description in FIELDS['amino_acids']:
+        return 'amino_acids'
+    group = group.lower()
+    if group in FIELDS and description in FIELDS[group]:
+        return group
+    return None
+
+## (USDA group, description, units) -> (grouping, column, scale to mg) for
+## every nutrient the program uses, None for the ones it ignores.  Built up
+## front for the group names used in the USDA file, anything else is worked
+## out the first time it's seen and remembered.
+def _build_nutrient_map():
+    table = {}
+    for grouping in ALL_GROUPINGS:
+        # "Elements", "Vitamins", ... "Amino Acids"
+        for label in set([grouping.capitalize(),
+                          grouping.replace('_', ' ').title()]):
+            for field in FIELDS[grouping]:
+                for unit, scale in UNIT_CONVERTER.items():
+                    table[(label, field, unit)] = \
+                        (grouping, COLUMN_INDEX[(grouping, field)], scale)
+    return table
+
+NUTRIENT_MAP = _build_nutrient_map()
+
+def nutrient_slot(group, description, units):
+    """ Looks a USDA nutrient up in NUTRIENT_MAP, returns (grouping, column,
+        scale) or None if the nutrient isn't used.
+        """
+    key = (group, description, units)
+    try:
+        return NUTRIENT_MAP[key]
+    except KeyError:
+        pass
+    slot = None
+    if units in UNIT_CONVERTER:
+        grouping = _usda_grouping(group, description)
+        if grouping is not None:
+            slot = (grouping, COLUMN_INDEX[(grouping, description)],
+                    UNIT_CONVERTER[units])
+    NUTRIENT_MAP[key] = slot
+    return slot
+
+def record_to_vector(json_object, serving_size, out=None):
+    """ Converts the nutrients of a json_object into a nutrient vector scaled
+        to serving_size grams.  Values not in g, mg or mcg are ignored.
+        """
+    ## ALL VALUES COMING IN FROM JSON ARE PER 100g SO THEY MUST BE SCALED
+    ## TO THE SERVING SIZE *AFTER* BEING CONVERTED TO MG!!!
+    if out is None:
+        out = empty_vector()
+    serv_size_conv_fact = serving_size / 100.
+    for nutrient in json_object['nutrients']:
+        slot = nutrient_slot(nutrient['group'], nutrient['description'],
+                             nutrient['units'])
+        if slot is not None:
+            out[slot[1]] = nutrient['value'] * slot[2] * serv_size_conv_fact
+    return out
+
+def convert_records(records):
+    """ The bulk version of record_to_vector, for a whole food group (or the
+        whole database) at once.  Returns a (records x NUM_COLUMNS) matrix of
+        per-serving values and the array of serving sizes.
+        """
+    n = len(records)
+    values = np.full((n, NUM_COLUMNS), np.nan)
+    serving_sizes = np.empty(n)
+    rows, cols, raw = [], [], []
+    for i, record in enumerate(records):
+        serving_sizes[i] = portion(record)[1]
+        for nutrient in record['nutrients']:
+            slot = nutrient_slot(nutrient['group'], nutrient['description'],
+                                 nutrient['units'])
+            if slot is not None:
+                rows.append(i)
+                cols.append(slot[1])
+                raw.append(nutrient['value'] * slot[2])
+    rows = np.array(rows, dtype=np.intp)
+    # one scaling pass for everything, per 100g -> per serving
+    values[rows, np.array(cols, dtype=np.intp)] = \
+        np.array(raw, dtype=float) * (serving_sizes[rows] / 100.)
+    return values, serving_sizes
+
+
+class NutrientGroup(object):
+    """ A dictionary-like view of one nutritional grouping of a nutrient
+        vector.  Reads give None for missing values, writes go straight into
+        the vector.
+        """
+    def __init__(self, values, group):
+        self.values = values
+        self.group = group
+
+    def _col(self, name):
+        try:
+            return COLUMN_INDEX[(self.group, name)]
+        except KeyError:
+            raise KeyError(name)
+    def __getitem__(self, name):
+        val = self.values[self._col(name)]
+        if np.isnan(val):
+            return None
+        return float(val)
+    def __setitem__(self, name, value):
+        if value is None:
+            value = np.nan
+        self.values[self._col(name)] = value
+    def __contains__(self, name):
+        return (self.group, name) in COLUMN_INDEX
+    def __iter__(self):
+        return iter(FIELDS[self.group])
+    def __len__(self):
+        return len(FIELDS[self.group])
+    def keys(self):
+        return list(FIELDS[self.group])
+    def items(self):
+        return [(name, self[name]) for name in FIELDS[self.group]]
+    def get(self, name, default=None):
+        if name in self:
+            return self[name]
+        return default
+
+
+RECORD_BATCH = 1024 # records converted at a time (see iter_json_records)
+
+class NutrientMatrix(object):
+    """ The whole food database as parallel arrays.  Row i of 'values' holds
+        the nutrients of one serving of food i, one column per entry in
+        COLUMNS, NaN where there's no data.
+        """
+    def __init__(self, values, names, groups, ids, units, serving_sizes,
+                 tags):
+        self.values = values
+        self.names = names
+        self.groups = groups
+        self.ids = ids
+        self.units = units
+        self.serving_sizes = serving_sizes
+        self.tags = tags # list of lists of strings
+        # rows are shared by every Food built from them
+        self.values.flags.writeable = False
+
+    @classmethod
+    def from_records(cls, records, batch_size=RECORD_BATCH):
+        """ Builds the matrix from an iterable of USDA json objects.  They're
+            converted batch_size at a time, so when records is a stream (see
+            iter_json_records) only the current batch is ever held as dicts.
+            """
+        blocks, sizes = [], []
+        names, groups, ids, units, tags = [], [], [], [], []
+        batch = []
+        def _convert():
+            values, serving_sizes = convert_records(batch)
+            blocks.append(values)
+            sizes.append(serving_sizes)
+            for record in batch:
+                names.append(record['description'])
+                groups.append(record['group'])
+                ids.append(record['id'])
+                units.append(portion(record)[0])
+                tags.append(list(record.get('tags', [])))
+            del batch[:]
+        for record in records:
+            batch.append(record)
+            if len(batch) >= batch_size:
+                _convert()
+        if batch or not blocks:
+            _convert()
+        values = np.concatenate(blocks)
+        del blocks[:]
+        return cls(values, names, groups, ids, units, np.concatenate(sizes),
+                   tags)
+
+    def __len__(self):
+        return len(self.names)
+
+    def rows_by_group(self):
+        """ Returns a dictionary of food group -> list of row numbers """
+        rows = {}
+        for i, group in enumerate(self.groups):
+            rows.setdefault(group, []).append(i)
+        return rows
+
+
+#############################################################################
+############################# reading JSON ##################################
+#############################################################################
+
+## json.load builds the whole file as Python objects before anything can be
+## converted, which takes several times the memory of the finished matrix.
+## Instead the list of foods is decoded one record at a time and converted
+## in batches, so the raw dicts only live until their batch is done.
+
+JSON_CHUNK = 1 << 16 # characters read at a time
+
+def iter_json_records(jsonfile, chunk_size=JSON_CHUNK):
+    """ Yields the items of the JSON list in jsonfile (a file opened in text
+        mode, e.g. with io.open) one at a time, reading chunk_size characters
+        at a time.
+        """
+    decoder = json.JSONDecoder()
+    buf, pos = u'', 0
+    started = need_comma = False
+    while True:
+        while pos < len(buf) and buf[pos] in u' \t\r\n':
+            pos += 1
+        if pos == len(buf):
+            chunk = jsonfile.read(chunk_size)
+            if not chunk:
+                raise ValueError("unexpected end of the JSON list")
+            buf, pos = chunk, 0
+            continue
+        char = buf[pos]
+        if not started:
+            if char != u'[':
+                raise ValueError("expected a JSON list")
+            started = True
+            pos += 1
+        elif char == u']':
+            return
+        elif char == u',' and need_comma:
+            need_comma = False
+            pos += 1
+        elif need_comma:
+            raise ValueError("expected ',' or ']' at %r" % buf[pos:pos + 20])
+        else:
+            try:
+                record, pos = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # most likely the record continues in the next chunk
+                chunk = jsonfile.read(chunk_size)
+                if not chunk:
+                    raise
+                buf, pos = buf[pos:] + chunk, 0
+                continue
+            need_comma = True
+            yield record
+
+def read_json_matrix(json_path):
+    """ Builds a NutrientMatrix from a USDA style JSON file, streaming it """
+    with io.open(json_path, 'r', encoding='utf-8') as jsonfile:
+        return NutrientMatrix.from_records(iter_json_records(jsonfile))
+
+
+#############################################################################
+############################## binary store #################################
+#############################################################################
+
+## Parsing the USDA JSON file takes seconds, so it is compiled once into a
+## directory of .npy arrays next to it.  Later starts memory-map the arrays,
+## which takes milliseconds and lets separate processes share the pages.
+##
+## store layout:
+##   header.json        format, checksum/size/mtime of the source JSON,
+##                      column layout, food group names
+##   values.npy         the nutrient matrix (float64, foods x COLUMNS)
+##   serving_sizes.npy  grams per serving (float64)
+##   ids.npy            USDA ids (int64)
+##   group_codes.npy    index into header['groups'] (int16)
+##   names.txt          descriptions, utf-8, one per line
+##   units.txt          serving units, utf-8, one per line
+##   tags.txt           tags, utf-8, one line per food, tab separated
+
+STORE_FORMAT = 2
+
+def store_path_for(json_path):
+    """ The store that belongs to a given JSON file """
+    return os.path.splitext(json_path)[0] + '.cache'
+
+def file_checksum(path):
+    """ sha1 of a file's contents """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def _source_info(json_path, checksum=None):
+    stat = os.stat(json_path)
+    if checksum is None:
+        checksum = file_checksum(json_path)
+    return {'checksum': checksum, 'source_size': stat.st_size,
+            'source_mtime': stat.st_mtime}
+
+def _write_lines(path, lines):
+    with open(path, 'wb') as f:
+        f.write(u'\n'.join(lines).encode('utf-8'))
+
+def _read_lines(path, count):
+    with open(path, 'rb') as f:
+        text = f.read().decode('utf-8')
+    if count == 0:
+        return []
+    lines = text.split(u'\n')
+    if len(lines) != count:
+        raise IOError("%s has %d lines instead of %d" %
+                      (path, len(lines), count))
+    return lines
+
+def save_store(matrix, store_path, source_info):
+    """ Writes a NutrientMatrix to store_path.  The store is written to a
+        temporary directory of its own first and then moved into place, so
+        several processes compiling the same JSON file at once don't clash.
+        If another one moves its store into place first, that store is kept.
+        An old store is moved aside before the new one goes in and only
+        removed after, so a reader never finds a half deleted store.
+        """
+    group_names = sorted(set(matrix.groups))
+    group_index = dict((g, i) for i, g in enumerate(group_names))
+    tmp_path = tempfile.mkdtemp(prefix=os.path.basename(store_path) + '.',
+                                suffix='.tmp',
+                                dir=os.path.dirname(os.path.abspath(
+                                    store_path)))
+    old_path = tmp_path[:-len('.tmp')] + '.old'
+    try:
+        os.chmod(tmp_path, 0o755) # mkdtemp makes it private
+        np.save(os.path.join(tmp_path, 'values.npy'),
+                np.asarray(matrix.values))
+        np.save(os.path.join(tmp_path, 'serving_sizes.npy'),
+                np.asarray(matrix.serving_sizes, dtype=np.float64))
+        np.save(os.path.join(tmp_path, 'ids.npy'),
+                np.asarray(matrix.ids, dtype=np.int64))
+        np.save(os.path.join(tmp_path, 'group_codes.npy'),
+                np.array([group_index[g] for g in matrix.groups],
+                         dtype=np.int16))
+        _write_lines(os.path.join(tmp_path, 'names.txt'), matrix.names)
+        _write_lines(os.path.join(tmp_path, 'units.txt'), matrix.units)
+        _write_lines(os.path.join(tmp_path, 'tags.txt'),
+                     [u'\t'.join(tags) for tags in matrix.tags])
+        header = {'format': STORE_FORMAT, 'rows': len(matrix),
+                  'columns': COLUMNS, 'groups': group_names}
+        header.update(source_info)
+        with open(os.path.join(tmp_path, 'header.json'), 'w') as f:
+            json.dump(header, f)
+        if os.path.exists(store_path):
+            ## an out of date store, a racing process may move it first
+            try:
+                os.rename(store_path, old_path)
+            except OSError:
+                pass
+        try:
+            os.rename(tmp_path, store_path)
+        except OSError:
+            ## lost the race: fine if the winner stored the same source
+            current = read_store_header(store_path)
+            if current is None or \
+               current.get('checksum') != source_info['checksum']:
+                raise
+    finally:
+        for path in (tmp_path, old_path):
+            if os.path.exists(path):
+                shutil.rmtree(path, ignore_errors=True)
+
+def read_store_header(store_path):
+    """ Returns the store's header dictionary, or None if there's no usable
+        store at store_path.
+        """
+    try:
+        with open(os.path.join(store_path, 'header.json')) as f:
+            header = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if header.get('format') != STORE_FORMAT or \
+       [tuple(col) for col in header.get('columns', [])] != COLUMNS:
+        return None
+    return header
+
+def _refresh_header(store_path, header, stat):
+    # the source was touched but not changed: record its new size and mtime
+    # so the next start doesn't checksum it again.  Written to a temporary
+    # file and renamed over the old header, readers see one or the other.
+    header['source_size'] = stat.st_size
+    header['source_mtime'] = stat.st_mtime
+    handle, tmp_path = tempfile.mkstemp(prefix='header.', suffix='.tmp',
+                                        dir=store_path)
+    try:
+        with os.fdopen(handle, 'w') as f:
+            json.dump(header, f)
+        os.rename(tmp_path, os.path.join(store_path, 'header.json'))
+    except (IOError, OSError):
+        pass # a read-only store, checksummed again next time
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def store_is_current(header, json_path, store_path=None):
+    """ True if the store header matches the JSON file.  Size and mtime are
+        checked first, the checksum is only recomputed if they differ.  If
+        it still matches, the header in store_path (when given) is updated
+        with the new size and mtime.
+        """
+    if header is None:
+        return False
+    if not os.path.exists(json_path):
+        # no source to compare against, trust the store
+        return True
+    stat = os.stat(json_path)
+    if stat.st_size == header['source_size'] and \
+       stat.st_mtime == header['source_mtime']:
+        return True
+    if file_checksum(json_path) != header['checksum']:
+        return False
+    if store_path is not None:
+        _refresh_header(store_path, header, stat)
+    return True
+
+def load_store(store_path, mmap=True):
+    """ Loads a NutrientMatrix from a store, memory-mapping the arrays unless
+        mmap is False.  Returns (matrix, header).  Raises IOError if the store
+        is missing, or its files don't all have header['rows'] rows.
+        """
+    header = read_store_header(store_path)
+    if header is None:
+        raise IOError("no usable nutrient store at %s" % store_path)
+    mode = 'r' if mmap else None
+    def _load(name):
+        # asarray drops the memmap subclass but keeps sharing the pages
+        return np.asarray(np.load(os.path.join(store_path, name),
+                                  mmap_mode=mode))
+    group_names = header['groups']
+    rows = header['rows']
+    try:
+        arrays = [_load(name) for name in ('values.npy', 'group_codes.npy',
+                                           'ids.npy', 'serving_sizes.npy')]
+    except ValueError as e: # a truncated or corrupt .npy file
+        raise IOError("bad nutrient store at %s: %s" % (store_path, e))
+    if any(len(array) != rows for array in arrays):
+        raise IOError("bad nutrient store at %s: row counts don't match"
+                      % store_path)
+    values, group_codes, ids, serving_sizes = arrays
+    matrix = NutrientMatrix(
+        values,
+        _read_lines(os.path.join(store_path, 'names.txt'), rows),
+        [group_names[code] for code in group_codes],
+        ids.tolist(),
+        _read_lines(os.path.join(store_path, 'units.txt'), rows),
+        serving_sizes,
+        [line.split(u'\t') if line else []
+         for line in _read_lines(os.path.join(store_path, 'tags.txt'), rows)])
+    return matrix, header
+
+def compile_store(json_path, store_path=None):
+    """ The one-time compile step: parses the JSON file and writes its store.
+        Returns the new NutrientMatrix and the store header information.
+        """
+    if store_path is None:
+        store_path = store_path_for(json_path)
+    matrix = read_json_matrix(json_path)
+    source_info = _source_info(json_path)
+    save_store(matrix, store_path, source_info)
+    return matrix, source_info
+
+def load_or_compile(json_path, store_path=None):
+    """ Memory-maps the store for json_path, (re)compiling it first if it is
+        missing or out of date.  If the store can't be written (read-only
+        install) the matrix built from the JSON file is used directly.
+        Returns (matrix, checksum of the source JSON).
+        """
+    if store_path is None:
+        store_path = store_path_for(json_path)
+    header = read_store_header(store_path)
+    if store_is_current(header, json_path, store_path):
+        try:
+            return load_store(store_path)[0], header['checksum']
+        except (IOError, OSError):
+            pass # a damaged store, compile it again
+    matrix = read_json_matrix(json_path)
+    source_info = _source_info(json_path)
+    try:
+        save_store(matrix, store_path, source_info)
+    except (IOError, OSError):
+        return matrix, source_info['checksum']
+    return load_store(store_path)[0], source_info['checksum']
+
+
+if __name__ == '__main__':
+    ## usage: python nutrient_matrix.py foods-2011-10-03.json
+    for path in sys.argv[1:]:
+        compile_store(path)
+        print 'compiled', path, '->', store_path_for(path)
@@ -22,16 +22,17 @@
 ####	Class Structure (data types)
 ####		Food(object)
 ####		Meal(Food)
+####		(nutrient values live in nutrient_matrix.py's dense matrix)
 ####	
-####	Data and Benchmarks (data moved to nutrient_subgroups.py)
+####	Data and Benchmarks (daily values in daily_values.json)
 ####		daily_min, daily_max 
 ####		various data for the program
 ####	
 ####	JSON Considerations
 ####		Food_Group_Filter
 ####		Name_Filter
-####		open JSON file
-####		read in JSON objects (filtered and not)
+####		open JSON file (compiled once to a binary store, then mmapped)
+####		read in database rows (filtered and not)
 ####		
 ####	Making Food objects and lists of Food objects
 ####		(isolates the algorithms from JSON considerations)
@@ -48,144 +49,99 @@
 debugging = False
 
 import ackpl # the Arbitrary Constraint Knapsack Problem Library
+import nutrient_matrix # the database-wide nutrient layout
+import token_index # the search index
+import caching
+import hashlib
+import json
+import instrument # PERFECTMEAL_PROFILE counters and timers
+import numpy as np
+import itertools
+import Queue
 import threading
+from collections import OrderedDict, deque, namedtuple
 from multiprocessing.pool import ThreadPool
-import json
-import re
 import os # to find current directory (to find the json database)
 import sys # same, used if the os method fails
 
+UNDO_DEPTH = 100 # checkpoints kept by a Meal's undo history
+
 #############################################################################
 ##################### class structure (data types) ##########################
 #############################################################################
 
 class Food(object):
-    def __init__(self, nutritional_groupings, json_obj=None, name=None):
+    def __init__(self, nutritional_groupings, json_obj=None, name=None,
+                 values=None):
         """ The Food object has standard attributes for:
             -name: name of the food, optional
             -nutritional_groupings: a subset of ['elements', 'vitamins', 'energy', 'sugars',
                                      'amino_acids', 'other', 'composition']
-                       used to choose which dictionaries to initialize
-            -the seven dictionaries listed in the nutritional_groupings list
+                       used to choose which groups are active
+            -values: a nutrient vector with one slot per column of the
+                     database-wide nutrient matrix (see nutrient_matrix.py),
+                     NaN where there's no data.  Foods built from the
+                     database share their row of the matrix.
+
+            The groups listed in nutritional_groupings are available as
+            dictionary-like attributes (food.elements, food.vitamins...)
+            that read from and write to the vector.
             
-            If a json_obj is included the dictionaries will be populated with
+            If a json_obj is included the vector will be populated with
             the data (as filtered by the nutritional_groupings list)
             """
         ## For comparisons to work the nutritional_groupings list will need to
         ## be the same for all Foods being used - problematic
         self.name = name
+        self.food_id = None
         assert type(nutritional_groupings) is list
         self.nutritional_groupings = nutritional_groupings     
         for i in self.nutritional_groupings:
-            assert i in ['elements', 'vitamins', 'energy', 'sugars',
-                         'amino_acids', 'other', 'composition']
-        if 'elements' in self.nutritional_groupings:
-            self.elements = {'Sodium, Na': None, 'Phosphorus, P': None,
-                              'Manganese, Mn': None, 'Iron, Fe': None,
-                              'Potassium, K': None, 'Fluoride, F': None,
-                              'Selenium, Se': None, 'Magnesium, Mg': None,
-                              'Zinc, Zn': None, 'Copper, Cu': None,
-                              'Calcium, Ca': None}
-        if 'vitamins' in self.nutritional_groupings:
-            self.vitamins = {'Niacin': None, 'Menaquinone-4': None, 'Thiamin': None,
-                             'Folate, food': None, 'Vitamin B-6': None,
-                             'Tocopherol, gamma': None, 'Carotene, beta': None,
-                             'Pantothenic acid': None, 'Vitamin E, added': None,
-                             'Tocopherol, beta': None,
-                             'Vitamin C, total ascorbic acid': None,
-                             'Tocopherol, delta': None, 'Cryptoxanthin, beta': None,
-                             'Vitamin D3 (cholecalciferol)': None, 'Lycopene': None,
-                             'Vitamin B-12, added': None, 'Vitamin A, IU': None,
-                             'Retinol': None, 'Vitamin A, RAE': None,
-                             'Dihydrophylloquinone': None,
-                             'Vitamin E (alpha-tocopherol)': None,
-                             'Lutein + zeaxanthin': None, 'Betaine': None,
-                             'Riboflavin': None, 'Vitamin D': None,
-                             'Vitamin D2 (ergocalciferol)': None,
-                             'Carotene, alpha': None, 'Folic acid': None,
-                             'Folate, total': None, 'Vitamin B-12': None,
-                             'Choline, total': None,
-                             'Vitamin K (phylloquinone)': None,
-                             'Vitamin D (D2 + D3)': None, 'Folate, DFE': None}
-        if 'energy' in self.nutritional_groupings:
-            self.energy = {'Energy': None}
-        if 'sugars' in self.nutritional_groupings:
-            self.sugars = {'Galactose': None, 'Starch': None, 'Lactose': None,
-                           'Sucrose': None, 'Maltose': None, 'Fructose': None,
-                           'Glucose (dextrose)': None}
-        if 'amino_acids' in self.nutritional_groupings:
-            self.amino_acids = {'Lysine': None, 'Alanine': None,
-                                'Glycine': None, 'Proline': None, 'Serine': None,
-                                'Arginine': None, 'Glutamic acid': None,
-                                'Phenylalanine': None, 'Leucine': None,
-                                'Methionine': None, 'Histidine': None,
-                                'Valine': None, 'Tryptophan': None,
-                                'Isoleucine': None, 'Threonine': None,
-                                'Aspartic acid': None, 'Cystine': None,
-                                'Tyrosine': None, 'Hydroxyproline': None}
-        if 'other' in self.nutritional_groupings:
-            self.other = {'Alcohol, ethyl': None, 'Stigmasterol': None,
-                          'Fatty acids, total trans-monoenoic': None,
-                          'Theobromine': None, 'Caffeine': None,
-                          'Fatty acids, total trans': None,
-                          'Fatty acids, total monounsaturated': None,
-                          'Beta-sitosterol': None,
-                          'Fatty acids, total saturated': None,
-                          'Fatty acids, total trans-polyenoic': None,
-                          'Campesterol': None, 'Cholesterol': None, 'Ash': None,
-                          'Fatty acids, total polyunsaturated': None,
-                          'Phytosterols': None}
-        if 'composition' in self.nutritional_groupings:
-            self.composition = {'Fiber, total dietary': None,
-                                'Adjusted Protein': None, 'Water': None,
-                                'Total lipid (fat)': None, 'Protein': None,
-                                'Carbohydrate, by difference': None,
-                                'Sugars, total': None}
+            assert i in nutrient_matrix.ALL_GROUPINGS
+        if values is None:
+            values = nutrient_matrix.empty_vector()
+        self.values = values
         if json_obj is not None:
             self.populate_from_json(json_obj)
+
+    @classmethod
+    def from_row(cls, matrix, row, nutritional_groupings):
+        """ Builds a Food that views row 'row' of a NutrientMatrix. """
+        food = cls(nutritional_groupings, name=matrix.names[row],
+                   values=matrix.values[row])
+        food.food_id = int(matrix.ids[row])
+        food.unit = matrix.units[row]
+        food.serving_size = float(matrix.serving_sizes[row])
+        return food
+
+    def __getattr__(self, attr):
+        ## only called when normal lookup fails, i.e. for the group views
+        if attr in self.__dict__.get('nutritional_groupings', ()):
+            return nutrient_matrix.NutrientGroup(self.values, attr)
+        raise AttributeError(attr)
+
+    def columns(self):
+        """ Index array of this food's active columns in its vector """
+        return nutrient_matrix.columns_for(self.nutritional_groupings)
+
     def _portion_helper(self, json_object):
         """ Takes a json_object, writes the smallest serving size (in grams)
             and unit of measurement to memory.
             Returns nothing.
             """
-        portions = sorted(json_object['portions'], key=lambda k: k['grams'])
-        if len(portions) == 0:
-            self.unit = "100g"
-            self.serving_size = 100
-        else:
-            smallest = portions[0]
-            self.unit = smallest['unit']
-            self.serving_size = smallest['grams']
+        self.unit, self.serving_size = nutrient_matrix.portion(json_object)
+    @instrument.timed('perfectmeal.Food.populate_from_json')
     def populate_from_json(self, json_object):
-        ## **** THIS IS AT LIKE 40% FUNCTIONALITY ****
-        ##
-        ## ALL VALUES COMING IN FROM JSON ARE PER 100g SO THEY MUST BE SCALED
-        ## TO THE SERVING SIZE *AFTER* BEING CONVERTED TO MG!!!
         """ This takes a json_object and populates the active groups from it
             """
         assert type(json_object) is dict
         self.name = json_object['description']
+        self.food_id = json_object.get('id')
         self._portion_helper(json_object)
-        serv_size_conv_fact = self.serving_size/100. # json data is per 100g
-        converter = {'g':1000., 'mg': 1., 'mcg': (1/1000.)} # normalize to mg
-        serving_size = json_object['portions']
-        #print 'serving_size, self.serving_size', serving_size, self.serving_size
-        
-        for nutr_group in self.nutritional_groupings:
-            for nutrient in json_object['nutrients']:
-                if nutrient['group'] == nutr_group.capitalize() and\
-                   nutrient['units'] in ['g','mg', 'mcg']:
-                    new_value = nutrient['value'] * converter[nutrient['units']]* \
-                                serv_size_conv_fact
-                    self.__dict__[nutr_group][nutrient['description']] = new_value
-                else:
-                    if nutr_group == "amino_acids" and\
-                       nutrient['units'] in ['g','mg', 'mcg']:
-                        new_value = nutrient['value'] * \
-                                    converter[nutrient['units']]* \
-                                    serv_size_conv_fact
-                        self.__dict__["amino_acids"][nutrient['description']] = new_value
-                
+        record = nutrient_matrix.record_to_vector(json_object,
+                                                  self.serving_size)
+        cols = self.columns()
+        self.values[cols] = record[cols]
         ## may need a lookup table for IU to mg conversion for different
         ## vitamins and elements
         ## measurements not in g, mg or mcg are being ignored!!!
@@ -193,8 +149,8 @@ class Food(object):
     def d(self, string):
         ## d is for dictionary
         ## this gets the __dict__'s out of the algorithm layer
-        ## ** marked for deprecation or full implementation
-        return self.__dict__[string]
+        ## returns a dictionary-like view of one of the active groups
+        return getattr(self, string)
     def display(self):
         print ''
         print 'Food Name:'
@@ -205,48 +161,37 @@ class Food(object):
         print ''
     def display_value(self, name):
         for group in self.nutritional_groupings:
-            for item_name in self.__dict__[group]:
+            for item_name in self.d(group):
                 if item_name == name:
-                    print "Name:", name, " Value: ", self.__dict__[group][name]
+                    print "Name:", name, " Value: ", self.d(group)[name]
 
     def flatten(self):
         """ Flattens the active nutritional groupings into one dictionary."""
         flat = {}
         for group in self.nutritional_groupings:
-            first_dict = flat.items()
-            second_dict = self.__dict__[group].items()
-            flat = dict(first_dict + second_dict)
-            #flat = dict(flat.items() + self[group].items())
+            flat.update(self.d(group).items())
         return flat
     
     @classmethod
     def unflatten(cls, dictionary, name):
         """ Unflattens the food.  Actually creates a new Food object and populates
             its values from the provided dictionary. """
-        ## ** this needs to be cleaned up
-        keys = dictionary.keys()
-        # create the food with all nutritional groups
-        new_food = Food(['elements', 'vitamins', 'energy', 'sugars',
-                         'amino_acids', 'other', 'composition'], name=name)
-        # populate the nutritional groups
-        for group in new_food.nutritional_groupings:
-            for item_name in new_food.__dict__[group]:
-                if item_name in dictionary.keys():
-                    new_food.__dict__[group][item_name] = dictionary[item_name]
-        # remove the extra nutritional groups (not clear or efficient)
-        for group in new_food.nutritional_groupings:
-            if set(new_food.__dict__[group].keys()) <= set(dictionary.keys()):
-                # the nutritional group's keys are all in the dictionary
-                pass
-            else:
-                del new_food.__dict__[group]
+        # only the groups whose keys are all in the dictionary are kept
+        groupings = [group for group in nutrient_matrix.ALL_GROUPINGS
+                     if set(nutrient_matrix.FIELDS[group]) <= \
+                        set(dictionary.keys())]
+        new_food = Food(groupings, name=name)
+        for group in groupings:
+            view = new_food.d(group)
+            for item_name in view:
+                view[item_name] = dictionary[item_name]
         return new_food
             
     def get_val(self, group, item):
         ## hacky way to deal with the 'null' meal
         try:
-            return self.__dict__[group][item]
-        except:
+            return self.d(group)[item]
+        except (AttributeError, KeyError):
             return None
     def get_name(self):
         return self.name
@@ -268,92 +213,210 @@ class Food(object):
     def get_composition(name):
         return self.composition[name]
        
+MealSnapshot = namedtuple('MealSnapshot', ['values', 'totals', 'known',
+                                           'entries', 'sequence'])
+
 class Meal(Food):
     ## identical to the Food superclass with the addition of combination
     ## and comparison methods, and a self.foods attribute to keep a list of
     ## foods contained in the meal
     ## self.foods is optional since benchmark meals (daily min and max, etc)
     ## are also of this class
-    def __init__(self, nutritional_groupings, foods=None):
-        Food.__init__(self, nutritional_groupings)
-        self.foods = []
+    ##
+    ## Foods are kept as a multiset: each distinct food (by USDA id, or name
+    ## for foods without one) has one entry holding the Food and the sequence
+    ## numbers of its servings, so adding or removing a serving doesn't touch
+    ## the other foods.  The totals are kept as a running sum (missing values
+    ## counted as 0) and a count of the servings that had a value for each
+    ## column, a column with no values reads as None.  Preset values (a
+    ## benchmark's) count as the starting totals.
+    def __init__(self, nutritional_groupings, foods=None, values=None):
+        Food.__init__(self, nutritional_groupings, values=values)
+        if values is None:
+            self.totals = np.zeros(nutrient_matrix.NUM_COLUMNS)
+            self.known = np.zeros(nutrient_matrix.NUM_COLUMNS, dtype=np.intp)
+        else:
+            has_value = ~np.isnan(self.values)
+            self.totals = np.where(has_value, self.values, 0.)
+            self.known = has_value.astype(np.intp)
+        self._entries = OrderedDict()   # key -> [food, deque of sequences]
+        self._keys_by_name = {}         # name -> keys of the foods, in order
+        self._sequence = 0
+        self._foods = [] # the foods property, None when it needs rebuilding
+        self._undo = deque(maxlen=UNDO_DEPTH)
+        self._redo = []
         if foods is not None:
             for food in foods:
                 self.add(food)
-    def _add_helper(self, first, second):
-        # needed to deal with the default None's
-        # used by add (only)
-        if second is None:
-            if first is None:
-                return None
-            else:
-                return first
-        elif first is None:
-            return second
-        else:
-            return first + second
+
+    @property
+    def foods(self):
+        """ The servings in the order they were added.  The list is kept
+            until the meal changes, treat it as read-only.
+            """
+        if self._foods is None:
+            servings = [(sequence, entry[0])
+                        for entry in self._entries.itervalues()
+                        for sequence in entry[1]]
+            servings.sort(key=lambda serving: serving[0])
+            self._foods = [food for sequence, food in servings]
+        return self._foods
+
+    def _shared_columns(self, food):
+        # the columns active in both this meal and the food, the food's other
+        # columns count as "no data"
+        return nutrient_matrix.columns_for(
+            [g for g in self.nutritional_groupings
+             if g in food.nutritional_groupings])
+
+    @staticmethod
+    def _food_key(food):
+        if food.food_id is None:
+            return food.get_name()
+        return food.food_id
+
+    def _apply(self, food, sign):
+        # adds (sign 1) or takes away (sign -1) one serving of food from the
+        # running totals and refreshes the affected values
+        cols = self._shared_columns(food)
+        values = food.values[cols]
+        has_value = ~np.isnan(values)
+        totals = self.totals[cols] + sign * np.where(has_value, values, 0.)
+        if sign < 0:
+            ## nutrients can't go negative, what's left is rounding error
+            totals[totals <= 1e-9] = 0.
+        known = self.known[cols] + sign * has_value
+        self.totals[cols] = totals
+        self.known[cols] = known
+        self.values[cols] = np.where(known > 0, totals, np.nan)
+
+    @instrument.timed('perfectmeal.Meal.add')
     def add(self, food):
-        ## this can be looped using __dict__'s but it isn't very clear
-        ## variable name "food" is unclear, maybe change
-        self.foods.append(food) ## (!) now keeping the entire food object (!)
-        for group in self.nutritional_groupings:
-            for key in self.__dict__[group]:
-                new_val = self._add_helper(self.get_val(group,key),
-                                           food.get_val(group,key))
-                self.__dict__[group][key] = new_val
+        """ Adds a serving of food to the meal """
+        key = self._food_key(food)
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = [food, deque()]
+            self._keys_by_name.setdefault(food.get_name(), []).append(key)
+        entry[1].append(self._sequence)
+        self._sequence += 1
+        self._foods = None
+        self._apply(food, 1)
                 
     def with_(self, food):
         """ with_ is a non-mutating version of add that returns a new Meal
             object.  The underscore avoids conflicts with the "with" built-in.
             """
-        new_obj = copy.deepcopy(self)
+        new_obj = self.copy()
         new_obj.add(food)
         return new_obj
 
-    def _subtract_helper(self, first, second):
-        # needed to deal with all the default None's floating around
-        # used by _sub_diff_helper (only)
-        if first is None:
-            if second is None:
-                return None
-            else:
-                return 0 - second
-        else:
-            if second is None:
-                return first
-            else:
-                if first - second > .000000001:
-                    return first - second
-                else:
-                    return 0
     def _sub_diff_helper(self, food):
-        # used by the subtract() and difference() methods
-
-        for group in self.nutritional_groupings:
-            for key in self.__dict__[group]:
-                new_val = self._subtract_helper(self.get_val(group,key),
-                                                food.get_val(group,key))
-                self.__dict__[group][key] = new_val
+        # used by the difference() method
+        cols = self._shared_columns(food)
+        self.values[cols] = nutrient_matrix.nan_sub(self.values[cols],
+                                                    food.values[cols])
 
     def subtract(self, food_name):
         """ Subtracts a food and its nutrients from the current meal.
             Unlike "difference()" this method causes data mutatation
             """
-        assert food_name in [f.name for f in self.foods]
-        for food in self.foods:
-            if food.get_name() == food_name:
-                self._sub_diff_helper(food)
-                self.foods.remove(food)
-                break
+        assert food_name in self._keys_by_name
+        ## several foods (different ids) can share a name, the first added
+        ## is taken
+        keys = self._keys_by_name[food_name]
+        key = keys[0]
+        entry = self._entries[key]
+        entry[1].popleft()
+        self._foods = None
+        if not entry[1]:
+            del self._entries[key]
+            del keys[0]
+            if not keys:
+                del self._keys_by_name[food_name]
+        self._apply(entry[0], -1)
     
     def difference(self, food):
         """ Returns a Meal object that represents the DIFFERENCE between
             the meal (self) and another meal, which may just be a benchmark.
             """
-        diff = copy.deepcopy(self)
+        diff = self.copy()
         diff._sub_diff_helper(food)
-        diff.foods = None # because this list is meaningless now 
+        diff._entries.clear() # because the list of foods is meaningless now
+        diff._keys_by_name.clear()
+        diff._foods = []
+        ## the difference stands in for the running totals, so adding to it
+        ## carries on from its values
+        has_value = ~np.isnan(diff.values)
+        diff.totals = np.where(has_value, diff.values, 0.)
+        diff.known = has_value.astype(np.intp)
         return diff
+
+    def servings(self):
+        """ Returns a list of (food, number of servings) pairs """
+        return [(entry[0], len(entry[1]))
+                for entry in self._entries.itervalues()]
+
+    def snapshot(self):
+        """ Returns an immutable MealSnapshot of the meal's contents.  Only
+            the vectors and the serving counts are copied, the Food objects
+            are shared.
+            """
+        entries = tuple((key, entry[0], tuple(entry[1]))
+                        for key, entry in self._entries.iteritems())
+        return MealSnapshot(self.values.copy(), self.totals.copy(),
+                            self.known.copy(), entries, self._sequence)
+
+    def restore(self, snapshot):
+        """ Sets the meal's contents back to a snapshot """
+        self.values = snapshot.values.copy()
+        self.totals = snapshot.totals.copy()
+        self.known = snapshot.known.copy()
+        self._entries = OrderedDict()
+        self._keys_by_name = {}
+        self._foods = None
+        for key, food, sequences in snapshot.entries:
+            self._entries[key] = [food, deque(sequences)]
+            self._keys_by_name.setdefault(food.get_name(), []).append(key)
+        self._sequence = snapshot.sequence
+
+    def copy(self):
+        """ A new Meal with the same contents (and no undo history) """
+        new_obj = Meal(list(self.nutritional_groupings))
+        new_obj.name = self.name
+        new_obj.restore(self.snapshot())
+        return new_obj
+
+    def checkpoint(self):
+        """ Records the current contents so a later undo() returns to them.
+            Call before each change that should be undoable.
+            """
+        self._undo.append(self.snapshot())
+        del self._redo[:]
+
+    def can_undo(self):
+        return len(self._undo) > 0
+
+    def can_redo(self):
+        return len(self._redo) > 0
+
+    def undo(self):
+        """ Returns to the last checkpoint, returns False if there isn't one
+            """
+        if not self._undo:
+            return False
+        self._redo.append(self.snapshot())
+        self.restore(self._undo.pop())
+        return True
+
+    def redo(self):
+        """ Reverses the last undo(), returns False if there isn't one """
+        if not self._redo:
+            return False
+        self._undo.append(self.snapshot())
+        self.restore(self._redo.pop())
+        return True
+
     def greater_than(self, food):
         """ Compares this meal to another meal, returns True iff every nutrient
             in this meal is greater than (or wins by default against) every
@@ -366,14 +429,11 @@ class Meal(Food):
         assert type(food) in [Food, Meal]
         assert sorted(self.nutritional_groupings) == \
                sorted(food.nutritional_groupings)
-        ## --check for logic error possibilities with None's--
-        for group in self.nutritional_groupings:
-            for key in self.__dict__[group]:
-                this, that = self.get_val(group, key), food.get_val(group, key)
-                if this < that:
-                    if this is not None and that is not None:
-                        return False
-        return True
+        # comparisons against NaN are always False, so missing values win by
+        # default
+        cols = self._shared_columns(food)
+        with np.errstate(invalid='ignore'):
+            return not np.any(self.values[cols] < food.values[cols])
     
     def display_foods(self):
         if self.foods == []:
@@ -399,10 +459,10 @@ class Meal(Food):
                 for food in self.foods]
 
     def get_food_by_name(self, name):
-        for food in self.foods:
-            if food.get_name(name) == name:
-                return food
-        return False
+        keys = self._keys_by_name.get(name)
+        if keys is None:
+            return False
+        return self._entries[keys[0]][0]
 
 def display_nutrients(food, min_meal, max_meal):
     """ Displays the nutritional contents of 3 meals.
@@ -436,120 +496,127 @@ def info(name):
 #############################################################################
 ############################ nutritional benchmarks #########################
 #############################################################################
-# *see nutrient_subgroups.py
+# *see daily_values.json
+
+## The daily allowances are read from daily_values.json (next to the
+## database) the first time they're needed.  They're per day, the amino acid
+## minimums per 100 kg of body weight, and 999999. means "no upper limit".
+##
+## A benchmark profile is the (minimum, maximum) pair of Meals for one set of
+## nutritional groupings, body weight and period ('meal' is a third of a
+## day, 'day' the whole day).  Profiles are built once and cached, their
+## vectors are read-only so the solver, the GUI and the batch workers can all
+## share them.  make_daily_min / make_daily_max still hand out fresh,
+## writable per-meal Meals.
+
+PERIODS = ('meal', 'day')
+
+daily_values_name = "daily_values.json"
+_daily_values = None
+_daily_values_lock = threading.Lock()
+
+def _daily_values_path():
+    ## next to the database (py2exe, see setup.py), or next to this module
+    path = os.path.join(current_dir, daily_values_name)
+    if not os.path.exists(path):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            daily_values_name)
+    return path
+
+def get_daily_values():
+    """ The parsed daily_values.json, loaded once """
+    global _daily_values
+    if _daily_values is None:
+        with _daily_values_lock:
+            if _daily_values is None:
+                with open(_daily_values_path(), 'r') as f:
+                    _daily_values = json.load(f)
+    return _daily_values
+
+def _benchmark_vector(kind, groupings, body_weight, period):
+    # kind is 'minimum' or 'maximum'
+    daily = get_daily_values()
+    per_day = 1. if period == 'day' else float(daily['meals_per_day'])
+    vector = nutrient_matrix.empty_vector()
+    for group in groupings:
+        for field, value in daily[kind].get(group, {}).iteritems():
+            if value is None:
+                continue
+            if value != daily['no_limit']:
+                value = value / per_day
+            if group == 'amino_acids' and body_weight is not None:
+                value = value * (body_weight / float(
+                    daily['amino_acids_per_kg']))
+            vector[nutrient_matrix.COLUMN_INDEX[(group, field)]] = value
+    return vector
+
+def _read_only_meal(groupings, values):
+    meal = Meal(list(groupings), values=values)
+    for array in (meal.values, meal.totals, meal.known):
+        array.flags.writeable = False
+    return meal
 
-# this was moved to per meal instead of per day at the last minute, needs
-# to be redone properly (which includes adding an option to switch between
-# per meal and per day - the time of designing that piece is why I just did
-# a temporary fix here)
+BenchmarkProfile = namedtuple('BenchmarkProfile', ['minimum', 'maximum',
+                                                   'groupings',
+                                                   'body_weight', 'period'])
+
+profile_cache = caching.LRUCache(maxsize=64)
+
+def get_benchmark_profile(groupings, body_weight=None, period='meal'):
+    """ Returns the cached BenchmarkProfile for the nutritional groupings.
+        body_weight: in kilograms, scales the amino acid minimums (None
+                     leaves them per 100 kg)
+        period: 'meal' or 'day'
+        The minimum and maximum Meals are shared and can't be changed, use
+        make_daily_min / make_daily_max for a copy to edit.
+        """
+    if period not in PERIODS:
+        raise ValueError("period must be one of %s" % (PERIODS,))
+    if body_weight is not None and 'amino_acids' in groupings:
+        body_weight = float(body_weight)
+    else:
+        body_weight = None # only the amino acids depend on it
+    key = (tuple(groupings), body_weight, period)
+    profile = profile_cache.get(key)
+    if profile is None:
+        profile = BenchmarkProfile(
+            minimum=_read_only_meal(groupings, _benchmark_vector(
+                'minimum', groupings, body_weight, period)),
+            maximum=_read_only_meal(groupings, _benchmark_vector(
+                'maximum', groupings, body_weight, period)),
+            groupings=key[0], body_weight=body_weight, period=period)
+        profile_cache.put(key, profile)
+    return profile
 
 def make_daily_min(groupings):
-    # not complete
     assert type(groupings) == list
-    daily_min = Meal(groupings)
-    if 'elements' in groupings:
-        daily_min.elements['Sodium, Na'] =  (1500. / 3.)
-        daily_min.elements['Phosphorus, P'] =  (700. / 3.)
-        daily_min.elements['Manganese, Mn'] =  (2.3 / 3.)
-        daily_min.elements['Iron, Fe'] =  (8. / 3.)
-        daily_min.elements['Potassium, K'] =  (4700. / 3.)
-        daily_min.elements['Fluoride, F'] = None #4. having troubles
-        daily_min.elements['Selenium, Se'] = None #.055 having troubles...
-        daily_min.elements['Magnesium, Mg'] =  (420. / 3.)
-        daily_min.elements['Zinc, Zn'] =  (11. / 3.)
-        daily_min.elements['Copper, Cu'] =  (.9 / 3.)
-        daily_min.elements['Calcium, Ca'] =  (1000. / 3.)
-    if 'vitamins' in groupings:
-        daily_min.vitamins['Niacin'] =  (16. / 3.)
-        daily_min.vitamins['Thiamin'] =  (1.2 / 3.)
-        daily_min.vitamins['Vitamin B-6'] = None ## instead of zero?
-        daily_min.vitamins['Pantothenic acid'] =  (5. / 3.)
-        daily_min.vitamins['Vitamin C, total ascorbic acid'] = (90. / 3.)
-        daily_min.vitamins['Vitamin A, IU'] =  (.9 / 3.)
-        daily_min.vitamins['Vitamin E (alpha-tocopherol)'] = (15. / 3.)
-        daily_min.vitamins['Vitamin D'] =  (.015 / 3.)
-        daily_min.vitamins['Folate, total'] =  (.4 / 3.)
-        daily_min.vitamins['Vitamin B-12'] =  (.0024 / 3.)
-        daily_min.vitamins['Vitamin K (phylloquinone)'] = (.12 / 3.)
-    if 'amino_acids' in groupings:
-        # assumed to be per 100kg, source for Proof Of Concept from
-        # http://en.wikipedia.org/wiki/Essential_amino_acid#Recommended_daily_amounts
-        # Methionine+Cysteine and Phenylalanine+Tyrosine were broken up,
-        # although they are substitutes for eachother.  These are in a sense
-        # dummy values!!!
-        daily_min.amino_acids['Lysine'] =  (3000 / 3.)
-        daily_min.amino_acids['Phenylalanine'] =  (1250 / 3.)
-        daily_min.amino_acids['Leucine'] =  (3900 / 3.)
-        daily_min.amino_acids['Methionine'] =  (750 / 3.)
-        daily_min.amino_acids['Histidine'] =  (1000 / 3.)
-        daily_min.amino_acids['Valine'] =  (2600 / 3.)
-        daily_min.amino_acids['Tryptophan'] =  (400 / 3.)
-        daily_min.amino_acids['Isoleucine'] =  (2000 / 3.)
-        daily_min.amino_acids['Threonine'] =  (1500 / 3.)
-        daily_min.amino_acids['Cystine'] =  (750 / 3.)
-        daily_min.amino_acids['Tyrosine'] =  (1250 / 3.)
-        daily_min.amino_acids['Hydroxyproline'] =  (5 / 3.)
-    return daily_min
+    return Meal(groupings, values=_benchmark_vector('minimum', groupings,
+                                                    None, 'meal'))
 
 def make_daily_max(groupings):
     assert type(groupings) == list
-    daily_max = Meal(groupings)
-    if 'elements' in groupings:
-        daily_max.elements['Sodium, Na'] =  (2300. / 3.)
-        daily_max.elements['Phosphorus, P'] =  (4000. / 3.)
-        daily_max.elements['Manganese, Mn'] =  (211. / 3.)
-        daily_max.elements['Iron, Fe'] =  (45. / 3.)
-        daily_max.elements['Potassium, K'] = 999999. ## 999999.=no upper limit
-        daily_max.elements['Fluoride, F'] = None #10.  having troubles
-        daily_max.elements['Selenium, Se'] = None #.4 having troubles, units off?
-        daily_max.elements['Magnesium, Mg'] = 999999.
-        daily_max.elements['Zinc, Zn'] =  (40. / 3.)
-        daily_max.elements['Copper, Cu'] =  (10. / 3.)
-        daily_max.elements['Calcium, Ca'] =  (2500. / 3.)
-    if 'vitamins' in groupings:
-        daily_max.vitamins['Niacin'] =  (35. / 3.)
-        daily_max.vitamins['Thiamin'] = 999999. 
-        daily_max.vitamins['Vitamin B-6'] =   (100. / 3.)
-        daily_max.vitamins['Pantothenic acid'] = 999999.
-        daily_max.vitamins['Vitamin C, total ascorbic acid'] = (2000. / 3.)
-        daily_max.vitamins['Vitamin A, IU'] =  (3. / 3.)
-        daily_max.vitamins['Vitamin E (alpha-tocopherol)'] = (1000. / 3.)
-        daily_max.vitamins['Vitamin D'] =  (.05 / 3.)
-        daily_max.vitamins['Folate, total'] =  (1. / 3.)
-        daily_max.vitamins['Vitamin B-12'] = 999999.
-        daily_max.vitamins['Vitamin K (phylloquinone)'] = 999999. 
-    return daily_max
-
-
-amino_acid_per_mass = {'Lysine':  (3000 / 3.),
-                       'Alanine': None,
-                       'Glycine': None,
-                       'Proline': None,
-                       'Serine': None,
-                       'Arginine': None,
-                       'Glutamic acid': None,
-                       'Phenylalanine':  (1250 / 3.),
-                       'Leucine':  (3900 / 3.),
-                       'Methionine':  (750 / 3.),
-                       'Histidine':  (1000 / 3.),
-                       'Valine':  (2600 / 3.),
-                       'Tryptophan':  (400 / 3.),
-                       'Isoleucine':  (2000 / 3.),
-                       'Threonine':  (1500 / 3.),
-                       'Aspartic acid': None,
-                       'Cystine':  (750 / 3.),
-                       'Tyrosine':  (1250 / 3.)}
-
-def add_amino_acids_to_min(daily_min, body_weight):
-    # body_weight is assumed to be in kilograms
-    for element in daily_min.amino_acids:
-        daily_min.amino_acids[element] = amino_acid_per_mass[element] * \
-                                         (body_weight / 100)
-    return daily_min
+    return Meal(groupings, values=_benchmark_vector('maximum', groupings,
+                                                    None, 'meal'))
+
+
+def add_amino_acids_to_min(daily_min, body_weight, period='meal'):
+    """ Returns a copy of daily_min with its amino acid minimums scaled to
+        body_weight (in kilograms) from daily_values.json.  daily_min isn't
+        changed, so the shared benchmarks of get_benchmarks can be passed
+        in too (get_benchmark_profile(groupings, body_weight) gives the
+        cached result directly).
+        """
+    values = daily_min.values.copy()
+    if 'amino_acids' in daily_min.nutritional_groupings:
+        columns = nutrient_matrix.columns_for(['amino_acids'])
+        values[columns] = _benchmark_vector('minimum', ['amino_acids'],
+                                            body_weight, period)[columns]
+    return Meal(list(daily_min.nutritional_groupings), values=values)
     
-def add_amino_acids_to_max(daily_max, body_weight):
-    # no max info at this time
-    pass
+def add_amino_acids_to_max(daily_max, body_weight, period='meal'):
+    # no max info at this time, returns a copy like add_amino_acids_to_min
+    return Meal(list(daily_max.nutritional_groupings),
+                values=daily_max.values.copy())
     
 
 #############################################################################
@@ -644,11 +711,14 @@ the_groups = ['Dairy and Egg Products', 'Spices and Herbs', 'Baby Foods',\
 
 def get_food_from_group_by_name(group_filter, name):
     """ Given a name and a filter of the group that name is in, returns the
-        single corresponding object.
+        single corresponding Food.
         """
-    ## this should be optimized later (should terminate when object is found)
     assert type(group_filter) is Food_Group_Filter and type(name) is str
-    return get_foods_by_group_and_name(group_filter, Name_Filter([name]))[0]
+    db = get_database()
+    row = db.row_by_name.get(name)
+    if row is None or not group_filter.check(db.matrix.groups[row]):
+        raise IndexError("no food named %r in the selected groups" % name)
+    return Food.from_row(db.matrix, row, ['elements', 'vitamins'])
 
 
 ##
@@ -661,106 +731,108 @@ def get_food_from_group_by_name(group_filter, name):
 ## this little chunk must be coordinated with setup.py for the program to run
 current_dir = os.path.dirname(os.path.abspath(sys.argv[0]))
 json_loc = os.path.join(current_dir, "foods-2011-10-03.json")
-jsonfile = open(json_loc, "r")
-
-## json needs to be loaded using multithreading/multiprocessing so it doesn't
-## hold up the entire program.  The multithreading approach is being
-## experimented with bnut my computer only has one processor so I can't run
-## and debug the multithreaded solution
-
-db_tuple = tuple(json.load(jsonfile)) # tuple to prevent mutation
 
+## The JSON file is only parsed the first time (or after it changes), when
+## it is compiled into a binary store next to it.  After that the store's
+## nutrient matrix is memory-mapped (see nutrient_matrix.py).
+##
+## Nothing is loaded when this module is imported.  The database is loaded
+## by the first call to get_database(), or ahead of time in a background
+## thread by warm_up(), so the GUI can open its window right away.
+
+class FoodDatabase(object):
+    """ Everything loaded from the food database:
+        -matrix: the NutrientMatrix (one row per food)
+        -checksum: sha1 of the source JSON file
+        -rows_by_foodgroup: food group -> list of matrix rows
+        -row_by_name, row_by_id: description / USDA id -> matrix row
+        -the search index (see get_search_index)
+        """
+    def __init__(self, matrix, checksum):
+        self.matrix = matrix
+        self.checksum = checksum
+        ## database in pieces, separated by food group
+        self.rows_by_foodgroup = matrix.rows_by_group()
+        ## lookup tables, the first row wins if a name is repeated
+        self.row_by_name = {}
+        for row, name in enumerate(matrix.names):
+            self.row_by_name.setdefault(name, row)
+        self.row_by_id = {}
+        for row, food_id in enumerate(matrix.ids):
+            self.row_by_id.setdefault(food_id, row)
+        self._search_index = None
+        self._lock = threading.Lock()
+
+    def get_search_index(self):
+        """ The TokenIndex over food descriptions and tags, built on first
+            use.
+            """
+        if self._search_index is None:
+            with self._lock:
+                if self._search_index is None:
+                    self._search_index = token_index.TokenIndex(
+                        self.matrix.names, self.matrix.tags,
+                        self.matrix.groups)
+        return self._search_index
+
+_database = None
+_database_lock = threading.Lock()
+
+def get_database():
+    """ Returns the FoodDatabase, loading it on first use.  Safe to call from
+        any thread, the database is only ever loaded once.
+        """
+    global _database
+    if _database is None:
+        with _database_lock:
+            if _database is None:
+                with instrument.timer('perfectmeal.database_load'):
+                    matrix, checksum = \
+                        nutrient_matrix.load_or_compile(json_loc)
+                _database = FoodDatabase(matrix, checksum)
+    return _database
+
+def _warm_up():
+    get_database().get_search_index()
+
+def warm_up():
+    """ Starts loading the database (and building its search index) in a
+        background thread and returns the thread.  Anything that needs the
+        database in the meantime simply waits for the load to finish.
+        """
+    thread = threading.Thread(target=_warm_up, name="perfectmeal-db")
+    thread.daemon = True
+    thread.start()
+    return thread
 
-## database in pieces, separated by food group
-def make_database_by_foodgroup(full_db):
-    """ Create a dictionary from the json database where the keys are food
-        groups and the values are lists of their members.
+def database_loaded():
+    return _database is not None
 
+def get_partial_db(food_groups):
+    """ Returns the database rows belonging to the given food groups.
         Useful for searching through part of the database.
         """
-    food_groups = ['Dairy and Egg Products', 'Spices and Herbs', 'Baby Foods',\
-                  'Fats and Oils', 'Poultry Products', 'Soups, Sauces, and Gravies',\
-                  'Sausages and Luncheon Meats', 'Breakfast Cereals',\
-                  'Fruits and Fruit Juices', 'Pork Products',\
-                  'Vegetables and Vegetable Products', 'Nut and Seed Products',\
-                  'Beef Products', 'Beverages', 'Finfish and Shellfish Products',\
-                  'Legumes and Legume Products', 'Lamb, Veal, and Game Products',\
-                  'Baked Products', 'Snacks', 'Sweets', 'Cereal Grains and Pasta',\
-                  'Fast Foods', 'Meals, Entrees, and Sidedishes', 'Ethnic Foods',\
-                  'Restaurant Foods']
-    data_dict = {x:[] for x in food_groups}
-    for item in full_db:
-        data_dict[item['group']].append(item)
-    return data_dict
-
-db_by_foodgroup = make_database_by_foodgroup(db_tuple)
-
-def get_partial_db(food_groups):
+    rows_by_foodgroup = get_database().rows_by_foodgroup
     total = []
     for key in food_groups:
-        total += db_by_foodgroup[key]
+        total += rows_by_foodgroup.get(key, [])
     return total
 
 ########################################
 
-def get_objects_by_group_and_name(food_group_filter, name_filter):
-    """ Steps through the JSON database and keeps objects that satisfy the
-        group and name filters' constraints.
-        """
-    ## TODO: fix this to work with get_partial_db()
-
-    #print ''
-    #print 'food_group_filter and name_filter', food_group_filter, name_filter
-    #print ''
-    assert type(food_group_filter) is Food_Group_Filter
-    # and type(name_filter) is Name_Filter
-    objects = []
+def search_by_name(word, food_groups, candidates=None):
+    # matches every food with a word (in its description or tags) that starts
+    # with 'word', see token_index.py
+    return get_database().get_search_index().search_one(word, food_groups,
+                                                        candidates)
 
-    partial = get_partial_db(food_group_filter.get_groups())
-    
-    for jdict in partial:
-        if food_group_filter.check(jdict['group']) and\
-           name_filter.check(jdict['description']):
-            objects.append(jdict)
-    return objects
-
-def get_object_by_name(name):
-    """ Steps through the JSON database and returns the first object that meets
-        the name criteria.
-        """
-    for jdict in db_tuple:
-        if name == jdict['description']:
-            return jdict
-    return False
-
-def search_by_name(word, food_groups):
-    matches = []
-    # db_tuple is the 'global' database, (not mutated so not declared)
-    partial_db = get_partial_db(food_groups)
-    for jdict in partial_db:
-        if re.search(word.lower(),
-                     jdict['description'].lower()) is not None:
-            matches.append(jdict['description'])
-    return matches
-
-def search_many(word_list, food_groups):
+def search_many(word_list, food_groups, candidates=None):
     # a fairly naive multiple term search algorithm (term grouping is not incl.)
     # counts the matches for each description, must match at least all but one
     # term in the word list
-    partial_db = get_partial_db(food_groups)
-    matches = {}
-    for jdict in partial_db: # partial_db is the database, jdict is a json object
-        for word in word_list:
-            if re.search(word.lower(),
-                      jdict['description'].lower()) is not None:
-                if jdict['description'] not in matches.keys():
-                    matches[jdict['description']] = 1
-                else:
-                    matches[jdict['description']] += 1
-    intermediate = sorted(matches.items(), key=lambda x: x[1], reverse=True)
-    return [x[0] for x in intermediate if x[1] >= len(word_list) - 1
-            and x[1] > 1]
-            
+    return get_database().get_search_index().search_many(word_list,
+                                                         food_groups,
+                                                         candidates)
  
 
 
@@ -768,6 +840,7 @@ def search_many(word_list, food_groups):
 ######################## From JSON to Food objects ##########################
 #############################################################################
 
+@instrument.timed()
 def get_food_objects(food_group_filter=Food_Group_Filter(),
                      name_filter=Name_Filter(),
                      nutrient_group_filter=['elements', 'vitamins']):
@@ -775,23 +848,149 @@ def get_food_objects(food_group_filter=Food_Group_Filter(),
         objects from the JSON database and maps them into Food objects,
         returns a list of Food objects.
         """
-    #print 'get_food_objects, type(name_filter', type(name_filter)
-    obj_list = get_objects_by_group_and_name(food_group_filter, name_filter)
-    return [Food(nutrient_group_filter, obj) for obj in obj_list]
+    matrix = get_database().matrix
+    rows = [row for row in get_partial_db(food_group_filter.get_groups())
+            if name_filter.check(matrix.names[row])]
+    return [Food.from_row(matrix, row, nutrient_group_filter)
+            for row in rows]
+
+## Converted foods (and their flattened dictionaries) are cached between
+## complete_meal calls.  Keys are (database checksum, USDA id, nutritional
+## groupings), the least recently used entries are dropped first.
+food_cache = caching.LRUCache(maxsize=16384)
+
+def get_cached_foods(food_group_filter, nutrient_groups):
+    """ Returns a list of (Food, flattened dictionary) pairs for the foods in
+        the filter's groups.  The pairs are shared between callers, treat
+        them as read-only.
+        """
+    db = get_database()
+    groupings_key = tuple(nutrient_groups)
+    pairs = []
+    for row in get_partial_db(food_group_filter.get_groups()):
+        key = (db.checksum, db.matrix.ids[row], groupings_key)
+        pair = food_cache.get(key)
+        if pair is None:
+            food = Food.from_row(db.matrix, row, list(nutrient_groups))
+            pair = (food, food.flatten())
+            food_cache.put(key, pair)
+        pairs.append(pair)
+    return pairs
+
+def get_food_cache_stats():
+    """ hits, misses, evictions and size of the converted food cache """
+    return food_cache.stats()
+
+## everything complete_meal hands to ackpl for one set of food groups and
+## nutritional groupings, built once and shared between completions
+Candidates = namedtuple('Candidates', ['foods', 'possibilities',
+                                       'serving_sizes', 'foods_by_name',
+                                       'columns', 'matrix'])
+
+candidate_cache = caching.LRUCache(maxsize=64)
+
+def get_candidates(food_groups, nutrient_groups):
+    """ Returns the Candidates for completing meals from food_groups:
+        the Foods, their [name, flattened dictionary] possibilities and
+        serving sizes, a name -> Food lookup (the first food wins), and the
+        candidates' (foods x nutrients) matrix with a field name -> matrix
+        column lookup.  Shared between callers, treat it as read-only.
+        """
+    db = get_database()
+    key = (db.checksum, tuple(food_groups), tuple(nutrient_groups))
+    candidates = candidate_cache.get(key)
+    if candidates is None:
+        group_filter = Food_Group_Filter(food_groups)
+        pairs = get_cached_foods(group_filter, nutrient_groups)
+        rows = get_partial_db(group_filter.get_groups())
+        cols = nutrient_matrix.columns_for(nutrient_groups)
+        foods_by_name = {}
+        for food, flat in pairs:
+            foods_by_name.setdefault(food.get_name(), food)
+        candidates = Candidates(
+            foods=[food for food, flat in pairs],
+            possibilities=[[food.get_name(), flat] for food, flat in pairs],
+            serving_sizes=[food.serving_size for food, flat in pairs],
+            foods_by_name=foods_by_name,
+            columns=dict((nutrient_matrix.COLUMNS[col][1], i)
+                         for i, col in enumerate(cols)),
+            matrix=db.matrix.values[np.ix_(rows, cols)])
+        candidate_cache.put(key, candidates)
+    return candidates
+
+## Completed meals are cached by a hash of everything that decides the
+## result (see result_key), so asking for the same completion again doesn't
+## search again.  The key includes the database checksum, results for an
+## older database are never found again and age out.  The memory tier is
+## per process, set PERFECTMEAL_RESULT_CACHE to a directory to also keep
+## results on disk (shared between processes and runs).
+RESULT_DISK_BYTES = 64 << 20
+
+result_cache = caching.TieredCache(caching.LRUCache(maxsize=256))
+
+def use_result_disk_cache(path, max_bytes=RESULT_DISK_BYTES):
+    """ Keeps completed meals in 'path' as well (None turns it off) """
+    if path is None:
+        result_cache.disk = None
+    else:
+        result_cache.disk = caching.DiskCache(path, max_bytes)
+
+if os.environ.get('PERFECTMEAL_RESULT_CACHE'):
+    use_result_disk_cache(os.environ['PERFECTMEAL_RESULT_CACHE'])
+
+def result_key(current_meal, min_meal, max_meal, algorithm, food_groups,
+               time_limit=None, prune=None):
+    """ The sha1 hex digest naming complete_meal's result for these inputs,
+        or None if the meal holds a food that isn't from the database.  The
+        current foods count as a multiset and the food groups as a set,
+        their order doesn't change the result.
+        """
+    servings = []
+    for food, count in current_meal.servings():
+        if food.food_id is None:
+            return None
+        servings.append((food.food_id, count))
+    servings.sort()
+    if time_limit is not None:
+        time_limit = float(time_limit)
+    digest = hashlib.sha1(json.dumps(
+        [get_database().checksum, servings,
+         list(current_meal.nutritional_groupings),
+         list(min_meal.nutritional_groupings),
+         list(max_meal.nutritional_groupings),
+         algorithm, sorted(set(food_groups)), time_limit, prune]))
+    for limits in (min_meal, max_meal):
+        ## one NaN for every missing value, whatever its bits were
+        values = limits.values[limits.columns()]
+        digest.update(np.where(np.isnan(values), np.nan, values).tostring())
+    return digest.hexdigest()
+
+def get_result_cache_stats():
+    """ the memory and disk tiers' stats for the completed meal cache """
+    return result_cache.stats()
 
 def get_foods_for_objects(objects, nutrient_groups=['vitamins', 'elements',
                                                     'amino_acids']):
     return [Food(nutrient_groups, obj) for obj in objects]
 
 def get_food_with_name(food_name, nutrient_groups=None):
-    ######## rewrite
     if nutrient_groups == None:
         nutrient_groups = ['elements', 'vitamins', 'amino_acids']
-    the_object = get_object_by_name(food_name)
-    if the_object is not False:
-        return Food(nutrient_groups, the_object)
-    else:
+    db = get_database()
+    row = db.row_by_name.get(food_name)
+    if row is None:
         return False
+    return Food.from_row(db.matrix, row, nutrient_groups)
+
+def get_food_with_id(food_id, nutrient_groups=None):
+    """ Same as get_food_with_name but takes a USDA id """
+    if nutrient_groups == None:
+        nutrient_groups = ['elements', 'vitamins', 'amino_acids']
+    db = get_database()
+    row = db.row_by_id.get(food_id)
+    if row is None:
+        return False
+    return Food.from_row(db.matrix, row, nutrient_groups)
 
 
 #############################################################################
@@ -804,17 +1003,13 @@ def get_food_with_name(food_name, nutrient_groups=None):
 def get_fields(nutritional_groupings=['elements', 'vitamins', 'energy',
                                       'sugars', 'amino_acids', 'other',
                                       'composition']):
-    #print 'get_fields groupings:', nutritional_groupings
-    food = Food(nutritional_groupings)
     fields = dict()
-    for group in food.nutritional_groupings:
-        fields[group] = food.__dict__[group].keys()
+    for group in nutritional_groupings:
+        fields[group] = list(nutrient_matrix.FIELDS[group])
     return fields
 
 def get_fields_for_group(group):
-    food = Food([group])
-    fields = food.__dict__[group].keys()
-    return fields
+    return list(nutrient_matrix.FIELDS[group])
 
 def get_food(name, groupings=['elements', 'vitamins', 'energy', 'sugars',
                               'amino_acids', 'other', 'composition']):
@@ -822,6 +1017,24 @@ def get_food(name, groupings=['elements', 'vitamins', 'energy', 'sugars',
         """
     return get_food_with_name(name, groupings)
 
+def get_foods(names, groupings=['elements', 'vitamins', 'energy', 'sugars',
+                                'amino_acids', 'other', 'composition']):
+    """ Takes a list of food names and returns the corresponding Food objects
+        (False for any name that isn't in the database), one dictionary
+        lookup per name.
+        """
+    if len(names) == 0:
+        return [] # don't force the database to load for an empty meal
+    db = get_database()
+    foods = []
+    for name in names:
+        row = db.row_by_name.get(name)
+        if row is None:
+            foods.append(False)
+        else:
+            foods.append(Food.from_row(db.matrix, row, groupings))
+    return foods
+
 def get_meal(name_list, groupings=['elements', 'vitamins', 'energy',
                                       'sugars', 'amino_acids', 'other',
                                       'composition']):
@@ -829,67 +1042,298 @@ def get_meal(name_list, groupings=['elements', 'vitamins', 'energy',
         those foods.
         """
     meal = Meal(groupings)
-    for name in name_list:
-        food = get_food_with_name(name)
+    for food in get_foods(name_list, groupings):
         meal.add(food)
     return meal
 
 def get_benchmarks(nutritional_groupings=['elements', 'vitamins', 'energy',
                                       'sugars', 'amino_acids', 'other',
-                                      'composition']):
-    """ Returns a two-tuple of the minimum and maximum daily allowances
+                                      'composition'],
+                   body_weight=None, period='meal'):
+    """ Returns a two-tuple of the minimum and maximum allowances (per meal
+        by default).  The Meals are shared and read-only, see
+        get_benchmark_profile.
+        """
+    profile = get_benchmark_profile(nutritional_groupings, body_weight,
+                                    period)
+    return profile.minimum, profile.maximum
+
+@instrument.timed()
+def search_like(search_string, food_groups, candidates=None):
+    """ Names of the foods in food_groups matching search_string.
+        candidates: optional database rows to search instead of the whole
+        index (see search_like_rows)
         """
-    return (make_daily_min(nutritional_groupings),
-            make_daily_max(nutritional_groupings))
-    
-def search_like(search_string, food_groups):
     assert type(search_string) is unicode or type(search_string) is str
     assert type(food_groups) is list
     search_list = search_string.split(' ')
     if len(search_list) == 1:
-        return search_by_name(search_string, food_groups)
+        return search_by_name(search_string, food_groups, candidates)
     else:
-        return search_many(search_list, food_groups)
+        return search_many(search_list, food_groups, candidates)
+
+def search_like_rows(search_string, food_groups, candidates=None):
+    """ search_like, returning (names, rows): rows are all of the matching
+        database rows.  A search that only adds letters to the terms of an
+        earlier one (same number of terms, same food groups) can pass the
+        earlier search's rows as candidates, only those are checked.
+        """
+    assert type(search_string) is unicode or type(search_string) is str
+    assert type(food_groups) is list
+    index = get_database().get_search_index()
+    search_list = search_string.split(' ')
+    if len(search_list) == 1:
+        rows = index.search_one_rows(search_string, food_groups, candidates)
+        return index.names_for(rows), rows
+    rows = index.search_many_rows(search_list, food_groups, candidates)
+    return index.names_for(rows, unique=True), rows
     
 def get_available_algs():
     """ Go-between for the GUI and ackpl """
     # this exists so perfectmeal_gui doesn't need to directy access ackpl.py
     return ackpl.algorithm_names()
 
-def complete_meal(current_meal, min_meal, max_meal, algorithm, food_groups):
+@instrument.timed()
+def complete_meal(current_meal, min_meal, max_meal, algorithm, food_groups,
+                  engine="array", progress=None, time_limit=None,
+                  prune=None, report=None, cache=True):
     """ Acts as a go-between for the GUI and ackpl.py
         Returns a "completed" meal, completed either because it violated a max
         constraint or because it satisfied all of its min constraints.
+        'engine', 'progress', 'time_limit', 'prune' and 'report' are passed
+        through to ackpl.ackp (the serving sizes are passed as the costs, so
+        "heuristic" pruning compares foods per gram)
+        cache: look the result up in (and add it to) result_cache.  Calls
+               with a report always search, and searches stopped by
+               progress or the time limit aren't kept.
         """
-    ## should this Name_Filter class be derprecated or just renamed?
-    all_foods = get_food_objects(food_group_filter=Food_Group_Filter(food_groups),
-                                 name_filter=Name_Filter(),
-                                 nutrient_group_filter=current_meal.nutritional_groupings)
-    possibilities = []
-    serving_sizes = {}
-    for food in all_foods:
-        serving_sizes[food.get_name()] = food.serving_size
-        possibilities.append([food.get_name(), food.flatten()])
+    key = None
+    if cache and report is None:
+        key = result_key(current_meal, min_meal, max_meal, algorithm,
+                         food_groups, time_limit, prune)
+    if key is not None:
+        food_ids = result_cache.get(key, _no_result)
+        if food_ids is not _no_result:
+            instrument.count('perfectmeal.result_cache.hits')
+            if food_ids is None:
+                return None
+            return meal_from_ids(food_ids, current_meal.nutritional_groupings)
+        instrument.count('perfectmeal.result_cache.misses')
+        report = {} # to learn whether an exact search finished
+        if progress is not None:
+            progress = _StopWatch(progress)
+    candidates = get_candidates(food_groups,
+                                current_meal.nutritional_groupings)
+    current_foods = dict((food.get_name(), food)
+                         for food in current_meal.foods)
     minimums = ('minimums', min_meal.flatten())
     maximums = ('maximums', max_meal.flatten())
     currents = [[food.name, food.flatten()] for food in current_meal.foods]
+    ## the shared matrix in the key order ackpl will use
+    keys = list(minimums[1].keys())
+    matrix = candidates.matrix[:, [candidates.columns[field]
+                                   for field in keys]]
     #algorithm = algorithm
 
-    completed_flat = ackpl.ackp(possibilities, minimums, maximums, currents, 
-                                algorithm)
+    ## the searches may remove from the list, so they get their own copy
+    completed_flat = ackpl.ackp(list(candidates.possibilities), minimums,
+                                maximums, currents, algorithm, engine=engine,
+                                progress=progress,
+                                costs=candidates.serving_sizes,
+                                time_limit=time_limit, prune=prune,
+                                report=report, arrays=(keys, matrix))
+    if completed_flat is not None and type(completed_flat) is not list:
+        return completed_flat ## maybe?
+    keep = key is not None and report.get('optimal', True) and \
+           not (progress is not None and progress.stopped)
     if completed_flat is None:
+        if keep:
+            result_cache.put(key, None)
         return None
-    if type(completed_flat) is not list:
-        return completed_flat ## maybe?
-    foods = []
-    for food in completed_flat:
-        new_food = Food.unflatten(food[1], food[0])
-        new_food.serving_size = serving_sizes[new_food.get_name()]
-        foods.append(new_food)
+    ## the picks are the same Food objects, so the new meal's multiset is
+    ## keyed by their database ids
+    foods = [current_foods[name] if name in current_foods
+             else candidates.foods_by_name[name]
+             for name, flat in completed_flat]
     #print 'number foods', len(foods)
-    new_meal = Meal(foods[0].nutritional_groupings, foods)
+    new_meal = Meal(list(current_meal.nutritional_groupings), foods)
+    if keep:
+        result_cache.put(key, [food.food_id for food in new_meal.foods])
     return new_meal
 
+_no_result = object() # result_cache misses (None is a cached "no meal")
+
+class _StopWatch(object):
+    # wraps a progress callback and remembers whether it stopped the search
+    def __init__(self, progress):
+        self.progress = progress
+        self.stopped = False
+    def __call__(self, step, score):
+        if self.progress(step, score) is False:
+            self.stopped = True
+            return False
+
+## Batch completion
+## complete_meals fans requests out over worker processes.  The database is
+## loaded before the workers start (forked workers share it, others read
+## the mmapped store), each worker keeps its own candidate, benchmark and
+## result caches across the requests it handles, and only food ids travel
+## back.
+DEFAULT_GROUPINGS = ['elements', 'vitamins']
+
+## algorithms that start worker processes of their own, which pool workers
+## (daemonic) aren't allowed to do, they run in the calling process instead
+OWN_PROCESSES = ('portfolio',)
+
+def starts_processes(request, engine="array"):
+    """ True if running 'request' starts worker processes: the portfolio
+        algorithm, or a greedy search with the parallel engine over at
+        least ackpl.parallel_threshold candidates.  Smaller searches are
+        scored in the process running them (see ackpl.greedy_alg_parallel);
+        candidates are counted before pruning, so this can overestimate.
+        """
+    algorithm = request.get('algorithm', 'greedy_balance')
+    if algorithm in OWN_PROCESSES:
+        return True
+    if engine != "parallel" or "greedy" not in algorithm:
+        return False
+    group_filter = Food_Group_Filter(request.get('food_groups', the_groups))
+    return len(get_partial_db(group_filter.get_groups())) >= \
+        ackpl.parallel_threshold
+
+def check_request(request):
+    """ Returns a message for what's wrong with a complete_meals request,
+        or None if it looks runnable """
+    if not request.get('foods'):
+        ## ackpl completes a meal, it can't start from nothing
+        return 'foods must name at least one food'
+    algorithm = request.get('algorithm', 'greedy_balance')
+    if algorithm not in ackpl.algorithm_names():
+        return 'unknown algorithm: %s' % algorithm
+    for grouping in request.get('groupings', DEFAULT_GROUPINGS):
+        if grouping not in nutrient_matrix.ALL_GROUPINGS:
+            return 'unknown grouping: %s' % grouping
+    for group in request.get('food_groups', the_groups):
+        if group not in the_groups:
+            return 'unknown food group: %s' % group
+    return None
+
+def run_request(request, engine="array", progress=None):
+    """ Runs one complete_meals request (see below) in this process.
+        Returns (food ids or None, error message or None), progress is
+        passed through to complete_meal.  Only problems with the request
+        itself come back as messages, anything else is raised.
+        """
+    error = check_request(request)
+    if error is not None:
+        return None, error
+    groupings = list(request.get('groupings', DEFAULT_GROUPINGS))
+    min_meal, max_meal = get_benchmarks(groupings, request.get('body_weight'))
+    names = request['foods']
+    meal = Meal(groupings)
+    for name, food in zip(names, get_foods(names, groupings)):
+        if food is False:
+            return None, 'unknown food: %s' % name
+        meal.add(food)
+    new_meal = complete_meal(meal, min_meal, max_meal,
+                             request.get('algorithm', 'greedy_balance'),
+                             request.get('food_groups', the_groups),
+                             engine=engine, progress=progress,
+                             time_limit=request.get('time_limit'))
+    if new_meal is None:
+        return None, None
+    return [food.food_id for food in new_meal.foods], None
+
+def _complete_request(job):
+    # runs one request, returns (index, food ids or None, error message)
+    index, request, engine = job
+    try:
+        food_ids, error = run_request(request, engine)
+    except Exception as e:
+        return index, None, '%s: %s' % (type(e).__name__, e)
+    return index, food_ids, error
+
+def meal_from_ids(food_ids, groupings):
+    """ A Meal of the foods with the given USDA ids (repeats are servings) """
+    db = get_database()
+    groupings = list(groupings)
+    return Meal(groupings, [Food.from_row(db.matrix, db.row_by_id[food_id],
+                                          groupings)
+                            for food_id in food_ids])
+
+def complete_meals(requests, processes=None, engine="array", chunksize=4):
+    """ Completes many meals, yielding (index, meal, error) as each one
+        finishes (not necessarily in order).  index is the request's position
+        in 'requests', meal is the completed Meal (None if the algorithm
+        found nothing or the request failed) and error is None or a message.
+
+        Each request is a dictionary:
+            -foods: names of the foods already in the meal (at least one)
+            -algorithm: an ackpl algorithm name (default "greedy_balance")
+            -food_groups: the groups to complete from (default all of them)
+            -groupings: nutritional groupings (default DEFAULT_GROUPINGS)
+            -body_weight: in kilograms, scales the amino acid minimums
+            -time_limit: seconds, for the exact_ algorithms
+
+        processes: worker processes (None for one per CPU, 0 runs the
+                   requests in this process).  Requests that start worker
+                   processes of their own (see starts_processes) always run
+                   in a thread of this process, one at a time, while the
+                   pool works through the others.
+        """
+    get_database() # loaded once here, before the workers start
+    jobs = [(index, request, engine)
+            for index, request in enumerate(requests)]
+    pool = threads = None
+    if processes == 0:
+        results = itertools.imap(_complete_request, jobs)
+    else:
+        own = [job for job in jobs if starts_processes(job[1], engine)]
+        pooled = [job for job in jobs if not starts_processes(job[1], engine)]
+        finished = Queue.Queue()
+        if own:
+            threads = ThreadPool(1)
+            for job in own:
+                threads.apply_async(_complete_request, (job,),
+                                    callback=finished.put)
+        if pooled:
+            import multiprocessing
+            pool = multiprocessing.Pool(processes)
+            ## a thread hands the pool's results over as they come in, so
+            ## they mix with the thread's
+            feeder = threading.Thread(target=_feed, args=(
+                pool.imap_unordered(_complete_request, pooled, chunksize),
+                finished, [job[0] for job in pooled]))
+            feeder.daemon = True
+            feeder.start()
+        results = (finished.get() for job in jobs)
+    try:
+        for index, food_ids, error in results:
+            if food_ids is None:
+                yield index, None, error
+                continue
+            yield index, meal_from_ids(food_ids, jobs[index][1].get(
+                'groupings', DEFAULT_GROUPINGS)), None
+    finally:
+        for workers in (pool, threads):
+            if workers is not None:
+                workers.terminate()
+                workers.join()
+
+def _feed(results, finished, indexes):
+    # if the pool fails (a worker killed, a result that can't be pickled),
+    # the requests it didn't finish are reported failed rather than waited
+    # for forever
+    remaining = set(indexes)
+    try:
+        for result in results:
+            remaining.discard(result[0])
+            finished.put(result)
+    except Exception as e:
+        error = '%s: %s' % (type(e).__name__, e)
+        for index in sorted(remaining):
+            finished.put((index, None, error))
+
 def get_all_foodgroups():
     # pulling from a global?  this could be better...
     return the_groups
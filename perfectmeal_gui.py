@@ -22,72 +22,257 @@ import wx
 import wx.grid
 import wx.lib.scrolledpanel as scrolled
 import perfectmeal as perfmeal
+import nutrient_matrix # the nutrient vector layout, for the grid
+import ackpl # for the greedy search's step limit
+import threading
+import multiprocessing # freeze_support, for the py2exe build
 import sys # sys is only used for one try/except loop, can easily be disabled
 
+SEARCH_DELAY = 250 # milliseconds of no typing before a live search runs
+
 class NutrientGridDataTable(wx.grid.PyGridTableBase):
     ## The preferred method of using wxGrids is to have a data table that
     ## handles the data and a grid instance that handles the display.  This
-    ## is the data table.
+    ## is the data table.  It's virtual: the grid asks it for the cells it's
+    ## painting, and the values come straight out of the nutrient vectors of
+    ## the current meal and the min/max benchmarks.  refresh() repaints only
+    ## the cells whose text or color changed since the last refresh.
+    column_labels = ['current', 'min', 'max']
+
     def __init__(self, view):
         super(NutrientGridDataTable, self).__init__()
-        self.data = []
-        self.row_titles = []
         self.view = view
+        self.nutritional_groupings = None
+        self.row_titles = []
+        self.row_groups = [] # grouping of each row
+        self.row_columns = [] # nutrient vector index of each row, None for
+                              # the grouping title rows
+        self.shown = [] # (current, min, max, highlight) as last painted
+        self.attrs = {} # highlight color -> GridCellAttr
 
     def set_parent(self, parent):
         """ Called by whoever creates the data table, implies permission to
             access the parent's data and methods as needed """
         self.parent = parent
-        
-    def refresh_data(self):
-        self.nutritional_groupings = self.parent.get_nutrient_groups()
-        for group in self.nutritional_groupings:
-            self.row_titles.append(group.upper())
-            self.data.append(["","",""])
 
-            fields = perfmeal.get_fields_for_group(group)
-            for field in fields:
+    def _layout(self, groupings):
+        self.nutritional_groupings = groupings
+        self.row_titles, self.row_groups, self.row_columns = [], [], []
+        for group in groupings:
+            self.row_titles.append(group.upper())
+            self.row_groups.append(group)
+            self.row_columns.append(None)
+            for field in perfmeal.get_fields_for_group(group):
                 self.row_titles.append(field)
-                self.data.append([self.parent.current_meal.get_val(group,field),
-                                  self.parent.min_vals.get_val(group,field),
-                                  self.parent.max_vals.get_val(group,field)])
-            
-    def get_number_rows(self):
-        return len(self.data)
-    def get_number_cols(self):
-        return len(self.data[0])
-    def is_empty_cell(self, row, col):
-        return False
-    def get_type_name(self, row, col):
-        return None
-    def get_row_label(self, row):
-        return self.row_titles[row]
+                self.row_groups.append(group)
+                self.row_columns.append(
+                    nutrient_matrix.COLUMN_INDEX[(group, field)])
+
+    def _snapshot(self):
+        return [(self.GetValue(row, 0), self.GetValue(row, 1),
+                 self.GetValue(row, 2), self.get_entry_highlight(row))
+                for row in range(self.GetNumberRows())]
+
+    def refresh(self):
+        """ Brings the grid up to date with the current meal, benchmarks and
+            nutritional groupings.  Changing the groupings changes the rows
+            and repaints the whole grid, otherwise only the cells that
+            changed are repainted.
+            """
+        groupings = self.parent.get_nutrient_groups()
+        if groupings != self.nutritional_groupings:
+            old_rows = self.GetNumberRows()
+            self._layout(groupings)
+            self.shown = self._snapshot()
+            self._notify_rows(old_rows, self.GetNumberRows())
+            return
+        shown = self._snapshot()
+        for row, (old, new) in enumerate(zip(self.shown, shown)):
+            if old[0] != new[0] or old[3] != new[3]:
+                self._refresh_cell(row, 0)
+            for col in (1, 2):
+                if old[col] != new[col]:
+                    self._refresh_cell(row, col)
+        self.shown = shown
+
+    def _notify_rows(self, old_rows, new_rows):
+        # tells an attached grid the number of rows changed
+        grid = self.GetView()
+        if grid is None:
+            return
+        grid.BeginBatch()
+        if new_rows < old_rows:
+            grid.ProcessTableMessage(wx.grid.GridTableMessage(
+                self, wx.grid.GRIDTABLE_NOTIFY_ROWS_DELETED, new_rows,
+                old_rows - new_rows))
+        elif new_rows > old_rows:
+            grid.ProcessTableMessage(wx.grid.GridTableMessage(
+                self, wx.grid.GRIDTABLE_NOTIFY_ROWS_APPENDED,
+                new_rows - old_rows))
+        grid.EndBatch()
+        grid.SetRowLabelSize(self.get_row_label_size())
+        grid.ForceRefresh()
+
+    def _refresh_cell(self, row, col):
+        grid = self.GetView()
+        if grid is None:
+            return
+        rect = grid.CellToRect(row, col)
+        rect.x, rect.y = grid.CalcScrolledPosition(rect.x, rect.y)
+        grid.GetGridWindow().RefreshRect(rect)
+
+    def get_number(self, row, col):
+        """ The current (col 0), min (1) or max (2) value of a row, None if
+            there's no data or the row is a grouping title
+            """
+        index = self.row_columns[row]
+        if index is None:
+            return None
+        food = (self.parent.current_meal, self.parent.min_vals,
+                self.parent.max_vals)[col]
+        if food is None or \
+           self.row_groups[row] not in food.nutritional_groupings:
+            return None
+        value = food.values[index]
+        if value != value: # NaN
+            return None
+        return float(value)
+
+    ## the wx.grid.PyGridTableBase interface
+    def GetNumberRows(self):
+        return len(self.row_titles)
+    def GetNumberCols(self):
+        return len(self.column_labels)
+    def IsEmptyCell(self, row, col):
+        return self.row_columns[row] is None
+    def GetValue(self, row, col):
+        if self.row_columns[row] is None:
+            return ""
+        value = self.get_number(row, col)
+        if value is None:
+            return "" if col == 0 else "None"
+        return "%.2f" % value
+    def SetValue(self, row, col, value):
+        pass # read-only
+    def GetRowLabelValue(self, row):
+        return str(self.row_titles[row])
+    def GetColLabelValue(self, col):
+        return self.column_labels[col]
+    def GetAttr(self, row, col, kind):
+        if col != 0:
+            return None
+        highlight = self.get_entry_highlight(row)
+        if highlight is None:
+            return None
+        attr = self.attrs.get(highlight)
+        if attr is None:
+            attr = self.attrs[highlight] = wx.grid.GridCellAttr()
+            attr.SetBackgroundColour(highlight)
+        attr.IncRef() # the grid releases it after painting
+        return attr
+
     def get_row_label_size(self):
+        if not self.row_titles:
+            return 0
         return max([len(x) for x in self.row_titles]) * 6
     def get_entry_highlight(self, row):
-        if self.data[row][0] is None:
+        current = self.get_number(row, 0)
+        minimum = self.get_number(row, 1)
+        maximum = self.get_number(row, 2)
+        if current is None:
             # if no meal nutrition data available for current entry
             return None
-        if self.data[row][1] is None and self.data[row][2] is None:
+        if minimum is None and maximum is None:
             # if no min or max data is available color the cell grey
             return (169, 169, 169)
-        a = self.data[row][0] > self.data[row][1] or self.data[row][1] is None
-        b = self.data[row][0] < self.data[row][2] or self.data[row][2] is None
+        a = minimum is None or current > minimum
+        b = maximum is None or current < maximum
         if a and b:
             # if the current entry is greater than the min and less than the
             # max, color the cell green
             return (151, 252, 151)
-        else:
-            if self.data[row][2] is not None and \
-               self.data[row][2] < self.data[row][0]:
-                # if the current entry has exceeded the max allowance color it
-                # red
-                return (255, 0, 0)
-    def get_value(self,row,col):
-        ## ** ambiguous name
-        return self.data[row][col]
+        if maximum is not None and maximum < current:
+            # if the current entry has exceeded the max allowance color it
+            # red
+            return (255, 0, 0)
+        return None
     
 
+class SearchResultsList(wx.ListCtrl):
+    ## A virtual list: it only holds the result names and the control asks
+    ## for the few rows it's showing, so thousands of results don't block
+    ## the GUI the way filling a ListBox does.
+    def __init__(self, parent, size):
+        wx.ListCtrl.__init__(self, parent=parent, id=-1, size=size,
+                             style=wx.LC_REPORT | wx.LC_VIRTUAL |
+                                   wx.LC_NO_HEADER)
+        self.InsertColumn(0, 'food', width=size[0] - 25)
+        self.names = []
+
+    def set_names(self, names):
+        self.names = names
+        for item in self.get_selections():
+            self.Select(item, False)
+        self.SetItemCount(len(names))
+        self.Refresh()
+
+    def OnGetItemText(self, item, col):
+        return self.names[item]
+
+    def get_selections(self):
+        selections = []
+        item = self.GetFirstSelected()
+        while item != -1:
+            selections.append(item)
+            item = self.GetNextSelected(item)
+        return selections
+
+    def get_selected_names(self):
+        return [self.names[i] for i in self.get_selections()]
+
+
+def extends_search(old_text, new_text):
+    """ True if new_text has as many terms as old_text and each of them
+        starts with the old term, so its results are among old_text's.
+        """
+    old_terms, new_terms = old_text.split(' '), new_text.split(' ')
+    return len(old_terms) == len(new_terms) and \
+           all(new.startswith(old) for old, new in zip(old_terms, new_terms))
+
+class SearchWorker(object):
+    ## Runs the live searches in a background thread.  Only the newest
+    ## request is kept (requests made while a search runs replace each
+    ## other), results go to 'callback' on the GUI thread with the request's
+    ## generation number so the GUI can drop any that are already stale.
+    def __init__(self, callback):
+        self.callback = callback
+        self.condition = threading.Condition()
+        self.pending = None
+        thread = threading.Thread(target=self._run, name="perfectmeal-search")
+        thread.daemon = True
+        thread.start()
+
+    def submit(self, generation, text, food_groups, candidates=None):
+        with self.condition:
+            self.pending = (generation, text, food_groups, candidates)
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.pending is None:
+                    self.condition.wait()
+                request, self.pending = self.pending, None
+            generation, text, food_groups, candidates = request
+            try:
+                names, rows = perfmeal.search_like_rows(text, food_groups,
+                                                        candidates)
+            except Exception:
+                names, rows = [], None
+            wx.CallAfter(self.callback, generation, text, food_groups, names,
+                         rows)
+
+
 class InteractivePanel(scrolled.ScrolledPanel):
     ## Essentially everything except the menubar, menu items, etc.
     ## Has become unruly, could possibly be broken up.
@@ -97,7 +282,12 @@ class InteractivePanel(scrolled.ScrolledPanel):
         self.current_meal = perfmeal.get_meal([])
         self.body_weight = 150
         self.min_vals, self.max_vals = None, None
+        self.complete_meal_progress = None # dialog while a search runs
+        self.search_generation = 0 # number of the newest live search
+        self.last_search = None # (text, food groups, rows) on display
+        self.search_worker = SearchWorker(self.OnSearchResults)
 
+        perfmeal.warm_up() # load the food database while the disclaimer is up
         self.show_warning() # show disclaimer
         
         self.build_UI()
@@ -143,8 +333,16 @@ http://ashleyw.co.uk/project/food-nutrient-database\nfor more info."
         self.Bind(wx.EVT_BUTTON, self.OnRemoveSelected, id=2)
         self.Bind(wx.EVT_BUTTON, self.OnAddToMeal, id=3)
         self.Bind(wx.EVT_BUTTON, self.OnGo, id=4)
+        self.Bind(wx.EVT_BUTTON, self.OnUndo, id=5)
+        self.Bind(wx.EVT_BUTTON, self.OnRedo, id=6)
         self.Bind(wx.EVT_BUTTON, self.OnCompleteMeal, id=500) #choose better id
         self.Bind(wx.EVT_BUTTON, self.OnUseSelectedFoodgroups, id=700)
+        ## live search: typing restarts the timer, the search runs when it
+        ## goes off
+        self.search_timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.OnSearchTimer, self.search_timer)
+        self.search_textbox.Bind(wx.EVT_TEXT, self.OnSearchText)
+        self.search_textbox.Bind(wx.EVT_TEXT_ENTER, self.OnGo)
         
     def make_nutr_grid_data_table(self):
         """ Creates the data backend for the Nutritional Grid
@@ -153,78 +351,30 @@ http://ashleyw.co.uk/project/food-nutrient-database\nfor more info."
         self.nutr_grid_data.set_parent(self) # so it can freely access local data
         self.min_vals, self.max_vals = \
                        perfmeal.get_benchmarks()
-        self.nutr_grid_data.refresh_data()
+        self.nutr_grid_data.refresh()
         
     def add_nutritional_grid(self):
-        """ Creates the Nutritional Grid and requests the creation of the
-            corresponding data table """
+        """ Creates the Nutritional Grid and its (virtual) data table """
         #self.nutr_grid_panel = wx.Panel(parent=self.panel)
         self.nutritional_grid = wx.grid.Grid(self)
         self.make_nutr_grid_data_table()
-        
         self.nutritional_groupings = self.get_nutrient_groups()
-        rows = self.nutr_grid_data.get_number_rows()
-        columns = self.nutr_grid_data.get_number_cols()
-        
-        
-        self.nutritional_grid.CreateGrid(rows, columns)
-        self.nutritional_grid.SetRowLabelSize(self.nutr_grid_data.get_row_label_size())
-        self.nutritional_grid.SetColLabelValue(0,'current')
-        self.nutritional_grid.SetColLabelValue(1,'min')
-        self.nutritional_grid.SetColLabelValue(2,'max')
 
-        self.display_nutr_grid_vals()
+        # the grid doesn't own the table, the panel keeps it alive
+        self.nutritional_grid.SetTable(self.nutr_grid_data, False)
+        self.nutritional_grid.EnableEditing(False)
+        self.nutritional_grid.SetRowLabelSize(self.nutr_grid_data.get_row_label_size())
 
         self.sizer.Add(self.nutritional_grid,
                        pos=(0,0),
                        span=(100,4))
         self.sizer.Layout() # needed for updating the grid
-        
-    def remove_nutritional_grid(self):
-        """ Needed for hard resets of the grid.
-            """
-        self.sizer.Remove(self.nutritional_grid)
-        self.nutritional_grid.Destroy()
-        
-    def display_nutr_grid_vals(self):
-        """ Populates the Nutritional Grid"""
-        self.nutr_grid_data.refresh_data()
-        rows = self.nutr_grid_data.get_number_rows()
-        columns = self.nutr_grid_data.get_number_cols()
-        for i in range(rows):
-            for j in range(columns):
-                try:
-                    # this throws an error on windows machines (not Debian)
-                    val = self.nutr_grid_data.get_value(i,j)
-                    if type(val) is int or type(val) is float:
-                        val = "%.2f" % self.nutr_grid_data.get_value(i,j)
-                    else:
-                        if j != 0 and i != 0:
-                            val = "None"
-                    self.nutritional_grid.SetCellValue(i,
-                                                       j,
-                                                       val)
-                except:
-                    pass
-        for i in range(rows):
-            self.nutritional_grid.SetRowLabelValue(i,
-                                                   str(self.nutr_grid_data.get_row_label(i)))
-        self.highlight_nuntritional_grid()
-
-    def highlight_nuntritional_grid(self):
-        for row_num in range(self.nutr_grid_data.get_number_rows()):
-            highlight = self.nutr_grid_data.get_entry_highlight(row_num)
-            if highlight is not None:
-                self.nutritional_grid.SetCellBackgroundColour(row_num,
-                                                              0,
-                                                              highlight)
-
-    def reset_nutr_grid(self):
-        """ Destroys old grid and creates a new one."""
-        # the preferred message passing method for updating the grid line by
-        # line was getting out of hand.
-        self.remove_nutritional_grid()
-        self.add_nutritional_grid()
+
+    def refresh_nutr_grid(self):
+        """ Updates the Nutritional Grid after the meal or the nutritional
+            groupings change, repainting only what changed """
+        self.nutritional_groupings = self.get_nutrient_groups()
+        self.nutr_grid_data.refresh()
 
 
     def show_bodyweight_message(self):
@@ -256,6 +406,12 @@ moment))" % (self.body_weight)
         self.current_meal_delete_button = wx.Button(parent=self.panel,
                                                     id=2,
                                                     label='Remove Selected')
+        self.current_meal_undo_button = wx.Button(parent=self.panel,
+                                                  id=5,
+                                                  label='Undo')
+        self.current_meal_redo_button = wx.Button(parent=self.panel,
+                                                  id=6,
+                                                  label='Redo')
         
         self.current_meal_complete_button = wx.Button(parent=self.panel,
                                                       id=500,
@@ -277,7 +433,17 @@ moment))" % (self.body_weight)
                        span=(12,1),
                        flag=wx.TOP,
                        border=5)
-        self.sizer.Add(self.current_meal_delete_button,
+        self.current_meal_edit_sizer = wx.BoxSizer(wx.HORIZONTAL)
+        self.current_meal_edit_sizer.Add(self.current_meal_undo_button,
+                                         flag=wx.ALIGN_CENTER,
+                                         border=0)
+        self.current_meal_edit_sizer.Add(self.current_meal_redo_button,
+                                         flag=wx.ALIGN_CENTER,
+                                         border=0)
+        self.current_meal_edit_sizer.Add(self.current_meal_delete_button,
+                                         flag=wx.ALIGN_CENTER,
+                                         border=0)
+        self.sizer.Add(self.current_meal_edit_sizer,
                        pos=(13,5),
                        flag=wx.ALIGN_RIGHT,
                        border=0)
@@ -302,14 +468,12 @@ moment))" % (self.body_weight)
                                           label="Search Database")
         self.search_textbox = wx.TextCtrl(parent=self.panel,
                                           id=-1,
-                                          size=(275, -1))
+                                          size=(275, -1),
+                                          style=wx.TE_PROCESS_ENTER)
         self.search_textbox.SetValue('Start by typing a food here!')
         self.search_button = wx.Button(parent=self.panel, id=4, label="go")
-        self.search_listbox = wx.ListBox(parent=self.panel,
-                                         id=-1,
-                                         size=(275,300),
-                                         choices=[],
-                                         style=wx.LB_MULTIPLE)
+        self.search_listbox = SearchResultsList(parent=self.panel,
+                                                size=(275,300))
 
         self.search_addto_button = wx.Button(parent=self.panel,
                                              id=3,
@@ -405,10 +569,38 @@ moment))" % (self.body_weight)
     ## methods bound to a button are CapitalCamelCased and start with "On"
     ## (builtin wx methods also cased this way)
     def OnGo(self, event):
-        # go is the search button
+        # go is the search button (and Enter in the search box)
+        self.search_timer.Stop()
+        self.start_search()
+
+    def OnSearchText(self, event):
+        self.search_timer.Start(SEARCH_DELAY, wx.TIMER_ONE_SHOT)
+
+    def OnSearchTimer(self, event):
+        self.start_search()
+
+    def start_search(self):
+        """ Hands the search box's text to the search worker.  If it only
+            adds letters to the search on display, only that search's
+            results are searched.
+            """
         text = self.search_textbox.GetValue()
-        names = perfmeal.search_like(text, self.food_groupings)
-        self.search_listbox.Set(names)
+        food_groups = list(self.food_groupings)
+        candidates = None
+        if self.last_search is not None:
+            last_text, last_groups, last_rows = self.last_search
+            if last_rows is not None and last_groups == food_groups and \
+               extends_search(last_text, text):
+                candidates = last_rows
+        self.search_generation += 1
+        self.search_worker.submit(self.search_generation, text, food_groups,
+                                  candidates)
+
+    def OnSearchResults(self, generation, text, food_groups, names, rows):
+        if generation != self.search_generation:
+            return # a newer search has started since
+        self.last_search = (text, food_groups, rows)
+        self.search_listbox.set_names(names)
         
     def OnRemoveSelected(self, event):
         # remove selected items from the current meal listbox and meal object
@@ -416,26 +608,43 @@ moment))" % (self.body_weight)
         to_remove_raw = self.current_meal_listbox.GetStrings()
         to_remove_strings = [x.split('--')[1] for x in to_remove_raw]
         names = [to_remove_strings[i] for i in to_remove_indexes]
+        if not names:
+            return
+        self.current_meal.checkpoint()
         for food_name in names:
             self.current_meal.subtract(food_name)
         self.current_meal_listbox.Set(self.current_meal.get_servings_and_foods())
 
-        self.reset_nutr_grid()
+        self.refresh_nutr_grid()
             
     def OnAddToMeal(self, event):
         """ Adds foods from the search results box to the current meal listbox
             and current meal object
             """
-        to_add_indexes = self.search_listbox.GetSelections()
-        to_add_strings = self.search_listbox.GetStrings()
-        names = [to_add_strings[i] for i in to_add_indexes]
-        for food_name in names:
-            new_food = perfmeal.get_food(food_name)
+        names = self.search_listbox.get_selected_names()
+        if not names:
+            return
+        self.current_meal.checkpoint()
+        for new_food in perfmeal.get_foods(names):
             self.current_meal.add(new_food)
         self.current_meal_listbox.Set(self.current_meal.get_servings_and_foods())
 
-        self.reset_nutr_grid()
+        self.refresh_nutr_grid()
             
+    def OnUndo(self, event):
+        # step the current meal back to before the last add, remove or
+        # completion
+        if self.current_meal.undo():
+            self.refresh_current_meal()
+
+    def OnRedo(self, event):
+        if self.current_meal.redo():
+            self.refresh_current_meal()
+
+    def refresh_current_meal(self):
+        self.current_meal_listbox.Set(self.current_meal.get_servings_and_foods())
+        self.refresh_nutr_grid()
+
     def OnUseSelected(self, event):
         # nutrient groupings listbox action
         new_groupings = self.get_nutrient_groups()
@@ -445,8 +654,7 @@ moment))" % (self.body_weight)
            "amino_acids" not in self.nutritional_groupings:
             # if Amino Acids are being added to the mix, prompt for body weight
             self.show_bodyweight_message()
-        self.display_nutr_grid_vals()
-        self.reset_nutr_grid()
+        self.refresh_nutr_grid()
 
     def OnUseSelectedFoodgroups(self, event):
         # food groupings listbox action
@@ -461,15 +669,8 @@ moment))" % (self.body_weight)
         pass
 
     def OnCompleteMeal(self, event):
-        ## display popup
-        text = 'This may take some time.  Continue?'
-        dialog = wx.MessageDialog(None,
-                                  text,
-                                  'Complete Meal',
-                                  wx.OK | wx.CANCEL | wx.ICON_INFORMATION)
-        if dialog.ShowModal() == wx.ID_CANCEL:
-            return
-
+        ## the search runs in a worker thread, it reports each step back
+        ## through wx.CallAfter and checks the cancel flag between steps
         cur_alg = self.complete_meal_alg_dropdown.GetValue()
         if cur_alg == "Available algorithms":
             no_alg_dialog = wx.MessageDialog(None,
@@ -485,18 +686,73 @@ moment))" % (self.body_weight)
                                              wx.OK | wx.ICON_INFORMATION)
             if no_food_dialog.ShowModal():
                 return
-        
-        new_meal = perfmeal.complete_meal(self.current_meal, self.min_vals,
-                                          self.max_vals, cur_alg,
-                                          self.get_food_groups())
-        if new_meal != None:
-            self.current_meal = new_meal
-        else:
-            pass
-            ##print 'new_meal is None'
+
+        self.current_meal_complete_button.Disable()
+        self.complete_meal_cancel = threading.Event()
+        self.complete_meal_progress = wx.ProgressDialog(
+            'Complete Meal',
+            'Searching for foods...',
+            maximum=ackpl.max_steps,
+            parent=self,
+            style=wx.PD_APP_MODAL | wx.PD_CAN_ABORT | wx.PD_ELAPSED_TIME)
+        worker = threading.Thread(target=self.complete_meal_worker,
+                                  args=(self.current_meal.copy(),
+                                        self.min_vals, self.max_vals,
+                                        cur_alg, self.get_food_groups(),
+                                        self.complete_meal_cancel))
+        worker.daemon = True
+        worker.start()
+
+    def complete_meal_worker(self, meal, min_vals, max_vals, algorithm,
+                             food_groups, cancel):
+        # runs in the worker thread, must not touch any widgets directly
+        def progress(step, score):
+            wx.CallAfter(self.OnCompleteMealProgress, step, score)
+            return not cancel.is_set()
+        try:
+            new_meal = perfmeal.complete_meal(meal, min_vals, max_vals,
+                                              algorithm, food_groups,
+                                              progress=progress)
+        except Exception:
+            wx.CallAfter(self.OnCompleteMealDone, None, cancel,
+                         sys.exc_info()[1])
+            raise
+        wx.CallAfter(self.OnCompleteMealDone, new_meal, cancel, None)
+
+    def OnCompleteMealProgress(self, step, score):
+        dialog = self.complete_meal_progress
+        if dialog is None or self.complete_meal_cancel.is_set():
+            return
+        result = dialog.Update(min(step, ackpl.max_steps - 1),
+                               'Step %d, score %.4g' % (step, score))
+        # wx returns (continue, skip) on newer versions, a bool on older ones
+        if isinstance(result, tuple):
+            result = result[0]
+        if not result:
+            self.complete_meal_cancel.set()
+
+    def OnCompleteMealDone(self, new_meal, cancel, error):
+        if self.complete_meal_progress is not None:
+            self.complete_meal_progress.Destroy()
+            self.complete_meal_progress = None
+        self.current_meal_complete_button.Enable()
+        if error is not None:
+            wx.MessageDialog(None, 'Complete Meal failed: %s' % error,
+                             'Error', wx.OK | wx.ICON_ERROR).ShowModal()
+            return
+        if cancel.is_set():
+            return
+        if new_meal is None:
+            wx.MessageDialog(None,
+                             'No meal within the limits was found',
+                             'Complete Meal',
+                             wx.OK | wx.ICON_INFORMATION).ShowModal()
+            return
+        ## keep the same Meal so the completion can be undone
+        self.current_meal.checkpoint()
+        self.current_meal.restore(new_meal.snapshot())
         self.current_meal_listbox.Set(self.current_meal.get_servings_and_foods())
-        self.display_nutr_grid_vals()
-        self.reset_nutr_grid()
+        self.refresh_nutr_grid()
         
     def get_nutrient_groups(self):
         indexes = self.nutrient_groups_listbox.GetSelections()
@@ -516,6 +772,7 @@ moment))" % (self.body_weight)
 ##  
 ##  Add To Meal Button: id=3
 ##  Remove Selected Button: id=2
+##  Undo / Redo Buttons: id=5, id=6
 ##  Use Selected (Nutrient Groupings)Button: id=1 
 ##  Nutrient Value Textboxes: id=500
 ##
@@ -570,9 +827,9 @@ Hopefully in the future, with help, this program will offer sound advice."
     def OnHelp(self, e):
         """ Help menu """
         text = """Start by typing a food to search for in the search box on \
-the upper right hand corner of the screen.  Then click the "Go" button.  A \
-list of matching foods will be displayed that you can select and add to the \
-current meal.  If you would like to narrow your search the listbox on the \
+the upper right hand corner of the screen.  A list of matching foods will \
+be displayed as you type (or when you click the "Go" button) that you can \
+select and add to the current meal.  If you would like to narrow your search the listbox on the \
 lower right corner will allow you to choose which food groups you want to \
 consider.  You need to press the update button for these changes to take \
 effect.  You may also change the nuntrients that are displayed on the left \
@@ -598,7 +855,11 @@ of the others.
     def OnExit(self, e):
         self.Close(True)
 
-app = wx.App()
-MainWindow(None, title="Perfect Meal - alpha")
-app.MainLoop()
+if __name__ == '__main__':
+    ## the scoring pool's worker processes import this module on Windows,
+    ## they mustn't open windows of their own
+    multiprocessing.freeze_support()
+    app = wx.App()
+    MainWindow(None, title="Perfect Meal - alpha")
+    app.MainLoop()
 
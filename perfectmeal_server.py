@@ -0,0 +1,576 @@
+## Perfect Meal HTTP Server
+## Author: Christopher Olsen
+## Copyright: 2013
+## License: GNU GPL v3
+##
+
+## A JSON over HTTP front end to perfectmeal, for running it behind a web
+## backend instead of importing it per request.
+##
+##   GET  /search?q=chicken+breast[&group=Poultry+Products...][&limit=50]
+##            {"names": [...]}
+##   GET  /food?name=...[&grouping=elements...]
+##            the food, with its nutrients
+##   POST /meal  {"foods": [names], "groupings": [...]}
+##            the meal, with its nutrient totals
+##   GET  /benchmarks?[grouping=...][&body_weight=70][&period=day]
+##            the minimum and maximum allowances
+##   POST /complete  a perfectmeal.complete_meals request, plus
+##                   "stream": true for progress
+##            {"meal": the completed meal or null, "error": null}
+##
+## With "stream": true /complete answers with chunked, newline delimited
+## JSON events: "queued", then "progress" (step and score from the search,
+## at most every PROGRESS_INTERVAL seconds) or "waiting" (every HEARTBEAT
+## seconds without progress), and finally "done" with the meal or error
+## and "code", the HTTP status the same request would have got without
+## streaming.  A streaming completion whose client goes away is stopped.
+##
+## Problems with a request are answered with 400 (404 for unknown foods
+## outside of /complete), anything going wrong in the server with 500.
+##
+## Python 2 has no event loop library, so requests are handled by threads
+## (SocketServer.ThreadingMixIn) that only parse, look things up and wait.
+## Completions are CPU bound and run in a pool of worker processes.  The
+## database is loaded once in the server process, before the workers start,
+## and once more by each worker if it isn't inherited.
+##
+## usage:
+##   python perfectmeal_server.py --port 8080 --processes 4
+
+import argparse
+import BaseHTTPServer
+import itertools
+import json
+import multiprocessing
+import os
+import Queue
+import SocketServer
+import socket
+import threading
+import urlparse
+from multiprocessing.pool import ThreadPool
+from timeit import default_timer
+
+import ackpl
+import nutrient_matrix
+import perfectmeal
+
+PROGRESS_INTERVAL = .5 # seconds between progress events of one completion
+HEARTBEAT = 5. # seconds without progress before a "waiting" event
+MAX_BODY = 1 << 20 # bytes, for POST bodies
+CANCEL_SLOTS = 1024 # cancel flags shared with the workers, one per job
+
+
+class RequestError(Exception):
+    """ A request the server can't answer, sent back as {"error": message}
+        with the HTTP status 'code'.
+        """
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+
+
+#############################################################################
+############################## completions ##################################
+#############################################################################
+
+_progress_queue = None # the pool's progress queue, set in each worker
+_cancelled = None # the pool's cancel flags, set in each worker
+
+def _init_worker(progress_queue, cancelled):
+    global _progress_queue, _cancelled
+    _progress_queue = progress_queue
+    _cancelled = cancelled
+    perfectmeal.get_database()
+
+def _progress_reporter(job_id, slot):
+    # a complete_meal progress callback sending (job id, step, score) back
+    # to the server, throttled to one message per PROGRESS_INTERVAL.  It
+    # stops the search once the job's cancel flag is set.
+    last = [0.]
+    def _progress(step, score):
+        if _cancelled[slot]:
+            return False
+        now = default_timer()
+        if now - last[0] >= PROGRESS_INTERVAL:
+            last[0] = now
+            _progress_queue.put((job_id, step, score))
+    return _progress
+
+def _run_job(job):
+    # returns (food ids or None, error message or None, True if the error
+    # is the server's rather than the request's)
+    job_id, slot, request, engine, stream = job
+    progress = _progress_reporter(job_id, slot) if stream else None
+    try:
+        food_ids, error = perfectmeal.run_request(request, engine, progress)
+    except Exception as e:
+        return None, '%s: %s' % (type(e).__name__, e), True
+    return food_ids, error, False
+
+class CompletionPool(object):
+    def __init__(self, processes=None, engine="array"):
+        """ Runs complete_meals requests in 'processes' worker processes
+            (None for one per CPU, 0 for a single thread of this process).
+            """
+        self.engine = engine
+        if processes == 0:
+            self.progress_queue = Queue.Queue()
+        else:
+            self.progress_queue = multiprocessing.Queue()
+        self.cancelled = multiprocessing.RawArray('b', CANCEL_SLOTS)
+        initargs = (self.progress_queue, self.cancelled)
+        ## requests that start worker processes of their own, which the
+        ## pool's (daemonic) workers aren't allowed to do, run in a thread
+        ## of the server process instead, it only waits on their workers
+        self.threads = ThreadPool(1, _init_worker, initargs)
+        if processes == 0:
+            self.pool = self.threads
+        else:
+            self.pool = multiprocessing.Pool(processes, _init_worker,
+                                             initargs)
+        self._events = {} # job id -> Queue of its events
+        self._slots = {} # job id -> its cancel flag
+        self._free_slots = range(CANCEL_SLOTS)
+        self._lock = threading.Lock()
+        self._slot_freed = threading.Condition(self._lock)
+        self._job_ids = itertools.count()
+        self._router = threading.Thread(target=self._route_progress,
+                                        name="perfectmeal-progress")
+        self._router.daemon = True
+        self._router.start()
+
+    def _route_progress(self):
+        while True:
+            message = self.progress_queue.get()
+            if message is None:
+                return
+            job_id, step, score = message
+            with self._lock:
+                events = self._events.get(job_id)
+            if events is not None:
+                events.put(('progress', step, score))
+
+    def submit(self, request, stream=False):
+        """ Starts a completion.  Returns (job id, AsyncResult, events), the
+            events Queue gets ('progress', step, score) while it runs (if
+            stream) and ('done', food ids or None, error, internal) when
+            it's finished, internal is True if the error isn't the
+            request's fault.
+            Each running job holds one of CANCEL_SLOTS cancel flags, with
+            all of them taken submit waits for a job to finish.
+            """
+        job_id = next(self._job_ids)
+        events = Queue.Queue()
+        with self._lock:
+            while not self._free_slots:
+                self._slot_freed.wait()
+            slot = self._free_slots.pop()
+            self._slots[job_id] = slot
+            self._events[job_id] = events
+        self.cancelled[slot] = 0
+        def _finished(result):
+            self._release(job_id)
+            events.put(('done',) + tuple(result))
+        pool = self.pool
+        if perfectmeal.starts_processes(request, self.engine):
+            pool = self.threads
+        result = pool.apply_async(
+            _run_job, ((job_id, slot, request, self.engine, stream),),
+            callback=_finished)
+        return job_id, result, events
+
+    def cancel(self, job_id):
+        """ Stops a streaming completion nobody is waiting for anymore (at
+            its next progress report), freeing its worker.
+            """
+        with self._lock:
+            slot = self._slots.get(job_id)
+            if slot is not None:
+                self.cancelled[slot] = 1
+            self._events.pop(job_id, None)
+
+    def _release(self, job_id):
+        # the job is finished, its cancel flag can go to another one
+        with self._lock:
+            self._events.pop(job_id, None)
+            slot = self._slots.pop(job_id, None)
+            if slot is not None:
+                self._free_slots.append(slot)
+                self._slot_freed.notify()
+
+    def wait(self, job_id, result, events, timeout=HEARTBEAT):
+        """ Yields the events of a submitted completion, and ('waiting',)
+            after every 'timeout' seconds without one, up to and including
+            'done'.
+            """
+        while True:
+            try:
+                event = events.get(timeout=timeout)
+            except Queue.Empty:
+                if result.ready() and not result.successful():
+                    ## the worker failed outside of run_request
+                    self._release(job_id)
+                    try:
+                        result.get()
+                    except Exception as e:
+                        yield ('done', None,
+                               '%s: %s' % (type(e).__name__, e), True)
+                    return
+                yield ('waiting',)
+                continue
+            yield event
+            if event[0] == 'done':
+                return
+
+    def close(self):
+        for pool in set([self.pool, self.threads]):
+            pool.terminate()
+            pool.join()
+        self.progress_queue.put(None)
+
+
+#############################################################################
+################################ JSON views #################################
+#############################################################################
+
+def _number(value):
+    # scores can be numpy numbers or infinite, JSON gets a float or null
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    if value != value or value in (float('inf'), float('-inf')):
+        return None
+    return value
+
+def nutrients_json(food):
+    """ {grouping: {nutrient: value or None}} for the food's groupings """
+    return dict((group, dict(food.d(group).items()))
+                for group in food.nutritional_groupings)
+
+def food_json(food):
+    return {'id': food.food_id, 'name': food.get_name(),
+            'serving_size': food.serving_size, 'unit': food.unit,
+            'nutrients': nutrients_json(food)}
+
+def meal_json(meal):
+    if meal is None:
+        return None
+    return {'foods': [{'id': food.food_id, 'name': food.get_name(),
+                       'servings': servings,
+                       'serving_size': food.serving_size,
+                       'unit': food.unit}
+                      for food, servings in meal.servings()],
+            'nutrients': nutrients_json(meal)}
+
+
+#############################################################################
+############################## request parsing ##############################
+#############################################################################
+
+def _text(value):
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return value
+
+def _groupings(values, default):
+    if not values:
+        return list(default)
+    for value in values:
+        if value not in nutrient_matrix.ALL_GROUPINGS:
+            raise RequestError(400, 'unknown grouping: %s' % value)
+    return [str(value) for value in values]
+
+def _food_groups(values):
+    if not values:
+        return list(perfectmeal.the_groups)
+    for value in values:
+        if value not in perfectmeal.the_groups:
+            raise RequestError(400, 'unknown food group: %s' % value)
+    return [str(value) for value in values]
+
+def _optional_number(value, name, kind=float):
+    if value is None:
+        return None
+    try:
+        return kind(value)
+    except (TypeError, ValueError):
+        raise RequestError(400, '%s must be a number' % name)
+
+def _one(query, name, default=None):
+    values = query.get(name)
+    if not values:
+        return default
+    return values[-1]
+
+def _food_names(body):
+    foods = body.get('foods', [])
+    if not isinstance(foods, list) or \
+       not all(isinstance(name, basestring) for name in foods):
+        raise RequestError(400, 'foods must be a list of names')
+    return foods
+
+def completion_request(body):
+    """ Checks a /complete body and returns the complete_meals request """
+    foods = _food_names(body)
+    if not foods:
+        ## ackpl completes a meal, it can't start from nothing
+        raise RequestError(400, 'foods must name at least one food')
+    algorithm = body.get('algorithm', 'greedy_balance')
+    if algorithm not in ackpl.algorithm_names():
+        raise RequestError(400, 'unknown algorithm: %s' % algorithm)
+    request = {'foods': foods, 'algorithm': str(algorithm),
+               'food_groups': _food_groups(body.get('food_groups')),
+               'groupings': _groupings(body.get('groupings'),
+                                       perfectmeal.DEFAULT_GROUPINGS)}
+    for name in ('body_weight', 'time_limit'):
+        value = _optional_number(body.get(name), name)
+        if value is not None:
+            request[name] = value
+    return request
+
+
+#############################################################################
+################################## server ###################################
+#############################################################################
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive and chunked streaming
+    server_version = 'PerfectMeal/1.0'
+
+    GET_ROUTES = {'/search': 'get_search', '/food': 'get_food',
+                  '/benchmarks': 'get_benchmarks'}
+    POST_ROUTES = {'/meal': 'post_meal', '/complete': 'post_complete'}
+
+    def do_GET(self):
+        self._dispatch(self.GET_ROUTES)
+
+    def do_POST(self):
+        self._dispatch(self.POST_ROUTES)
+
+    def _dispatch(self, routes):
+        url = urlparse.urlparse(self.path)
+        try:
+            if url.path not in routes:
+                raise RequestError(404, 'no such endpoint: %s' % url.path)
+            method = getattr(self, routes[url.path])
+            method(urlparse.parse_qs(url.query))
+        except RequestError as e:
+            self.send_json({'error': str(e)}, e.code)
+        except Exception as e:
+            self.send_json({'error': '%s: %s' % (type(e).__name__, e)}, 500)
+
+    def read_json(self):
+        """ The request body, which has to be a JSON object """
+        length = _optional_number(self.headers.get('Content-Length', 0),
+                                  'Content-Length', int)
+        if length < 0:
+            raise RequestError(400, 'Content-Length must not be negative')
+        if length > MAX_BODY:
+            raise RequestError(413, 'request body too large')
+        try:
+            body = json.loads(self.rfile.read(length) or '{}')
+        except ValueError:
+            raise RequestError(400, 'the request body is not JSON')
+        if not isinstance(body, dict):
+            raise RequestError(400, 'the request body must be a JSON object')
+        return body
+
+    def send_json(self, obj, code=200):
+        body = json.dumps(obj)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    ## a client that goes away leaves part of a response unsent, which the
+    ## base classes try to flush once more
+    def handle(self):
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.handle(self)
+        except socket.error:
+            self.close_connection = 1
+
+    def finish(self):
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+        except socket.error:
+            pass
+
+    def _write_chunk(self, obj):
+        line = json.dumps(obj) + '\n'
+        self.wfile.write('%x\r\n%s\r\n' % (len(line), line))
+        self.wfile.flush()
+
+    ##
+    ## endpoints
+    ##
+
+    def get_search(self, query):
+        search = _one(query, 'q')
+        if not search:
+            raise RequestError(400, 'missing q')
+        limit = _optional_number(_one(query, 'limit'), 'limit', int)
+        names = perfectmeal.search_like(_text(search),
+                                        _food_groups(query.get('group')))
+        self.send_json({'count': len(names), 'names': names[:limit]})
+
+    def get_food(self, query):
+        name = _one(query, 'name')
+        if not name:
+            raise RequestError(400, 'missing name')
+        food = perfectmeal.get_food(_text(name), _groupings(
+            query.get('grouping'), nutrient_matrix.ALL_GROUPINGS))
+        if food is False:
+            raise RequestError(404, 'unknown food: %s' % name)
+        self.send_json(food_json(food))
+
+    def get_benchmarks(self, query):
+        groupings = _groupings(query.get('grouping'),
+                               nutrient_matrix.ALL_GROUPINGS)
+        body_weight = _optional_number(_one(query, 'body_weight'),
+                                       'body_weight')
+        try:
+            profile = perfectmeal.get_benchmark_profile(
+                groupings, body_weight, _one(query, 'period', 'meal'))
+        except ValueError as e:
+            raise RequestError(400, str(e))
+        self.send_json({'groupings': list(profile.groupings),
+                        'body_weight': profile.body_weight,
+                        'period': profile.period,
+                        'minimum': nutrients_json(profile.minimum),
+                        'maximum': nutrients_json(profile.maximum)})
+
+    def post_meal(self, query):
+        body = self.read_json()
+        names = _food_names(body)
+        groupings = _groupings(body.get('groupings'),
+                               nutrient_matrix.ALL_GROUPINGS)
+        meal = perfectmeal.Meal(groupings)
+        for name, food in zip(names, perfectmeal.get_foods(names,
+                                                           groupings)):
+            if food is False:
+                raise RequestError(404, 'unknown food: %s' % name)
+            meal.add(food)
+        self.send_json(meal_json(meal))
+
+    def post_complete(self, query):
+        body = self.read_json()
+        request = completion_request(body)
+        stream = bool(body.get('stream'))
+        completions = self.server.completions
+        job_id, result, events = completions.submit(request, stream)
+        if not stream:
+            for event in completions.wait(job_id, result, events):
+                pass
+            food_ids, error, internal = event[1:]
+            if error is not None:
+                raise RequestError(500 if internal else 400, error)
+            self.send_json({'meal': self._completed_meal(food_ids, request),
+                            'error': None})
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        start = default_timer()
+        try:
+            self._write_chunk({'event': 'queued'})
+            for event in completions.wait(job_id, result, events):
+                elapsed = default_timer() - start
+                if event[0] == 'progress':
+                    self._write_chunk({'event': 'progress',
+                                       'step': int(event[1]),
+                                       'score': _number(event[2]),
+                                       'elapsed': elapsed})
+                elif event[0] == 'waiting':
+                    self._write_chunk({'event': 'waiting',
+                                       'elapsed': elapsed})
+                else:
+                    food_ids, error, internal = event[1:]
+                    code = 200
+                    if error is not None:
+                        code = 500 if internal else 400
+                    self._write_chunk({
+                        'event': 'done', 'elapsed': elapsed, 'error': error,
+                        'code': code,
+                        'meal': self._completed_meal(food_ids, request)})
+            self.wfile.write('0\r\n\r\n')
+        except socket.error:
+            ## the client went away, stop the search and free its worker
+            completions.cancel(job_id)
+            self.close_connection = 1
+        except Exception as e:
+            ## the status line is already sent, end the stream with the
+            ## error instead
+            completions.cancel(job_id)
+            self.close_connection = 1
+            try:
+                self._write_chunk({'event': 'done',
+                                   'elapsed': default_timer() - start,
+                                   'error': '%s: %s' % (type(e).__name__, e),
+                                   'code': 500, 'meal': None})
+                self.wfile.write('0\r\n\r\n')
+            except socket.error:
+                pass
+
+    def _completed_meal(self, food_ids, request):
+        if food_ids is None:
+            return None
+        return meal_json(perfectmeal.meal_from_ids(food_ids,
+                                                   request['groupings']))
+
+
+class MealServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, completions):
+        BaseHTTPServer.HTTPServer.__init__(self, address, RequestHandler)
+        self.completions = completions
+
+    def server_close(self):
+        BaseHTTPServer.HTTPServer.server_close(self)
+        self.completions.close()
+
+def make_server(host='127.0.0.1', port=8080, processes=None, engine="array"):
+    """ Loads the database, starts the completion workers and returns a
+        MealServer bound to (host, port), port 0 picks a free one.  Call its
+        serve_forever() (from any thread) to start answering, and
+        shutdown() and server_close() to stop.
+        """
+    perfectmeal.get_database()
+    completions = CompletionPool(processes, engine)
+    return MealServer((host, port), completions)
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    parser = argparse.ArgumentParser(description="Perfect Meal HTTP server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--processes', type=int, default=None,
+                        help="completion workers (default: one per CPU, "
+                             "0 completes in the server process)")
+    parser.add_argument('--json', default=perfectmeal.json_loc,
+                        help="the food database (default: the USDA file)")
+    parser.add_argument('--result-cache', default=None, metavar='DIRECTORY',
+                        help="keep completed meals on disk, shared by the "
+                             "workers")
+    args = parser.parse_args()
+    perfectmeal.json_loc = args.json
+    if args.result_cache is not None:
+        ## the environment reaches workers that re-import perfectmeal
+        os.environ['PERFECTMEAL_RESULT_CACHE'] = args.result_cache
+        perfectmeal.use_result_disk_cache(args.result_cache)
+    server = make_server(args.host, args.port, args.processes)
+    print 'serving on http://%s:%d/' % server.server_address
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -2,7 +2,8 @@ from distutils.core import setup
 import py2exe
 
 from glob import glob
-data_files = [("", glob(r'C:\Users\cj\Desktop\perfect-meal-master\foods-2011-10-03.json'))]
+data_files = [("", glob(r'C:\Users\cj\Desktop\perfect-meal-master\foods-2011-10-03.json') +
+                   glob(r'C:\Users\cj\Desktop\perfect-meal-master\daily_values.json'))]
 
 setup(
     data_files=data_files,
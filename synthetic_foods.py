@@ -0,0 +1,175 @@
+## Synthetic Foods
+## Author: Christopher Olsen
+## Copyright: 2013
+## License: GNU GPL v3
+##
+
+## Generates food databases of any size in the same JSON format as the USDA
+## file, for stress testing the loader, the search and the algorithms
+## offline.
+##
+## The generator is fitted to a real database first.  Every synthetic food
+## belongs to a food group (drawn with the real group frequencies) and takes
+## the set of nutrients it lists from a real food of that group, so foods
+## keep realistic patterns of missing data.  Each value is drawn from the
+## values the real foods of the group have for that nutrient, with a little
+## noise.  Descriptions, portions and tags are recombined from the group's
+## real ones.
+##
+## usage:
+##   python synthetic_foods.py foods-2011-10-03.json big.json --foods 80000
+
+import argparse
+import json
+
+import numpy as np
+
+FIRST_ID = 1000000 # well clear of the USDA ids
+JITTER = .1 # standard deviation of the (log-normal) noise on the values
+
+
+class GroupProfile(object):
+    def __init__(self, records):
+        """ The nutrient values, nutrient patterns, descriptions, portions
+            and tags of one food group's records.
+            """
+        key_index = {}
+        values = []
+        self.patterns = [] # per record, the indexes of the nutrients it lists
+        for record in records:
+            pattern = []
+            for nutrient in record['nutrients']:
+                key = (nutrient['group'], nutrient['description'],
+                       nutrient['units'])
+                if key not in key_index:
+                    key_index[key] = len(values)
+                    values.append([])
+                values[key_index[key]].append(nutrient['value'])
+                pattern.append(key_index[key])
+            self.patterns.append(np.array(pattern, dtype=np.intp))
+        self.keys = sorted(key_index, key=key_index.get)
+        # the values of nutrient i are values[offsets[i]:offsets[i]+lengths[i]]
+        self.lengths = np.array([len(v) for v in values], dtype=np.intp)
+        self.offsets = np.zeros(len(values), dtype=np.intp)
+        self.offsets[1:] = np.cumsum(self.lengths)[:-1]
+        self.values = np.array([x for v in values for x in v], dtype=float)
+
+        segments = [record['description'].split(', ') for record in records]
+        self.heads = [s[0] for s in segments]
+        self.tails = [t for s in segments for t in s[1:]]
+        self.segment_counts = [len(s) for s in segments]
+        self.portions = [record['portions'] for record in records]
+        self.tags = [record.get('tags', []) for record in records]
+        self.manufacturers = [record.get('manufacturer', '')
+                              for record in records]
+
+    def _pick(self, rng, items):
+        return items[rng.randint(len(items))]
+
+    def description(self, rng):
+        parts = [self._pick(rng, self.heads)]
+        if self.tails:
+            for i in xrange(self._pick(rng, self.segment_counts) - 1):
+                parts.append(self._pick(rng, self.tails))
+        return u', '.join(parts)
+
+    def nutrients(self, rng, density=1., jitter=JITTER):
+        pattern = self._pick(rng, self.patterns)
+        if density < 1.:
+            pattern = pattern[rng.random_sample(len(pattern)) < density]
+        picks = self.offsets[pattern] + \
+                (rng.random_sample(len(pattern)) *
+                 self.lengths[pattern]).astype(np.intp)
+        values = self.values[picks] * rng.lognormal(0., jitter, len(pattern))
+        nutrients = []
+        for i, value in zip(pattern, values):
+            group, description, units = self.keys[i]
+            nutrients.append({'group': group, 'description': description,
+                              'units': units, 'value': round(value, 3)})
+        return nutrients
+
+
+class FoodProfile(object):
+    def __init__(self, records):
+        """ Fits the generator to a list of USDA json objects """
+        by_group = {}
+        for record in records:
+            by_group.setdefault(record['group'], []).append(record)
+        self.groups = sorted(by_group)
+        counts = np.array([len(by_group[g]) for g in self.groups],
+                          dtype=float)
+        self.weights = counts / counts.sum()
+        self.profiles = [GroupProfile(by_group[g]) for g in self.groups]
+        self.size = len(records)
+
+    @classmethod
+    def from_file(cls, json_path):
+        with open(json_path, 'r') as f:
+            return cls(json.load(f))
+
+    def generate(self, count, density=1., seed=None, first_id=FIRST_ID,
+                 jitter=JITTER):
+        """ Yields 'count' synthetic records.
+            density: the chance each nutrient a real food lists is kept (1.
+                     keeps the real database's sparsity, lower is sparser)
+            seed: for reproducible databases
+            Descriptions are unique, repeats get a " (n)" suffix.
+            """
+        rng = np.random.RandomState(seed)
+        group_picks = rng.choice(len(self.groups), size=count,
+                                 p=self.weights)
+        seen = {}
+        for i in xrange(count):
+            profile = self.profiles[group_picks[i]]
+            description = profile.description(rng)
+            repeats = seen.get(description, 0)
+            seen[description] = repeats + 1
+            if repeats:
+                description = u'%s (%d)' % (description, repeats + 1)
+            yield {'id': first_id + i,
+                   'description': description,
+                   'group': self.groups[group_picks[i]],
+                   'manufacturer': profile._pick(rng, profile.manufacturers),
+                   'tags': list(profile._pick(rng, profile.tags)),
+                   'portions': list(profile._pick(rng, profile.portions)),
+                   'nutrients': profile.nutrients(rng, density, jitter)}
+
+
+def write_json(records, out_path):
+    """ Writes an iterable of records as one JSON list, a record at a time """
+    with open(out_path, 'w') as out:
+        out.write('[')
+        for i, record in enumerate(records):
+            if i:
+                out.write(',\n')
+            json.dump(record, out)
+        out.write(']')
+    return out_path
+
+def generate_file(source_path, out_path, count, density=1., seed=None):
+    """ Fits a FoodProfile to source_path and writes 'count' synthetic foods
+        to out_path.  Returns out_path.
+        """
+    profile = FoodProfile.from_file(source_path)
+    return write_json(profile.generate(count, density, seed), out_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Generate a synthetic food database")
+    parser.add_argument('source', help="the real database to imitate")
+    parser.add_argument('output')
+    parser.add_argument('--foods', type=int, default=None,
+                        help="number of foods (default: the source's size)")
+    parser.add_argument('--scale', type=float, default=None,
+                        help="number of foods as a multiple of the source")
+    parser.add_argument('--density', type=float, default=1.,
+                        help="fraction of each real nutrient pattern kept")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    profile = FoodProfile.from_file(args.source)
+    count = args.foods
+    if count is None:
+        count = int(round(profile.size * (args.scale or 1.)))
+    write_json(profile.generate(count, args.density, args.seed), args.output)
+    print 'wrote', count, 'foods to', args.output
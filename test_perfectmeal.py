@@ -0,0 +1,816 @@
+## Tests
+## Author: Christopher Olsen
+## Copyright: 2013
+## License: GNU GPL v3
+##
+
+## Run with "python -m unittest test_perfectmeal".  The tests build a small
+## food database of their own in a temporary directory, the USDA file isn't
+## needed.
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import nutrient_matrix
+import perfectmeal
+
+GROUPS = ['Vegetables and Vegetable Products', 'Beverages']
+GROUPINGS = ['elements', 'vitamins']
+
+_work_dir = None
+
+
+def _daily_scale(grouping, field):
+    # a nutrient's daily minimum (or its maximum, or 1 mg), so that the test
+    # foods take a few servings to make a meal
+    daily = perfectmeal.get_daily_values()
+    for kind in ('minimum', 'maximum'):
+        value = daily[kind].get(grouping, {}).get(field)
+        if value and value != daily['no_limit']:
+            return value
+    return 1.
+
+def make_records(count=40, seed=0):
+    """ count foods with every element and vitamin, in the USDA format """
+    rng = np.random.RandomState(seed)
+    records = []
+    for i in xrange(count):
+        nutrients = [{'group': grouping.capitalize(), 'description': field,
+                      'units': 'mg',
+                      'value': round(_daily_scale(grouping, field) *
+                                     rng.uniform(.02, .08), 4)}
+                     for grouping in GROUPINGS
+                     for field in nutrient_matrix.FIELDS[grouping]]
+        records.append({'id': 1000 + i,
+                        'description': 'Test food %d' % i,
+                        'group': GROUPS[i % len(GROUPS)],
+                        'manufacturer': '', 'tags': [],
+                        'portions': [{'amount': 1, 'unit': 'cup',
+                                      'grams': 100.}],
+                        'nutrients': nutrients})
+    return records
+
+def use_test_database(json_path):
+    perfectmeal.json_loc = json_path
+    perfectmeal._database = None
+    perfectmeal.food_cache.clear()
+    perfectmeal.candidate_cache.clear()
+    perfectmeal.result_cache.memory.clear()
+
+def setUpModule():
+    global _work_dir
+    _work_dir = tempfile.mkdtemp(prefix='perfectmeal-test-')
+    json_path = os.path.join(_work_dir, 'foods.json')
+    with open(json_path, 'w') as f:
+        json.dump(make_records(), f)
+    use_test_database(json_path)
+
+def tearDownModule():
+    shutil.rmtree(_work_dir, ignore_errors=True)
+
+
+def _names(*indexes):
+    return ['Test food %d' % i for i in indexes]
+
+
+def _compile(paths):
+    json_path, store_path = paths
+    return nutrient_matrix.compile_store(json_path, store_path)[1]['checksum']
+
+class NutrientStoreTest(unittest.TestCase):
+    def test_round_trip(self):
+        json_path = os.path.join(_work_dir, 'foods.json')
+        store_path = os.path.join(tempfile.mkdtemp(dir=_work_dir),
+                                  'foods.cache')
+        matrix = nutrient_matrix.compile_store(json_path, store_path)[0]
+        loaded, header = nutrient_matrix.load_store(store_path)
+        self.assertEqual(header['checksum'],
+                         nutrient_matrix.file_checksum(json_path))
+        self.assertTrue(nutrient_matrix.store_is_current(header, json_path))
+        self.assertEqual(len(loaded), 40)
+        np.testing.assert_array_equal(loaded.values, matrix.values)
+        np.testing.assert_array_equal(loaded.serving_sizes,
+                                      matrix.serving_sizes)
+        self.assertEqual(list(loaded.names), list(matrix.names))
+        self.assertEqual(list(loaded.ids), list(matrix.ids))
+        self.assertEqual(list(loaded.groups), list(matrix.groups))
+        self.assertEqual(list(loaded.units), list(matrix.units))
+
+    def test_touched_source(self):
+        store_path = os.path.join(tempfile.mkdtemp(dir=_work_dir),
+                                  'foods.cache')
+        json_path = os.path.join(os.path.dirname(store_path), 'foods.json')
+        shutil.copy(perfectmeal.json_loc, json_path)
+        nutrient_matrix.compile_store(json_path, store_path)
+        mtime = os.stat(json_path).st_mtime + 60
+        os.utime(json_path, (mtime, mtime))
+        header = nutrient_matrix.read_store_header(store_path)
+        self.assertTrue(nutrient_matrix.store_is_current(header, json_path,
+                                                         store_path))
+        header = nutrient_matrix.read_store_header(store_path)
+        self.assertEqual(header['source_mtime'], os.stat(json_path).st_mtime)
+        self.assertFalse([name for name in os.listdir(store_path)
+                          if name.endswith('.tmp')])
+        ## the next check doesn't need the checksum
+        checksum = nutrient_matrix.file_checksum
+        nutrient_matrix.file_checksum = None
+        try:
+            self.assertTrue(nutrient_matrix.store_is_current(header,
+                                                             json_path))
+        finally:
+            nutrient_matrix.file_checksum = checksum
+
+    def test_concurrent_compiles(self):
+        import multiprocessing
+        store_dir = tempfile.mkdtemp(dir=_work_dir)
+        store_path = os.path.join(store_dir, 'foods.cache')
+        jobs = [(perfectmeal.json_loc, store_path)] * 8
+        pool = multiprocessing.Pool(4)
+        try:
+            checksums = pool.map(_compile, jobs, chunksize=1)
+        finally:
+            pool.terminate()
+            pool.join()
+        self.assertEqual(len(set(checksums)), 1)
+        self.assertEqual(os.listdir(store_dir), ['foods.cache'])
+        matrix, header = nutrient_matrix.load_store(store_path)
+        self.assertEqual(header['checksum'], checksums[0])
+        self.assertEqual(len(matrix), 40)
+
+    def test_truncated_store(self):
+        store_dir = tempfile.mkdtemp(dir=_work_dir)
+        store_path = os.path.join(store_dir, 'foods.cache')
+        nutrient_matrix.compile_store(perfectmeal.json_loc, store_path)
+        names_path = os.path.join(store_path, 'names.txt')
+        with open(names_path, 'rb') as f:
+            lines = f.read().split('\n')
+        with open(names_path, 'wb') as f:
+            f.write('\n'.join(lines[:-1]))
+        self.assertRaises(IOError, nutrient_matrix.load_store, store_path)
+        ## the damaged store is compiled again
+        matrix, checksum = nutrient_matrix.load_or_compile(
+            perfectmeal.json_loc, store_path)
+        self.assertEqual(matrix.names[-1], 'Test food 39')
+        self.assertEqual(len(nutrient_matrix.load_store(store_path)[0]), 40)
+        self.assertEqual(sorted(os.listdir(store_dir)), ['foods.cache'])
+
+
+class DiskCacheTest(unittest.TestCase):
+    def setUp(self):
+        import caching
+        self.cache = caching.DiskCache(tempfile.mkdtemp(dir=_work_dir))
+
+    def test_replace(self):
+        self.cache.put('ab', [1, 2, 3])
+        self.cache.put('ab', [4, 5, 6])
+        self.assertEqual(self.cache.get('ab'), [4, 5, 6])
+        self.assertEqual(self.cache._bytes, len(json.dumps([4, 5, 6])))
+
+    def test_failed_write(self):
+        def _fail(*args):
+            raise OSError('disk full')
+        original = os.rename
+        os.rename = _fail
+        try:
+            self.cache.put('ab', [1, 2, 3])
+        finally:
+            os.rename = original
+        self.assertEqual(os.listdir(self.cache.path), [])
+        self.assertEqual(self.cache._bytes, 0)
+        self.assertIsNone(self.cache.get('ab'))
+
+
+class MealTest(unittest.TestCase):
+    def test_totals_and_undo(self):
+        food0, food1, food2 = [
+            food.values for food in perfectmeal.get_foods(_names(0, 1, 2),
+                                                          GROUPINGS)]
+        meal = perfectmeal.get_meal(_names(0, 1, 0), GROUPINGS)
+        cols = meal.columns()
+        def _check(expected):
+            np.testing.assert_allclose(meal.values[cols], expected[cols])
+        _check(2 * food0 + food1)
+        self.assertEqual(sorted((food.get_name(), count)
+                                for food, count in meal.servings()),
+                         [('Test food 0', 2), ('Test food 1', 1)])
+        meal.checkpoint()
+        meal.subtract('Test food 0')
+        meal.add(perfectmeal.get_food('Test food 2', GROUPINGS))
+        _check(food0 + food1 + food2)
+        self.assertTrue(meal.undo())
+        _check(2 * food0 + food1)
+        self.assertEqual([f.get_name() for f in meal.foods], _names(0, 1, 0))
+        self.assertTrue(meal.redo())
+        _check(food0 + food1 + food2)
+        self.assertFalse(meal.redo())
+        ## a nutrient nothing in the meal has a value for reads as missing
+        for name in _names(0, 1, 2):
+            meal.subtract(name)
+        self.assertTrue(np.all(np.isnan(meal.values[cols])))
+
+    def test_foods_follow_changes(self):
+        meal = perfectmeal.get_meal(_names(0, 1, 0), GROUPINGS)
+        self.assertEqual([f.get_name() for f in meal.foods],
+                         _names(0, 1, 0))
+        self.assertIs(meal.foods, meal.foods)
+        meal.subtract('Test food 0')
+        self.assertEqual([f.get_name() for f in meal.foods], _names(1, 0))
+        meal.add(perfectmeal.get_food('Test food 2', GROUPINGS))
+        self.assertEqual([f.get_name() for f in meal.foods],
+                         _names(1, 0, 2))
+
+    def test_shared_names(self):
+        ## two foods (different ids) with one name come out in the order
+        ## they went in
+        first = perfectmeal.get_food('Test food 0', GROUPINGS)
+        second = perfectmeal.get_food('Test food 1', GROUPINGS)
+        second.name = 'Test food 0'
+        meal = perfectmeal.Meal(GROUPINGS, [first, second, first])
+        meal.subtract('Test food 0')
+        meal.subtract('Test food 0')
+        self.assertIs(meal.get_food_by_name('Test food 0'), second)
+        self.assertEqual(meal.foods, [second])
+        meal.subtract('Test food 0')
+        self.assertIs(meal.get_food_by_name('Test food 0'), False)
+        self.assertEqual(meal.foods, [])
+
+    def test_add_to_benchmark(self):
+        ## a Meal built from preset values adds onto them
+        food = perfectmeal.get_food('Test food 1', GROUPINGS)
+        cols = food.columns()
+        for meal in (perfectmeal.make_daily_min(GROUPINGS),
+                     perfectmeal.get_benchmarks(GROUPINGS)[0].copy()):
+            before = meal.values.copy()
+            meal.add(food)
+            np.testing.assert_allclose(
+                meal.values[cols],
+                nutrient_matrix.nan_add(before[cols], food.values[cols]))
+            meal.subtract('Test food 1')
+            np.testing.assert_allclose(meal.values[cols], before[cols])
+
+    def test_difference_totals(self):
+        meal = perfectmeal.get_meal(_names(0, 1, 2), GROUPINGS)
+        other = perfectmeal.get_meal(_names(1), GROUPINGS)
+        diff = meal.difference(other)
+        cols = diff.columns()
+        np.testing.assert_allclose(diff.totals[cols],
+                                   meal.values[cols] - other.values[cols])
+        self.assertTrue(np.all(diff.known[cols] == 1))
+        self.assertEqual(diff.foods, [])
+        ## adding carries on from the difference
+        food = perfectmeal.get_food('Test food 3', GROUPINGS)
+        diff.add(food)
+        np.testing.assert_allclose(
+            diff.values[cols],
+            meal.values[cols] - other.values[cols] + food.values[cols])
+
+
+class BenchmarkTest(unittest.TestCase):
+    def test_amino_acids_for_body_weight(self):
+        groupings = ['elements', 'amino_acids']
+        shared = perfectmeal.get_benchmarks(groupings)[0]
+        before = shared.values.copy()
+        scaled = perfectmeal.add_amino_acids_to_min(shared, 70)
+        np.testing.assert_array_equal(shared.values, before)
+        np.testing.assert_array_equal(
+            scaled.values,
+            perfectmeal.get_benchmark_profile(groupings, 70).minimum.values)
+        self.assertAlmostEqual(scaled.amino_acids['Lysine'],
+                               shared.amino_acids['Lysine'] * .7)
+
+
+def random_problem(rng, negatives=False):
+    """ a small ackp problem with some missing values """
+    keys = ['n%d' % k for k in xrange(rng.randint(2, 6))]
+    def value(low=0.):
+        if rng.uniform() < .15:
+            return None
+        return round(rng.uniform(low, 1.), 3)
+    low = -.2 if negatives else 0.
+    possibilities = [['food %d' % i, dict((key, value(low)) for key in keys)]
+                     for i in xrange(rng.randint(3, 12))]
+    minimums = ('minimums', dict((key, round(rng.uniform(1., 4.), 3))
+                                 for key in keys))
+    maximums = ('maximums', dict(
+        (key, None if rng.uniform() < .2 else
+              round(minimums[1][key] * rng.uniform(1.5, 4.), 3))
+        for key in keys))
+    currents = None
+    if rng.uniform() < .75:
+        currents = [['current', dict((key, value()) for key in keys)]]
+    return possibilities, minimums, maximums, currents
+
+class GreedyEngineTest(unittest.TestCase):
+    def test_engines_pick_alike(self):
+        ## the array engine (with and without its incremental scorers) and
+        ## the parallel one must make the dict engine's picks
+        import ackpl
+        threshold = ackpl.parallel_threshold
+        ackpl.parallel_threshold = 0 # every search goes to the ScoringPool
+        if ackpl._pool is None:
+            ackpl.scoring_processes = 2
+        rng = np.random.RandomState(0)
+        try:
+            for problem in xrange(12):
+                possibilities, minimums, maximums, currents = \
+                    random_problem(rng, negatives=problem % 4 == 3)
+                for algorithm in ackpl.algorithm_names():
+                    if 'greedy' not in algorithm:
+                        continue
+                    picks = {}
+                    for engine in ('dict', 'array', 'parallel'):
+                        meal = ackpl.ackp(
+                            list(possibilities), minimums, maximums,
+                            [list(c) for c in currents] if currents else None,
+                            algorithm, engine=engine)
+                        picks[engine] = [name for name, values in meal]
+                    self.assertEqual(picks['array'], picks['dict'],
+                                     (problem, algorithm))
+                    self.assertEqual(picks['parallel'], picks['dict'],
+                                     (problem, algorithm))
+        finally:
+            ackpl.parallel_threshold = threshold
+
+    def test_balance_scorer(self):
+        ## its cached sums and counts follow a total gaining values
+        import ackpl
+        rng = np.random.RandomState(1)
+        matrix = rng.uniform(0, 1, (30, 12))
+        matrix[rng.uniform(size=matrix.shape) < .3] = np.nan
+        mins = rng.uniform(.5, 2, 12)
+        mins[[3, 7]] = np.nan
+        scorer = ackpl.BalanceScorer(matrix, mins)
+        total = np.empty(12)
+        total.fill(np.nan)
+        rows = np.arange(0, 30, 2)
+        for step in xrange(5):
+            np.testing.assert_allclose(
+                scorer.scores(total, rows),
+                ackpl.balance_scores(mins, ackpl.array_add(total[None, :],
+                                                           matrix[rows])))
+            total = ackpl.array_add(total, matrix[rng.randint(30)])
+
+    def test_dead_scoring_worker(self):
+        ## a search that finds a worker gone fails, the next one gets a new
+        ## pool
+        import ackpl
+        threshold = ackpl.parallel_threshold
+        ackpl.parallel_threshold = 0
+        rng = np.random.RandomState(1)
+        possibilities, minimums, maximums, currents = random_problem(rng)
+        def _search():
+            meal = ackpl.ackp(list(possibilities), minimums, maximums,
+                              [list(c) for c in currents or []] or None,
+                              'greedy_balance', engine='parallel')
+            return [name for name, values in meal]
+        try:
+            expected = _search()
+            broken = ackpl.scoring_pool()
+            broken.processes[0].terminate()
+            broken.processes[0].join()
+            self.assertRaises((EOFError, IOError, OSError), _search)
+            self.assertIsNot(ackpl._pool, broken)
+            self.assertEqual(broken.processes, [])
+            self.assertEqual(_search(), expected)
+            self.assertIsNot(ackpl.scoring_pool(), broken)
+        finally:
+            ackpl.parallel_threshold = threshold
+
+
+class ExactSearchTest(unittest.TestCase):
+    def _problem(self, rng, foods=3, nutrients=3):
+        ## every food reaches every minimum within a few servings
+        matrix = rng.uniform(.3, 1., (foods, nutrients))
+        mins = rng.uniform(1., 2., nutrients)
+        maxs = mins * rng.uniform(1.2, 3., nutrients)
+        costs = rng.uniform(50., 150., foods)
+        return matrix, mins, maxs, costs
+
+    def _brute_force(self, matrix, mins, maxs, costs, objective, limit=21):
+        # the best value over every combination of up to 'limit' servings of
+        # each food (none of these problems needs more), None if none fits
+        import itertools
+        import milp
+        problem = milp.Problem(matrix, mins, maxs, None, costs)
+        grid = np.array(list(itertools.product(xrange(limit + 1),
+                                               repeat=len(matrix))), float)
+        fits = np.all(grid.dot(problem.A.T) <=
+                      problem.b + milp.FEASIBILITY_TOLERANCE, axis=1)
+        if not fits.any():
+            return None
+        return min(milp.OBJECTIVES[objective].value(problem, servings)
+                   for servings in grid[fits])
+
+    def test_optimal(self):
+        import milp
+        rng = np.random.RandomState(0)
+        infeasible = 0
+        for case in xrange(12):
+            matrix, mins, maxs, costs = self._problem(rng)
+            for objective in ('servings', 'mass'):
+                servings, value, optimal = milp.branch_and_bound(
+                    matrix, mins, maxs, None, objective, costs=costs)
+                best = self._brute_force(matrix, mins, maxs, costs,
+                                         objective)
+                self.assertTrue(optimal)
+                if best is None:
+                    infeasible += 1
+                    self.assertIsNone(servings)
+                else:
+                    self.assertAlmostEqual(value, best)
+        self.assertTrue(0 < infeasible < 24) # both kinds were checked
+
+    def test_infeasible(self):
+        import milp
+        ## the minimum needs 2 servings, the maximum allows 1.5
+        matrix = np.array([[1., 1.]])
+        servings, value, optimal = milp.branch_and_bound(
+            matrix, np.array([2., 1.]), np.array([np.nan, 1.5]))
+        self.assertEqual((servings, value, optimal), (None, None, True))
+        ## already over a maximum
+        servings, value, optimal = milp.branch_and_bound(
+            matrix, np.array([2., 1.]), np.array([5., 5.]),
+            total=np.array([0., 6.]))
+        self.assertEqual((servings, value, optimal), (None, None, True))
+
+    def test_time_limit(self):
+        import ackpl
+        import milp
+        matrix, mins, maxs, costs = self._problem(np.random.RandomState(1))
+        servings, value, optimal = milp.branch_and_bound(
+            matrix, mins, maxs, time_limit=-1)
+        self.assertEqual((servings, value, optimal), (None, None, False))
+        keys = ['n0', 'n1', 'n2']
+        possibilities = [['food %d' % i, dict(zip(keys, row))]
+                         for i, row in enumerate(matrix)]
+        report = {}
+        meal = ackpl.ackp(possibilities, ('minimums', dict(zip(keys, mins))),
+                          ('maximums', dict(zip(keys, maxs))), None,
+                          'exact_servings', time_limit=-1, report=report)
+        self.assertIsNone(meal)
+        self.assertFalse(report['optimal'])
+
+    def test_safe_pruning(self):
+        ## the exact searches prune "safe" by themselves, it mustn't make
+        ## their meals any worse
+        import ackpl
+        ## the only data for b is P2's zero, pruning P2 mustn't leave b
+        ## without its minimum
+        possibilities = [['P1', {'a': 1., 'b': None}],
+                         ['P2', {'a': None, 'b': 0.}]]
+        limits = [(name, {'a': value, 'b': value})
+                  for name, value in (('minimums', 1.), ('maximums', 10.))]
+        currents = [['C', {'a': 0., 'b': None}]]
+        self.assertIsNone(ackpl.exact_alg(possibilities, limits[0],
+                                          limits[1], currents, 'servings'))
+        self.assertIsNone(ackpl.ackp(list(possibilities), limits[0],
+                                     limits[1], list(currents),
+                                     'exact_servings'))
+        rng = np.random.RandomState(2)
+        for case in xrange(8):
+            possibilities, minimums, maximums, currents = \
+                random_problem(rng)
+            costs = list(rng.uniform(50., 150., len(possibilities)))
+            mass = dict((name, cost) for (name, values), cost
+                        in zip(possibilities, costs))
+            for algorithm, measure in (('exact_servings', len),
+                                       ('exact_mass', lambda picks: sum(
+                                           mass[name] for name in picks))):
+                meals = []
+                for prune in ('safe', None):
+                    if prune is None:
+                        meal = ackpl.exact_alg(possibilities, minimums,
+                                               maximums, currents,
+                                               algorithm[len('exact_'):],
+                                               costs=costs)
+                    else:
+                        meal = ackpl.ackp(list(possibilities), minimums,
+                                          maximums, currents, algorithm,
+                                          costs=costs, prune=prune)
+                    meals.append(None if meal is None else
+                                 [name for name, values
+                                  in meal[len(currents or []):]])
+                if meals[1] is None:
+                    self.assertIsNone(meals[0], (case, algorithm))
+                else:
+                    self.assertAlmostEqual(measure(meals[0]),
+                                           measure(meals[1]))
+
+
+class ResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        perfectmeal.result_cache.clear()
+        self.limits = perfectmeal.get_benchmarks(GROUPINGS)
+
+    def _complete(self, names, algorithm='greedy_balance', food_groups=GROUPS,
+                  **kwargs):
+        meal = perfectmeal.get_meal(names, GROUPINGS)
+        return perfectmeal.complete_meal(meal, self.limits[0],
+                                         self.limits[1], algorithm,
+                                         food_groups, **kwargs)
+
+    def _key(self, names, food_groups=GROUPS):
+        return perfectmeal.result_key(perfectmeal.get_meal(names, GROUPINGS),
+                                      self.limits[0], self.limits[1],
+                                      'greedy_balance', food_groups)
+
+    def test_hit_and_miss(self):
+        first = self._complete(_names(0, 1))
+        self.assertEqual(perfectmeal.result_cache.memory.stats()['misses'], 1)
+        again = self._complete(_names(1, 0))
+        stats = perfectmeal.result_cache.memory.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertEqual([food.food_id for food in again.foods],
+                         [food.food_id for food in first.foods])
+        self._complete(_names(0, 2))
+        self.assertEqual(perfectmeal.result_cache.memory.stats()['misses'], 2)
+
+    def test_key_ignores_order(self):
+        key = self._key(_names(0, 1, 0))
+        self.assertEqual(self._key(_names(1, 0, 0)), key)
+        self.assertEqual(self._key(_names(0, 1, 0), GROUPS[::-1]), key)
+        self.assertNotEqual(self._key(_names(0, 1)), key)
+        self.assertNotEqual(self._key(_names(0, 1, 0), GROUPS[:1]), key)
+
+    def test_key_follows_database(self):
+        key = self._key(_names(0))
+        db = perfectmeal.get_database()
+        checksum = db.checksum
+        db.checksum = 'another database'
+        try:
+            self.assertNotEqual(self._key(_names(0)), key)
+        finally:
+            db.checksum = checksum
+        self.assertEqual(self._key(_names(0)), key)
+
+    def test_unfinished_searches_not_kept(self):
+        self._complete(_names(0), progress=lambda step, score: False)
+        self.assertEqual(len(perfectmeal.result_cache.memory), 0)
+        ## no time at all, the exact search stops before its first node
+        self._complete(_names(0), 'exact_servings', time_limit=-1)
+        self.assertEqual(len(perfectmeal.result_cache.memory), 0)
+        self._complete(_names(0), 'exact_servings')
+        self.assertEqual(len(perfectmeal.result_cache.memory), 1)
+
+
+class CompleteMealsTest(unittest.TestCase):
+    def test_unknown_food(self):
+        requests = [{'foods': _names(0), 'food_groups': GROUPS},
+                    {'foods': _names(1) + ['No such food'],
+                     'food_groups': GROUPS}]
+        for processes in (0, 1):
+            results = dict((index, (meal, error)) for index, meal, error in
+                           perfectmeal.complete_meals(requests, processes))
+            self.assertEqual(sorted(results), [0, 1])
+            meal, error = results[0]
+            self.assertIsNone(error)
+            self.assertEqual(meal.foods[0].get_name(), 'Test food 0')
+            self.assertEqual(results[1], (None, 'unknown food: No such food'))
+
+    def _run(self, requests, processes):
+        results = dict((index, (meal, error)) for index, meal, error in
+                       perfectmeal.complete_meals(requests, processes))
+        self.assertEqual(sorted(results), range(len(requests)))
+        return [results[index] for index in xrange(len(requests))]
+
+    def test_portfolio_in_pool(self):
+        ## portfolio starts processes of its own, the pool's workers can't
+        requests = [{'foods': _names(0), 'algorithm': 'portfolio',
+                     'food_groups': GROUPS},
+                    {'foods': _names(1), 'food_groups': GROUPS}]
+        for meal, error in self._run(requests, 1):
+            self.assertIsNone(error)
+            self.assertIsNotNone(meal)
+            self.assertTrue(len(meal.foods) > 1)
+
+    def test_own_processes_dont_hold_up_the_pool(self):
+        import threading
+        release = threading.Event()
+        run_request = perfectmeal.run_request
+        def _held(request, *args):
+            if request.get('algorithm') == 'portfolio':
+                release.wait(10)
+            return run_request(request, *args)
+        perfectmeal.run_request = _held
+        try:
+            requests = [{'foods': _names(0), 'algorithm': 'portfolio',
+                         'food_groups': GROUPS},
+                        {'foods': _names(1), 'food_groups': GROUPS}]
+            order = []
+            for index, meal, error in perfectmeal.complete_meals(requests,
+                                                                 1):
+                self.assertIsNone(error)
+                order.append(index)
+                release.set()
+        finally:
+            perfectmeal.run_request = run_request
+        self.assertEqual(order, [1, 0])
+
+    def test_starts_processes(self):
+        import ackpl
+        request = {'foods': _names(0), 'food_groups': GROUPS}
+        rows = len(perfectmeal.get_partial_db(GROUPS))
+        self.assertFalse(perfectmeal.starts_processes(request))
+        self.assertTrue(perfectmeal.starts_processes(
+            dict(request, algorithm='portfolio')))
+        threshold = ackpl.parallel_threshold
+        try:
+            ackpl.parallel_threshold = rows + 1
+            self.assertFalse(perfectmeal.starts_processes(request,
+                                                          "parallel"))
+            ackpl.parallel_threshold = rows
+            self.assertTrue(perfectmeal.starts_processes(request,
+                                                         "parallel"))
+            self.assertFalse(perfectmeal.starts_processes(
+                dict(request, algorithm='exact_servings'), "parallel"))
+        finally:
+            ackpl.parallel_threshold = threshold
+
+    def test_failed_pool(self):
+        import Queue
+        def _results():
+            yield 2, [1000], None
+            raise IOError('worker lost')
+        finished = Queue.Queue()
+        perfectmeal._feed(_results(), finished, [0, 2, 3])
+        self.assertEqual([finished.get_nowait() for i in xrange(3)],
+                         [(2, [1000], None),
+                          (0, None, 'IOError: worker lost'),
+                          (3, None, 'IOError: worker lost')])
+        self.assertTrue(finished.empty())
+
+    def test_bad_requests(self):
+        requests = [{'food_groups': GROUPS},
+                    {'foods': [], 'food_groups': GROUPS},
+                    {'foods': ['No such food'], 'food_groups': GROUPS},
+                    {'foods': _names(0), 'algorithm': 'no_such_algorithm'}]
+        errors = [error for meal, error in self._run(requests, 0)]
+        self.assertEqual(errors, ['foods must name at least one food',
+                                  'foods must name at least one food',
+                                  'unknown food: No such food',
+                                  'unknown algorithm: no_such_algorithm'])
+
+
+class ServerTest(unittest.TestCase):
+    ## a server on a free port, completing in its own process (so the tests
+    ## can replace what it calls)
+    @classmethod
+    def setUpClass(cls):
+        import threading
+        import perfectmeal_server
+        ## quiet, the handler logs every request to stderr
+        perfectmeal_server.RequestHandler.log_message = lambda *args: None
+        cls.server = perfectmeal_server.make_server(port=0, processes=0)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        import perfectmeal_server
+        del perfectmeal_server.RequestHandler.log_message
+
+    def _request(self, method, path, body=None):
+        import httplib
+        connection = httplib.HTTPConnection(*self.server.server_address)
+        try:
+            connection.request(method, path,
+                               None if body is None else json.dumps(body))
+            response = connection.getresponse()
+            return response.status, response.read()
+        finally:
+            connection.close()
+
+    def _json(self, method, path, body=None):
+        status, text = self._request(method, path, body)
+        return status, json.loads(text)
+
+    def _complete(self, **body):
+        body.setdefault('foods', _names(0))
+        body.setdefault('food_groups', GROUPS)
+        body.setdefault('groupings', GROUPINGS)
+        return self._request('POST', '/complete', body)
+
+    def _patch(self, owner, name, value):
+        self.addCleanup(setattr, owner, name, getattr(owner, name))
+        setattr(owner, name, value)
+
+    def test_search(self):
+        status, body = self._json('GET', '/search?q=test+food&limit=3')
+        self.assertEqual(status, 200)
+        self.assertEqual(body['count'], 40)
+        self.assertEqual(len(body['names']), 3)
+        status, body = self._json('GET', '/search')
+        self.assertEqual(status, 400)
+
+    def test_meal(self):
+        status, body = self._json('POST', '/meal', {'foods': _names(0, 1, 0),
+                                                    'groupings': GROUPINGS})
+        self.assertEqual(status, 200)
+        self.assertEqual([(food['name'], food['servings'])
+                          for food in body['foods']],
+                         [('Test food 0', 2), ('Test food 1', 1)])
+        meal = perfectmeal.get_meal(_names(0, 1, 0), GROUPINGS)
+        self.assertAlmostEqual(body['nutrients']['elements']['Calcium, Ca'],
+                               meal.elements['Calcium, Ca'])
+        for foods in ('Test food 0', 3, {'name': 'Test food 0'}, [1]):
+            status, body = self._json('POST', '/meal', {'foods': foods})
+            self.assertEqual(status, 400)
+            self.assertEqual(body['error'], 'foods must be a list of names')
+        status, body = self._json('POST', '/meal', {'foods': ['No such']})
+        self.assertEqual(status, 404)
+
+    def test_negative_length(self):
+        import httplib
+        connection = httplib.HTTPConnection(*self.server.server_address)
+        try:
+            connection.putrequest('POST', '/meal')
+            connection.putheader('Content-Length', '-1')
+            connection.endheaders()
+            response = connection.getresponse()
+            self.assertEqual(response.status, 400)
+            self.assertEqual(json.loads(response.read())['error'],
+                             'Content-Length must not be negative')
+        finally:
+            connection.close()
+
+    def test_complete(self):
+        status, text = self._complete()
+        self.assertEqual(status, 200)
+        body = json.loads(text)
+        self.assertIsNone(body['error'])
+        expected = perfectmeal.meal_from_ids(
+            perfectmeal.run_request({'foods': _names(0),
+                                     'food_groups': GROUPS,
+                                     'groupings': GROUPINGS})[0], GROUPINGS)
+        self.assertEqual([food['id'] for food in body['meal']['foods']],
+                         [food.food_id for food, servings
+                          in expected.servings()])
+
+    def test_complete_errors(self):
+        status, body = self._json('POST', '/complete', {'foods': []})
+        self.assertEqual((status, body['error']),
+                         (400, 'foods must name at least one food'))
+        status, text = self._complete(foods=['No such food'])
+        self.assertEqual((status, json.loads(text)['error']),
+                         (400, 'unknown food: No such food'))
+        def _fail(*args):
+            raise RuntimeError('broken')
+        self._patch(perfectmeal, 'run_request', _fail)
+        status, text = self._complete()
+        self.assertEqual((status, json.loads(text)['error']),
+                         (500, 'RuntimeError: broken'))
+
+    def _stream(self, **body):
+        status, text = self._complete(stream=True, **body)
+        self.assertEqual(status, 200)
+        events = [json.loads(line) for line in text.splitlines()]
+        self.assertEqual(events[0]['event'], 'queued')
+        self.assertEqual(events[-1]['event'], 'done')
+        return events[-1]
+
+    def test_stream(self):
+        done = self._stream()
+        self.assertEqual((done['code'], done['error']), (200, None))
+        self.assertTrue(len(done['meal']['foods']) > 1)
+        done = self._stream(foods=['No such food'])
+        self.assertEqual((done['code'], done['meal']), (400, None))
+
+    def test_stream_server_error(self):
+        ## after the headers, an error still ends the stream properly
+        import perfectmeal_server
+        def _fail(*args):
+            raise RuntimeError('broken')
+        self._patch(perfectmeal_server.RequestHandler, '_completed_meal',
+                    _fail)
+        done = self._stream()
+        self.assertEqual((done['code'], done['error']),
+                         (500, 'RuntimeError: broken'))
+
+    def test_cancel_flags(self):
+        import perfectmeal_server
+        self._patch(perfectmeal_server, 'CANCEL_SLOTS', 1)
+        pool = perfectmeal_server.CompletionPool(0)
+        self.addCleanup(pool.close)
+        request = {'foods': _names(0), 'food_groups': GROUPS,
+                   'groupings': GROUPINGS}
+        first = pool.submit(request, stream=True)
+        list(pool.wait(*first))
+        ## the finished job's flag went to the second one, cancelling the
+        ## first mustn't touch it
+        second = pool.submit(request, stream=True)
+        pool.cancel(first[0])
+        self.assertEqual(pool.cancelled[0], 0)
+        events = list(pool.wait(*second))
+        self.assertIsNotNone(events[-1][1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+## Token Index
+## Author: Christopher Olsen
+## Copyright: 2013
+## License: GNU GPL v3
+##
+
+## An inverted index over the food descriptions (and their USDA tags) so
+## searching doesn't have to scan every description in the selected food
+## groups on every query.
+##
+## The vocabulary is kept sorted, and the rows of each token are stored back
+## to back in one array (in vocabulary order), so all of the tokens starting
+## with a prefix are one contiguous slice of that array.
+##
+## There's also a forward index (the sorted token numbers of each row, back
+## to back) so a search can be narrowed to the rows an earlier search found,
+## e.g. while a search is typed one letter at a time.
+
+import re
+from bisect import bisect_left
+
+import numpy as np
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+def tokenize(text):
+    """ Lowercased word tokens of a string """
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    return TOKEN_RE.findall(text.lower())
+
+
+class TokenIndex(object):
+    def __init__(self, names, tags, groups):
+        """ names, tags and groups are parallel lists, one entry per database
+            row (tags is a list of lists of strings)
+            """
+        postings = {}
+        for row, name in enumerate(names):
+            tokens = set(tokenize(name))
+            for tag in tags[row]:
+                tokens.update(tokenize(tag))
+            for token in tokens:
+                postings.setdefault(token, []).append(row)
+        self.vocabulary = sorted(postings)
+        self.offsets = np.zeros(len(self.vocabulary) + 1, dtype=np.intp)
+        self.offsets[1:] = np.cumsum([len(postings[token])
+                                      for token in self.vocabulary])
+        self.postings = np.empty(self.offsets[-1], dtype=np.int32)
+        for i, token in enumerate(self.vocabulary):
+            self.postings[self.offsets[i]:self.offsets[i + 1]] = \
+                postings[token]
+        # the forward index: row_tokens[row_offsets[r]:row_offsets[r + 1]]
+        # are row r's token numbers
+        token_ids = np.repeat(np.arange(len(self.vocabulary), dtype=np.int32),
+                              np.diff(self.offsets))
+        order = np.lexsort((token_ids, self.postings))
+        self.row_tokens = token_ids[order]
+        self.row_offsets = np.zeros(len(names) + 1, dtype=np.intp)
+        self.row_offsets[1:] = np.cumsum(np.bincount(self.postings,
+                                                     minlength=len(names)))
+        self.names = names
+        self.group_names = sorted(set(groups))
+        group_code = dict((g, i) for i, g in enumerate(self.group_names))
+        self.group_codes = np.array([group_code[g] for g in groups],
+                                    dtype=np.intp)
+        self.all_rows = np.arange(len(names), dtype=np.int32)
+
+    def _token_range(self, prefix):
+        # the vocabulary numbers of the tokens starting with prefix
+        return (bisect_left(self.vocabulary, prefix),
+                bisect_left(self.vocabulary, prefix + u'\uffff'))
+
+    def prefix_rows(self, prefix):
+        """ Sorted rows having at least one token that starts with prefix """
+        lo, hi = self._token_range(prefix)
+        return np.unique(self.postings[self.offsets[lo]:self.offsets[hi]])
+
+    def narrow(self, rows, prefix):
+        """ The rows (an array) having a token that starts with prefix,
+            found through the forward index so the cost depends on len(rows)
+            rather than on how common the prefix is.
+            """
+        lo, hi = self._token_range(prefix)
+        starts = self.row_offsets[rows]
+        lengths = self.row_offsets[rows + 1] - starts
+        # positions of all of the rows' tokens in row_tokens
+        positions = np.arange(lengths.sum()) + \
+                    np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+        tokens = self.row_tokens[positions]
+        hits = np.repeat(np.arange(len(rows)), lengths)[(tokens >= lo) &
+                                                         (tokens < hi)]
+        matched = np.zeros(len(rows), dtype=bool)
+        matched[hits] = True
+        return rows[matched]
+
+    def term_rows(self, term, candidates=None):
+        """ Sorted rows matching a search term.  A term that is more than one
+            token ("t-bone") needs all of them, a term with no tokens at all
+            matches everything.  If candidates (an array of rows) are given
+            only they are checked, and they keep their order.
+            """
+        rows = candidates
+        for token in tokenize(term):
+            if rows is not None:
+                rows = self.narrow(rows, token)
+            else:
+                rows = self.prefix_rows(token)
+        if rows is None:
+            return self.all_rows
+        return rows
+
+    def _group_ranks(self, food_groups):
+        # rank of each group code in food_groups, -1 if not selected
+        ranks = np.empty(len(self.group_names), dtype=np.intp)
+        ranks.fill(-1)
+        for rank, group in enumerate(food_groups):
+            if group in self.group_names:
+                code = self.group_names.index(group)
+                if ranks[code] < 0:
+                    ranks[code] = rank
+        return ranks
+
+    def search_one_rows(self, term, food_groups, candidates=None):
+        """ Rows of the foods in food_groups matching term, in food group
+            then database order.  candidates: see term_rows.
+            """
+        ranks = self._group_ranks(food_groups)
+        rows = self.term_rows(term, candidates)
+        row_ranks = ranks[self.group_codes[rows]]
+        keep = row_ranks >= 0
+        rows, row_ranks = rows[keep], row_ranks[keep]
+        order = np.lexsort((rows, row_ranks))
+        return rows[order]
+
+    def search_many_rows(self, terms, food_groups, candidates=None):
+        """ Rows of the foods in food_groups matching all but one of the
+            terms (and at least two of them), most matches first.
+            candidates: see term_rows.
+            """
+        ranks = self._group_ranks(food_groups)
+        rows, counts = np.unique(
+            np.concatenate([self.term_rows(term, candidates)
+                            for term in terms]),
+            return_counts=True)
+        row_ranks = ranks[self.group_codes[rows]]
+        keep = (row_ranks >= 0) & (counts >= len(terms) - 1) & (counts > 1)
+        rows, counts, row_ranks = rows[keep], counts[keep], row_ranks[keep]
+        order = np.lexsort((rows, row_ranks, -counts))
+        return rows[order]
+
+    def names_for(self, rows, unique=False):
+        """ The names of rows, in order.  unique drops repeated names. """
+        if not unique:
+            return [self.names[row] for row in rows]
+        names, seen = [], set()
+        for row in rows:
+            name = self.names[row]
+            if name not in seen:
+                seen.add(name)
+                names.append(name)
+        return names
+
+    def search_one(self, term, food_groups, candidates=None):
+        """ Names of the foods in food_groups matching term, in food group
+            then database order.
+            """
+        return self.names_for(self.search_one_rows(term, food_groups,
+                                                   candidates))
+
+    def search_many(self, terms, food_groups, candidates=None):
+        """ Names of the foods in food_groups matching all but one of the
+            terms (and at least two of them), most matches first.
+            """
+        return self.names_for(self.search_many_rows(terms, food_groups,
+                                                    candidates),
+                              unique=True)